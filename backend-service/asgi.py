@@ -0,0 +1,202 @@
+"""
+ASGI entry point for the fulfillment webhook, for running on an ASGI
+server (e.g. `uvicorn asgi:app`) instead of the Functions Framework.
+
+POST requests carry the Dialogflow webhook body and are answered by
+main.handle_request_async; GET .../metrics serves the Prometheus metrics,
+GET .../sales the sales rollups and GET .../kitchen the kitchen feed, as
+server-sent events when the client accepts text/event-stream and by
+long-poll otherwise.
+Requests wait on the event loop, not on a thread, so one worker serves many
+concurrent lanes.
+"""
+import asyncio
+import logging
+import os
+from urllib.parse import parse_qsl
+
+import fast_json
+import main
+import metrics
+from kitchen_feed import parse_poll
+from webhook_request import decode_webhook_request
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Larger request bodies are rejected before parsing; webhook bodies are a few KB
+ASGI_MAX_BODY_BYTES = int(os.environ.get("ASGI_MAX_BODY_BYTES", str(1024 * 1024)))
+
+# Comment lines sent on idle event streams, so proxies do not close them
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("SSE_KEEPALIVE_SECONDS", "15"))
+
+
+async def _send(send, status: int, body: bytes, content_type: str):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(send, status: int, payload):
+    await _send(send, status, fast_json.dumps(payload), fast_json.CONTENT_TYPE)
+
+
+class BodyTooLarge(Exception):
+    """Raised when a request body exceeds ASGI_MAX_BODY_BYTES."""
+
+
+async def _read_body(receive):
+    """Returns the request body, or None if the client disconnected first."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > ASGI_MAX_BODY_BYTES:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+def _header(scope, name: bytes) -> str:
+    for key, value in scope.get("headers", []):
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return ""
+
+
+def _subscribe(cursor, store_id=None):
+    """Subscribes to the kitchen feed; returns the subscription and an asyncio.Event set when events arrive."""
+    arrived = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    subscription = main.kitchen_feed.subscribe(cursor, wake=lambda: loop.call_soon_threadsafe(arrived.set),
+                                               store_id=store_id)
+    return subscription, arrived
+
+
+async def _kitchen_poll(send, params):
+    """Long-poll on the event loop: waits for events without holding a worker thread."""
+    try:
+        arguments = parse_poll(params)
+    except ValueError as e:
+        await _send_json(send, 400, {"error": f"Invalid kitchen feed query: {str(e)}"})
+        return
+    subscription, arrived = _subscribe(arguments["cursor"], arguments["store_id"])
+    try:
+        events, reset = subscription.take()
+        if not events and not reset:
+            try:
+                await asyncio.wait_for(arrived.wait(), arguments["timeout"])
+                events, reset = subscription.take()
+            except asyncio.TimeoutError:
+                pass
+        await _send_json(send, 200, {"cursor": subscription.cursor, "reset": reset, "events": events})
+    finally:
+        subscription.close()
+
+
+async def _kitchen_stream(scope, receive, send, params):
+    """
+    Streams the kitchen feed as server-sent events, one "order" event per
+    order with the cursor as its id, so EventSource resumes from
+    Last-Event-ID on reconnect. A "reset" event tells the display to clear
+    its screen before the orders that follow.
+    """
+    subscription, arrived = _subscribe(_header(scope, b"last-event-id") or params.get("after") or None,
+                                       params.get("store") or None)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        })
+        while not disconnected.done():
+            arrived.clear()
+            events, reset = subscription.take()
+            chunks = [b"event: reset\ndata: {}\n\n"] if reset else []
+            for event in events:
+                chunks.append(b"id: " + event["id"].encode() + b"\nevent: order\ndata: "
+                              + fast_json.dumps(event["order"]) + b"\n\n")
+            if chunks:
+                await send({"type": "http.response.body", "body": b"".join(chunks), "more_body": True})
+                continue
+            waiter = asyncio.ensure_future(arrived.wait())
+            done, _ = await asyncio.wait({waiter, disconnected}, timeout=SSE_KEEPALIVE_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if not done:
+                await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+    finally:
+        disconnected.cancel()
+        subscription.close()
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Give journaled orders a chance to reach Firestore before the worker exits
+            await main.run_blocking(main.order_writer.flush, 10)
+            main.io_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    if method == "GET" and scope["path"].endswith("/metrics"):
+        await _send(send, 200, metrics.REGISTRY.render().encode(), metrics.CONTENT_TYPE)
+        return
+    if method == "GET" and scope["path"].endswith("/sales"):
+        params = dict(parse_qsl(scope.get("query_string", b"").decode()))
+        payload, status = await main.run_blocking(main.sales_report, params)
+        await _send_json(send, status, payload)
+        return
+    if method == "GET" and scope["path"].endswith("/kitchen"):
+        params = dict(parse_qsl(scope.get("query_string", b"").decode()))
+        if "text/event-stream" in _header(scope, b"accept"):
+            await _kitchen_stream(scope, receive, send, params)
+        else:
+            await _kitchen_poll(send, params)
+        return
+    if method != "POST":
+        await _send_json(send, 405, {"error": "Method not allowed"})
+        return
+
+    try:
+        body = await _read_body(receive)
+    except BodyTooLarge:
+        await _send_json(send, 413, {"error": "Request body too large"})
+        return
+    if body is None:
+        return
+    try:
+        webhook_request = decode_webhook_request(body)
+    except ValueError as e:
+        logger.warning(f"Rejected invalid webhook request: {str(e)}")
+        await _send_json(send, 400, {"error": "Invalid webhook request"})
+        return
+
+    response = await main.handle_request_async(webhook_request)
+    await _send_json(send, 200, response)
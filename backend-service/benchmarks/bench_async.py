@@ -0,0 +1,145 @@
+"""
+Benchmark for the ASGI entry point under many concurrent drive-thru lanes.
+
+Serves the same conversations (order an item, complete the order) for N
+lanes twice against an in-memory Firestore with simulated latency: one
+request at a time through main.handle_request, and all lanes in flight at
+once through asgi.app. Orders are written synchronously so every completion
+pays a Firestore round trip. Also reports the cold first request, where the
+async path loads the menu and order limits concurrently, and the number of
+threads the async run used.
+
+    python benchmarks/bench_async.py [--lanes 200] [--latency-ms 20] [--workers 16]
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from fake_firestore import FakeFirestore
+from harness import load_service
+
+MENU = {
+    "1001": {"name": "Big Mac", "category": "food", "available": True, "base_price": 5.99},
+    "2001": {"name": "Coca Cola", "category": "drink", "available": True, "base_price": 1.99,
+             "has_size": True, "sizes": {"small": 0, "medium": 0.5, "large": 1.0}},
+}
+ORDER_LIMITS = {"order_limits": {"food": {"default_max_quantity": 10}, "drink": {"default_max_quantity": 10}}}
+
+
+def turn(lane: str, intent: str, parameters: dict) -> dict:
+    session = f"projects/bench/agent/sessions/{lane}"
+    return {
+        "responseId": f"{lane}-{intent}",
+        "session": session,
+        "queryResult": {
+            "queryText": intent,
+            "parameters": parameters,
+            "intent": {"displayName": intent},
+            "outputContexts": [{"name": f"{session}/contexts/ongoing-order", "parameters": parameters}],
+        },
+    }
+
+
+def conversation(lane: str):
+    return [
+        turn(lane, "order.food", {"food-item": ["Big Mac"], "number": 1}),
+        turn(lane, "order.complete", {}),
+    ]
+
+
+class Request:
+    method = "POST"
+    path = "/"
+
+    def __init__(self, body: dict):
+        self._body = json.dumps(body).encode()
+
+    def get_data(self):
+        return self._body
+
+
+async def asgi_post(app, body: dict) -> int:
+    messages = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": "POST", "path": "/"}, receive, send)
+    return sent[0]["status"]
+
+
+def fresh_firestore(service, latency_seconds: float) -> FakeFirestore:
+    """Installs a new in-memory Firestore and empties the caches, so the next request is cold."""
+    fake = FakeFirestore(latency_seconds=latency_seconds)
+    fake.seed("menu_items", MENU)
+    fake.seed("configs", {"order_limits": ORDER_LIMITS})
+    service.set_db(fake)
+    for cache in (service.menu_catalog, service.order_limits_config):
+        cache._loaded_at = None
+    return fake
+
+
+async def run_async(service, app, lanes: int):
+    async def lane(index: int):
+        for body in conversation(f"async-{index}"):
+            status = await asgi_post(app, body)
+            if status != 200:
+                raise RuntimeError(f"lane {index} got HTTP {status}")
+
+    peak_threads = threading.active_count()
+    tasks = [asyncio.ensure_future(lane(index)) for index in range(lanes)]
+    while not all(task.done() for task in tasks):
+        peak_threads = max(peak_threads, threading.active_count())
+        await asyncio.sleep(0.005)
+    await asyncio.gather(*tasks)
+    return peak_threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lanes", type=int, default=200, help="concurrent conversations")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated latency per Firestore call")
+    parser.add_argument("--workers", type=int, default=16, help="ASYNC_WORKER_THREADS")
+    args = parser.parse_args()
+
+    service = load_service(FakeFirestore(), ASYNC_WORKER_THREADS=args.workers, ORDER_WRITE_BEHIND="false")
+    import asgi
+
+    latency = args.latency_ms / 1000
+
+    fresh_firestore(service, latency)
+    started = time.perf_counter()
+    service.handle_request(Request(turn("cold-sync", "order.food", {"food-item": ["Big Mac"], "number": 1})))
+    cold_sync_ms = (time.perf_counter() - started) * 1000
+
+    fresh_firestore(service, latency)
+    started = time.perf_counter()
+    asyncio.run(asgi_post(asgi.app, turn("cold-async", "order.food", {"food-item": ["Big Mac"], "number": 1})))
+    cold_async_ms = (time.perf_counter() - started) * 1000
+    print(f"cold first request: sync {cold_sync_ms:.1f} ms, async {cold_async_ms:.1f} ms")
+
+    started = time.perf_counter()
+    for index in range(args.lanes):
+        for body in conversation(f"sync-{index}"):
+            service.handle_request(Request(body))
+    sync_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    peak_threads = asyncio.run(run_async(service, asgi.app, args.lanes))
+    async_seconds = time.perf_counter() - started
+
+    turns = args.lanes * 2
+    print(f"{args.lanes} lanes, {turns} turns, {args.latency_ms:g} ms per Firestore call")
+    print(f"  sync, one at a time: {sync_seconds:7.2f} s  ({turns / sync_seconds:7.1f} turns/s)")
+    print(f"  async, all in flight: {async_seconds:6.2f} s  ({turns / async_seconds:7.1f} turns/s), "
+          f"peak {peak_threads} threads")
+
+
+if __name__ == "__main__":
+    main()
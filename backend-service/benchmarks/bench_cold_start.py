@@ -0,0 +1,93 @@
+"""
+Benchmark for webhook cold start: import of main.py to first response.
+
+Each run starts a fresh interpreter that imports main, then serves one
+order.food request through handle_request. Runs are repeated for a fully
+cold start, a start seeded from a warm snapshot file, and a start with
+WARM_UP_ON_IMPORT, and the medians are reported.
+
+main.py connects to the Firestore project it is configured for, so run this
+where its dependencies and credentials (or an emulator) are available:
+
+    python benchmarks/bench_cold_start.py [--runs 10] [--snapshot warm_snapshot.json] [--item "Big Mac"]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the child interpreter; prints one JSON line of timings
+CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+class Request:
+    method = "POST"
+    path = "/"
+
+    def get_data(self):
+        return json.dumps({
+            "responseId": "cold-start",
+            "queryResult": {
+                "intent": {"displayName": "order.food"},
+                "parameters": {"food-item": [sys.argv[1]], "number": 1},
+                "outputContexts": [{"name": "projects/bench/agent/sessions/cold-start/contexts/ongoing-order"}],
+            },
+        }).encode()
+
+main.handle_request(Request())
+responded = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_response_ms": (responded - imported) * 1000,
+    "total_ms": (responded - started) * 1000,
+}))
+"""
+
+SCENARIOS = {
+    "cold": {"WARM_SNAPSHOT_PATH": "", "WARM_UP_ON_IMPORT": "false"},
+    "snapshot": {"WARM_UP_ON_IMPORT": "false"},
+    "warm-up": {"WARM_SNAPSHOT_PATH": "", "WARM_UP_ON_IMPORT": "true"},
+}
+
+
+def run_once(env: dict, item: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, item],
+        cwd=SERVICE_DIR, env=env, capture_output=True, text=True, check=False,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"child failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--snapshot", default=os.path.join(SERVICE_DIR, "warm_snapshot.json"))
+    parser.add_argument("--item", default="Big Mac")
+    args = parser.parse_args()
+
+    print(f"{'scenario':>9} {'import ms':>10} {'first resp ms':>14} {'total ms':>9}")
+    for scenario, overrides in SCENARIOS.items():
+        env = dict(os.environ, **overrides)
+        if scenario == "snapshot":
+            if not os.path.exists(args.snapshot):
+                print(f"{scenario:>9}  skipped: no snapshot at {args.snapshot} (python warm_snapshot.py)")
+                continue
+            env["WARM_SNAPSHOT_PATH"] = os.path.abspath(args.snapshot)
+
+        runs = [run_once(env, args.item) for _ in range(args.runs)]
+        print(f"{scenario:>9} {statistics.median(r['import_ms'] for r in runs):>10.1f} "
+              f"{statistics.median(r['first_response_ms'] for r in runs):>14.1f} "
+              f"{statistics.median(r['total_ms'] for r in runs):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark for exporting the orders collection.
+
+Writes N completed orders to the SQLite data backend in a temporary file,
+then exports them to NDJSON with order_export (paged reads with query
+cursors, one page in memory at a time) and, for comparison, by reading
+every order at once with list_orders(), for growing N. Reports throughput
+and the peak Python heap of each, measured with tracemalloc.
+
+    python benchmarks/bench_export.py [--orders 2000,10000,40000] [--page-size 500]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from bench_sales import make_order
+from harness import load_service
+
+
+def measured(function):
+    """Runs function; returns (result, seconds, peak traced heap in MB)."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", default="2000,10000,40000", help="order counts to measure at")
+    parser.add_argument("--page-size", type=int, default=500, help="orders per query page")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-export-")
+    service = load_service(DATA_BACKEND="sqlite", DATA_SQLITE_PATH=os.path.join(workdir, "data.sqlite3"))
+    from order_export import export_orders
+
+    random.seed(7)
+    day_start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    repository = service.order_repository
+
+    def paged():
+        out_dir = os.path.join(workdir, "export")
+        shutil.rmtree(out_dir, ignore_errors=True)
+        return export_orders(repository, out_dir, page_size=args.page_size)
+
+    def all_at_once():
+        return len(repository.list_orders())
+
+    written = 0
+    print(f"{'orders':>7} {'paged export':>28} {'list_orders() only':>28}")
+    try:
+        for target in (int(count) for count in args.orders.split(",")):
+            while written < target:
+                repository.save_orders([make_order(index, day_start) for index in range(written, min(target, written + 500))])
+                written = min(target, written + 500)
+
+            stats, export_seconds, export_peak = measured(paged)
+            assert stats["orders"] == target, stats["orders"]
+            count, list_seconds, list_peak = measured(all_at_once)
+            print(f"{target:>7} {target / export_seconds:>9.0f} orders/s {export_peak:>8.1f} MB peak "
+                  f"{count / list_seconds:>9.0f} orders/s {list_peak:>8.1f} MB peak")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Per-intent benchmark for the webhook, run offline against an in-memory Firestore.
+
+Builds webhook payloads for every webhook-enabled intent from the training
+phrases and entities in dialogflow/, serves them through
+main.dialogflow_webhook with benchmarks/fake_firestore.py standing in for
+Firestore, and reports per-intent latency percentiles, peak allocation and
+Firestore calls per request. Results are written as JSON so runs can be
+compared; --compare exits non-zero on regressions against a previous run.
+
+    python benchmarks/bench_intents.py [--requests 500] [--latency-ms 0] [--output results.json]
+                                       [--compare baseline.json] [--tolerance 0.25]
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+from fake_firestore import FakeFirestore
+from harness import SERVICE_DIR, load_service
+
+DIALOGFLOW_DIR = os.path.join(SERVICE_DIR, "dialogflow")
+
+PROJECT_ID = "bench-project"
+
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10, "a couple": 2, "couple": 2,
+}
+
+# Handlers that act on an existing cart get one to work on first
+NEEDS_CART = {"order.modify", "order.quantity", "order.remove", "order.size", "order.complete"}
+
+# Allocation tracking slows requests down, so it runs as a shorter second pass
+ALLOCATION_REQUESTS = 100
+
+
+def load_entities() -> dict:
+    """Returns {entity name: {lowercased synonym: canonical value}}."""
+    entities = {}
+    for path in glob.glob(os.path.join(DIALOGFLOW_DIR, "entities", "*_entries_en.json")):
+        name = os.path.basename(path)[:-len("_entries_en.json")]
+        with open(path) as f:
+            entries = json.load(f)
+        synonyms = entities.setdefault(name, {})
+        for entry in entries:
+            for synonym in [entry["value"]] + entry.get("synonyms", []):
+                synonyms.setdefault(synonym.lower(), entry["value"])
+    return entities
+
+
+def load_intents() -> dict:
+    """Returns {intent name: (declared parameters, input contexts, training phrases)} for webhook intents."""
+    intents = {}
+    for path in sorted(glob.glob(os.path.join(DIALOGFLOW_DIR, "intents", "*.json"))):
+        if path.endswith("_usersays_en.json"):
+            continue
+        with open(path) as f:
+            intent = json.load(f)
+        if not intent.get("webhookUsed"):
+            continue
+        declared = {
+            parameter["name"]: (parameter["dataType"], parameter["isList"])
+            for response in intent.get("responses", [])
+            for parameter in response.get("parameters", [])
+        }
+        phrases_path = path[:-len(".json")] + "_usersays_en.json"
+        phrases = []
+        if os.path.exists(phrases_path):
+            with open(phrases_path) as f:
+                phrases = json.load(f)
+        intents[intent["name"]] = (declared, intent.get("contexts", []), phrases)
+    return intents
+
+
+def parse_number(text: str):
+    text = text.strip().lower()
+    if text in NUMBER_WORDS:
+        return NUMBER_WORDS[text]
+    try:
+        return float(text)
+    except ValueError:
+        return 1
+
+
+def phrase_parameters(phrase: dict, declared: dict, entities: dict) -> dict:
+    """Resolves a training phrase's annotated parts the way Dialogflow fills parameters."""
+    found = {name: [] for name in declared}
+    for part in phrase.get("data", []):
+        alias = part.get("alias")
+        if alias not in declared:
+            continue
+        text = part["text"].strip()
+        data_type = declared[alias][0]
+        if data_type == "@sys.number":
+            value = parse_number(text)
+        else:
+            value = entities.get(data_type.lstrip("@"), {}).get(text.lower(), text)
+        found[alias].append(value)
+
+    # Missing parameters arrive as empty strings (or empty lists for list parameters)
+    return {
+        name: values if is_list else (values[0] if values else "")
+        for name, (_, is_list), values in ((name, declared[name], found[name]) for name in declared)
+    }
+
+
+def build_menu(entities: dict):
+    """Menu documents for every food and drink entity value, with sizes and customizations."""
+    components = sorted(set(entities.get("food-components", {}).values()))
+    menu = {}
+    for index, name in enumerate(sorted(set(entities.get("food-item", {}).values()))):
+        has_size = "fries" in name.lower()
+        menu[f"food{index}"] = {
+            "name": name, "category": "food", "available": True,
+            "base_price": round(1.99 + index % 7, 2), "has_size": has_size,
+            "sizes": {"small": 0, "medium": 0.5, "large": 1.0} if has_size else {},
+            "customizations": {"removable": components, "addable": components, "modifiable": components},
+        }
+    for index, name in enumerate(sorted(set(entities.get("drink-item", {}).values()))):
+        menu[f"drink{index}"] = {
+            "name": name, "category": "drink", "available": True,
+            "base_price": round(0.99 + index % 4, 2), "has_size": True,
+            "sizes": {"small": 0, "medium": 0.5, "large": 1.0},
+        }
+    return menu
+
+
+ORDER_LIMITS = {
+    "order_limits": {
+        "food": {"default_max_quantity": 10, "item_specific_limits": {}},
+        "drink": {"default_max_quantity": 10, "item_specific_limits": {}},
+        "messages": {"exceed_limit": "For orders of {quantity} items, please visit our counter."},
+    }
+}
+
+
+# Every turn gets its own responseId, as from Dialogflow, so none is taken for a retry
+RESPONSE_IDS = itertools.count()
+
+
+def webhook_payload(intent: str, parameters: dict, session_id: str, extra_contexts=()) -> dict:
+    session = f"projects/{PROJECT_ID}/agent/sessions/{session_id}"
+    contexts = [{"name": f"{session}/contexts/ongoing-order", "lifespanCount": 5, "parameters": parameters}]
+    contexts += [
+        {"name": f"{session}/contexts/{name}", "lifespanCount": 1, "parameters": dict(params)}
+        for name, params in extra_contexts
+    ]
+    return {
+        "responseId": f"{session_id}-{intent}-{next(RESPONSE_IDS)}",
+        "session": session,
+        "queryResult": {
+            "queryText": intent,
+            "parameters": parameters,
+            "intent": {"displayName": intent},
+            "outputContexts": contexts,
+        },
+    }
+
+
+class Workload:
+    """Cycles through an intent's training phrases, producing (setup requests, measured request)."""
+
+    def __init__(self, intent: str, declared: dict, contexts: list, phrases: list, entities: dict, menu: dict):
+        self.intent = intent
+        self.contexts = [name for name in contexts if name != "ongoing-order"]
+        self.parameters = [phrase_parameters(phrase, declared, entities) for phrase in phrases] or [
+            {name: [] if is_list else "" for name, (_, is_list) in declared.items()}
+        ]
+        foods = [doc["name"] for doc in menu.values() if doc["category"] == "food" and not doc["has_size"]]
+        drinks = [doc["name"] for doc in menu.values() if doc["category"] == "drink"]
+        self.food = "Big Mac" if "Big Mac" in foods else foods[0]
+        self.drink = drinks[0]
+
+    def request(self, index: int):
+        session_id = f"bench-{self.intent}-{index}"
+        parameters = self.parameters[index % len(self.parameters)]
+        setup = []
+        if self.intent in NEEDS_CART:
+            setup.append(webhook_payload("order.food", {"food-item": [self.food], "number": 2}, session_id))
+            setup.append(webhook_payload("order.drink", {"drink-item": self.drink, "drink-size": "", "number": 1},
+                                         session_id))
+        extra = [(name, {}) for name in self.contexts if name != "awaiting-size"]
+        if "awaiting-size" in self.contexts:
+            extra.append(("awaiting-size", {"item_name": self.drink, "item_type": "drink"}))
+        return setup, webhook_payload(self.intent, parameters, session_id, extra)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_workload(main, fake: FakeFirestore, workload: Workload, requests: int, offset: int, track_allocations: bool):
+    latencies_us = []
+    peaks = []
+    calls = Counter()
+    errors = 0
+    for index in range(offset, offset + requests):
+        setup, payload = workload.request(index)
+        for setup_payload in setup:
+            main.dialogflow_webhook(setup_payload)
+        main.order_writer.flush(5)
+        before = Counter(fake.calls)
+
+        if track_allocations:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter_ns()
+        response = main.dialogflow_webhook(payload)
+        latencies_us.append((time.perf_counter_ns() - started) / 1000)
+        if track_allocations:
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+
+        # Background order writes are charged to the request that queued them
+        main.order_writer.flush(5)
+        calls.update(Counter(fake.calls) - before)
+        if response.get("fulfillmentText", "").startswith("Sorry, there was an error"):
+            errors += 1
+    return latencies_us, peaks, calls, errors
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Returns regression messages: slower p50/p95 beyond tolerance, or more Firestore calls."""
+    regressions = []
+    for intent, current in results["intents"].items():
+        previous = baseline.get("intents", {}).get(intent)
+        if previous is None:
+            continue
+        for metric in ("p50_us", "p95_us"):
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{intent}: {metric} {previous[metric]:.1f} -> {current[metric]:.1f}")
+        for kind, count in current["firestore_calls_per_request"].items():
+            if count > previous["firestore_calls_per_request"].get(kind, 0) + 1e-9:
+                regressions.append(f"{intent}: Firestore {kind} per request "
+                                   f"{previous['firestore_calls_per_request'].get(kind, 0):.2f} -> {count:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per intent")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated latency per Firestore call")
+    parser.add_argument("--intents", nargs="+", help="only benchmark these intents")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline results JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative latency increase")
+    args = parser.parse_args()
+
+    # Configure the service for an offline, in-process run before importing it
+    journal_dir = tempfile.mkdtemp(prefix="vos-bench-")
+    entities = load_entities()
+    menu = build_menu(entities)
+    fake = FakeFirestore(latency_seconds=args.latency_ms / 1000)
+    fake.seed("menu_items", menu)
+    fake.seed("configs", {"order_limits": ORDER_LIMITS})
+    service = load_service(fake, SESSION_STORE_BACKEND="memory",
+                           ORDER_JOURNAL_PATH=os.path.join(journal_dir, "orders.sqlite3"))
+    service.warm_up()
+
+    intents = load_intents()
+    selected = args.intents or sorted(intents)
+    results = {
+        "meta": {
+            "requests_per_intent": args.requests,
+            "simulated_latency_ms": args.latency_ms,
+            "menu_items": len(menu),
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "intents": {},
+    }
+
+    print(f"{'intent':>27} {'p50 us':>8} {'p95 us':>8} {'p99 us':>8} {'peak KiB':>9} {'fs calls':>9} {'errors':>6}")
+    for intent in selected:
+        declared, contexts, phrases = intents[intent]
+        workload = Workload(intent, declared, contexts, phrases, entities, menu)
+        latencies, _, calls, errors = run_workload(service, fake, workload, args.requests, 0, False)
+
+        tracemalloc.start()
+        try:
+            _, peaks, _, _ = run_workload(service, fake, workload, min(args.requests, ALLOCATION_REQUESTS),
+                                          args.requests, True)
+        finally:
+            tracemalloc.stop()
+
+        per_request = {kind: count / args.requests for kind, count in sorted(calls.items())}
+        stats = {
+            "requests": args.requests,
+            "errors": errors,
+            "mean_us": statistics.mean(latencies),
+            "p50_us": percentile(latencies, 50),
+            "p95_us": percentile(latencies, 95),
+            "p99_us": percentile(latencies, 99),
+            "alloc_peak_bytes_p50": percentile(peaks, 50),
+            "firestore_calls_per_request": per_request,
+        }
+        results["intents"][intent] = stats
+        print(f"{intent:>27} {stats['p50_us']:>8.1f} {stats['p95_us']:>8.1f} {stats['p99_us']:>8.1f} "
+              f"{stats['alloc_peak_bytes_p50'] / 1024:>9.1f} {sum(per_request.values()):>9.2f} {errors:>6}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONS:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"OK: no regressions against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark for the JSON codec used for webhook bodies.
+
+Records request and response bodies by serving conversations through
+main.dialogflow_webhook on the in-memory data backend, with carts of
+growing size, then times decoding each request into a WebhookRequest and
+encoding each response to bytes: with the standard library (the previous
+path) and with the codec fast_json selected (JSON_CODEC, orjson or msgspec
+when installed).
+
+    python benchmarks/bench_json.py [--iterations 2000] [--cart-sizes 1,5,20]
+"""
+import argparse
+import json
+import time
+
+from harness import load_service
+
+# The in-memory backend serves the example menu from firestore/menu_items.json
+TURNS = [
+    ("order.food", {"food-item": ["Big Mac"], "number": 2, "modification-type": ["no"], "food-components": ["onions"]}),
+    ("order.food", {"food-item": ["Big Mac"], "number": 1}),
+]
+
+
+def webhook_body(session_id: str, intent: str, parameters: dict) -> dict:
+    """A request as Dialogflow sends it, with the contexts an ongoing order carries."""
+    session = f"projects/bench/agent/sessions/{session_id}"
+    original = {f"{name}.original": str(value) for name, value in parameters.items()}
+    return {
+        "responseId": f"{session_id}-{intent}-{time.perf_counter_ns()}",
+        "session": session,
+        "queryResult": {
+            "queryText": f"I'd like {parameters}",
+            "parameters": parameters,
+            "allRequiredParamsPresent": True,
+            "intent": {"name": f"projects/bench/agent/intents/{intent}", "displayName": intent},
+            "intentDetectionConfidence": 0.92,
+            "languageCode": "en",
+            "outputContexts": [
+                {"name": f"{session}/contexts/ongoing-order", "lifespanCount": 5,
+                 "parameters": dict(parameters, **original)},
+                {"name": f"{session}/contexts/__system_counters__", "lifespanCount": 1,
+                 "parameters": {"no-input": 0.0, "no-match": 0.0, **parameters, **original}},
+            ],
+        },
+        "originalDetectIntentRequest": {"source": "DIALOGFLOW_CONSOLE", "payload": {}},
+    }
+
+
+def record(service, cart_size: int):
+    """Serves a conversation until the cart holds cart_size lines; returns the last request and response."""
+    session_id = f"cart-{cart_size}"
+    for index in range(cart_size):
+        intent, parameters = TURNS[index % len(TURNS)]
+        body = webhook_body(session_id, intent, parameters)
+        response = service.dialogflow_webhook(body)
+    return json.dumps(body).encode(), response
+
+
+def per_call_us(function, argument, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=2000, help="decodes and encodes per payload")
+    parser.add_argument("--cart-sizes", default="1,5,20", help="cart lines in the recorded responses")
+    args = parser.parse_args()
+
+    service = load_service(DATA_BACKEND="memory", ORDER_WRITE_BEHIND="false")
+    import fast_json
+    from webhook_request import decode_webhook_request, parse_webhook_request
+
+    def stdlib_decode(body):
+        return parse_webhook_request(json.loads(body))
+
+    def stdlib_encode(response):
+        return json.dumps(response).encode()
+
+    print(f"fast_json codec: {fast_json.CODEC}")
+    if fast_json.CODEC == "stdlib":
+        print("(orjson/msgspec not installed or not selected; both columns use the standard library)")
+    print(f"{'cart':>5} {'req B':>7} {'resp B':>7} {'decode us':>18} {'encode us':>18}")
+    print(f"{'':>5} {'':>7} {'':>7} {'stdlib':>8} {fast_json.CODEC:>9} {'stdlib':>8} {fast_json.CODEC:>9}")
+    for cart_size in (int(size) for size in args.cart_sizes.split(",")):
+        body, response = record(service, cart_size)
+        assert len(response["payload"]["order_summary"]["items"]) == cart_size, response["fulfillmentText"]
+        decode = (per_call_us(stdlib_decode, body, args.iterations),
+                  per_call_us(decode_webhook_request, body, args.iterations))
+        encode = (per_call_us(stdlib_encode, response, args.iterations),
+                  per_call_us(fast_json.dumps, response, args.iterations))
+        print(f"{cart_size:>5} {len(body):>7} {len(fast_json.dumps(response)):>7} "
+              f"{decode[0]:>8.1f} {decode[1]:>9.1f} {encode[0]:>8.1f} {encode[1]:>9.1f}"
+              f"   ({decode[0] / decode[1]:.1f}x, {encode[0] / encode[1]:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark for fanning completed orders out to kitchen displays.
+
+Subscribes N displays to a KitchenFeed the way asgi.py's event streams do
+(one coroutine per display, woken from the publishing thread), publishes
+orders from a separate thread at a steady rate, and reports the latency
+from publish() to each display taking the order, for growing N. The feed
+makes no data backend reads however many displays there are; the last
+column is the queries per minute the same displays would make polling
+Firestore for new orders every --poll-interval seconds.
+
+    python benchmarks/bench_kitchen.py [--displays 1,10,100,1000] [--orders 200] [--rate 100]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kitchen_feed import KitchenFeed  # noqa: E402
+
+ITEMS = [{"item_id": "1001", "name": "Big Mac", "quantity": 1, "customizations": ["no onions"]}]
+
+
+async def display(feed: KitchenFeed, orders: int, published_at: dict, latencies: list):
+    arrived = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    subscription = feed.subscribe(wake=lambda: loop.call_soon_threadsafe(arrived.set))
+    received = 0
+    try:
+        while received < orders:
+            arrived.clear()
+            events, _ = subscription.take()
+            now = time.perf_counter()
+            for event in events:
+                latencies.append(now - published_at[event["order"]["id"]])
+            received += len(events)
+            if not events:
+                await arrived.wait()
+    finally:
+        subscription.close()
+
+
+def publish(feed: KitchenFeed, orders: int, rate: float, published_at: dict):
+    for index in range(orders):
+        order_id = f"order-{index}"
+        published_at[order_id] = time.perf_counter()
+        feed.publish([{"id": order_id, "status": "completed", "session_id": f"lane-{index % 4}", "items": ITEMS}])
+        time.sleep(1 / rate)
+
+
+async def run(displays: int, orders: int, rate: float) -> list:
+    # Every display keeps up at these rates, so the buffer never overflows
+    feed = KitchenFeed(replay_events=orders, buffer_size=orders)
+    published_at = {}
+    latencies = []
+    tasks = [asyncio.ensure_future(display(feed, orders, published_at, latencies)) for _ in range(displays)]
+    await asyncio.sleep(0.1)
+    publisher = threading.Thread(target=publish, args=(feed, orders, rate, published_at))
+    publisher.start()
+    await asyncio.gather(*tasks)
+    publisher.join()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--displays", default="1,10,100,1000", help="subscribed display counts to measure at")
+    parser.add_argument("--orders", type=int, default=200, help="orders published per run")
+    parser.add_argument("--rate", type=float, default=100.0, help="orders published per second")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="seconds between polls, for the comparison")
+    args = parser.parse_args()
+
+    print(f"{args.orders} orders at {args.rate:g}/s")
+    print(f"{'displays':>8} {'deliveries':>11} {'p50 ms':>8} {'p99 ms':>8} {'polling queries/min':>20}")
+    for displays in (int(count) for count in args.displays.split(",")):
+        latencies = asyncio.run(run(displays, args.orders, args.rate))
+        assert len(latencies) == displays * args.orders, len(latencies)
+        cuts = statistics.quantiles(latencies, n=100)
+        print(f"{displays:>8} {len(latencies):>11} {statistics.median(latencies) * 1000:>8.2f} "
+              f"{cuts[98] * 1000:>8.2f} {displays * 60 / args.poll_interval:>20.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark for menu name resolution (name_index.NameIndex).
+
+Builds synthetic menus of increasing size, resolves exact names, entity
+synonyms, plurals, typos and misses against them, and reports per-lookup
+latency. Exits non-zero if any p99 exceeds the budget.
+
+    python benchmarks/bench_name_index.py [--sizes 1000 5000 10000] [--budget-us 1000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from name_index import NameIndex, load_entity_synonyms  # noqa: E402
+
+PREFIXES = ["Mc", "Big", "Double", "Triple", "Spicy", "Crispy", "Deluxe", "Classic", "Grilled", "Mini"]
+BASES = ["Chicken", "Burger", "Mac", "Fish", "Nuggets", "Wrap", "Fries", "Shake", "Muffin", "Pie",
+         "Salad", "Coffee", "Latte", "Frappe", "Cola", "Sprite", "Tea", "Sundae", "Flurry", "Bagel"]
+SUFFIXES = ["", "with Cheese", "Supreme", "Meal", "Bites", "Special", "Combo", "Snack Wrap", "Platter", "Box"]
+
+
+def synthetic_menu(size: int, rng: random.Random):
+    names = set(["Big Mac", "McChicken", "McNuggets", "Fries", "Cheeseburger", "McCrispy",
+                 "Happy Meal", "Quarter pounder with cheese", "Coca Cola", "Sprite"])
+    while len(names) < size:
+        name = f"{rng.choice(PREFIXES)} {rng.choice(BASES)} {rng.choice(SUFFIXES)}".strip()
+        names.add(f"{name} {rng.randint(1, size)}" if name in names else name)
+    return [{"id": str(i), "name": name} for i, name in enumerate(sorted(names))]
+
+
+def typo(word: str, rng: random.Random) -> str:
+    i = rng.randrange(len(word))
+    op = rng.choice(("drop", "swap", "replace"))
+    if op == "drop":
+        return word[:i] + word[i + 1:]
+    if op == "swap" and i < len(word) - 1:
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz") + word[i + 1:]
+
+
+def queries(items, synonyms, rng: random.Random, count: int):
+    names = [item["name"] for item in items]
+    long_names = [name for name in names if len(name) > 8]
+    return {
+        "exact": [rng.choice(names) for _ in range(count)],
+        "synonym": [rng.choice(list(synonyms)) for _ in range(count)],
+        "plural": [rng.choice(names) + "s" for _ in range(count)],
+        "typo": [typo(rng.choice(long_names), rng) for _ in range(count)],
+        "miss": [f"zz unknown item {i}" for i in range(count)],
+    }
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 10000])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--budget-us", type=float, default=1000.0)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    synonyms = load_entity_synonyms()
+    over_budget = False
+
+    print(f"{'items':>6} {'kind':>8} {'hit %':>6} {'mean us':>8} {'p50 us':>8} {'p99 us':>8} {'max us':>8}")
+    for size in args.sizes:
+        items = synthetic_menu(size, rng)
+        started = time.perf_counter()
+        index = NameIndex(items, synonyms)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        for kind, names in queries(items, synonyms, rng, args.queries).items():
+            samples = []
+            hits = 0
+            for name in names:
+                t0 = time.perf_counter_ns()
+                item = index.resolve(name)
+                samples.append((time.perf_counter_ns() - t0) / 1000)
+                hits += item is not None
+            p99 = percentile(samples, 99)
+            over_budget |= p99 > args.budget_us
+            print(f"{size:>6} {kind:>8} {100 * hits / len(names):>6.1f} {statistics.mean(samples):>8.1f} "
+                  f"{percentile(samples, 50):>8.1f} {p99:>8.1f} {max(samples):>8.1f}")
+        print(f"{size:>6} {'build':>8} {'':>6} {build_ms * 1000:>8.0f} us total")
+
+    if over_budget:
+        print(f"FAIL: p99 above {args.budget_us:.0f} us budget")
+        sys.exit(1)
+    print(f"OK: every p99 within {args.budget_us:.0f} us budget")
+
+
+if __name__ == "__main__":
+    main()
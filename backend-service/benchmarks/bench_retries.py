@@ -0,0 +1,86 @@
+"""
+Benchmark for retried webhook requests against a slow Firestore.
+
+Serves N conversations (order an item, complete the order) against an
+in-memory Firestore with simulated latency, and sends every turn three
+times with the same responseId: the original, a retry that starts while
+the original is still running (as when Dialogflow times out on a slow
+Firestore write), and a retry after it has finished. Reports orders and cart lines written per conversation (1 each when
+retries are deduplicated) and the latency of original turns vs. retries
+that arrive after the original has finished.
+
+    python benchmarks/bench_retries.py [--conversations 50] [--latency-ms 50]
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from fake_firestore import FakeFirestore
+from harness import load_service
+
+MENU = {"1001": {"name": "Big Mac", "category": "food", "available": True, "base_price": 5.99}}
+ORDER_LIMITS = {"order_limits": {"food": {"default_max_quantity": 10}, "drink": {"default_max_quantity": 10}}}
+
+
+def turn(session_id: str, intent: str, parameters: dict) -> dict:
+    session = f"projects/bench/agent/sessions/{session_id}"
+    return {
+        "responseId": f"{session_id}-{intent}",
+        "session": session,
+        "queryResult": {
+            "queryText": intent,
+            "parameters": parameters,
+            "intent": {"displayName": intent},
+            "outputContexts": [{"name": f"{session}/contexts/ongoing-order", "parameters": parameters}],
+        },
+    }
+
+
+def timed(service, body: dict) -> float:
+    started = time.perf_counter()
+    service.dialogflow_webhook(body)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--conversations", type=int, default=50, help="conversations served")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="simulated latency per Firestore call")
+    args = parser.parse_args()
+
+    fake = FakeFirestore(latency_seconds=args.latency_ms / 1000)
+    fake.seed("menu_items", MENU)
+    fake.seed("configs", {"order_limits": ORDER_LIMITS})
+    service = load_service(fake, ORDER_WRITE_BEHIND="false")
+    service.menu_catalog.ensure_loaded()
+    service.order_limits_config.ensure_loaded()
+
+    originals = []
+    late_retries = []
+    for index in range(args.conversations):
+        for body in (turn(f"lane-{index}", "order.food", {"food-item": ["Big Mac"], "number": 1}),
+                     turn(f"lane-{index}", "order.complete", {})):
+            # The retry arrives while the original turn is in flight...
+            retry = threading.Thread(target=service.dialogflow_webhook, args=(body,))
+            original = threading.Thread(target=lambda: originals.append(timed(service, body)))
+            original.start()
+            time.sleep(0.001)
+            retry.start()
+            original.join()
+            retry.join()
+            # ...and once more after it has finished
+            late_retries.append(timed(service, body))
+
+    orders = list(fake.store.get("orders", {}).values())
+    lines = sum(len(order["items"]) for order in orders)
+    print(f"{args.conversations} conversations, every turn sent 3 times, "
+          f"{args.latency_ms:g} ms per Firestore call")
+    print(f"  orders written: {len(orders)} ({len(orders) / args.conversations:.2f} per conversation), "
+          f"cart lines: {lines} ({lines / args.conversations:.2f} per conversation)")
+    print(f"  original turn p50: {statistics.median(originals) * 1000:8.2f} ms")
+    print(f"  late retry p50:    {statistics.median(late_retries) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark for answering sales questions from the rollups vs. scanning orders.
+
+Writes N completed orders spread over one day to the in-memory data
+backend, in write-behind sized batches that update the rollups as the
+service does, then times "sales today" and "sales per hour" answered from
+the rollups and by reading and aggregating every order, for growing N.
+
+    python benchmarks/bench_sales.py [--orders 1000,10000,50000] [--batch 100]
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from harness import load_service
+
+ITEMS = [("1001", "Big Mac", 5.99), ("1002", "Fries", 2.49), ("2001", "Coca Cola", 1.99)]
+
+
+def make_order(index: int, day_start: datetime) -> dict:
+    lines = []
+    for item_id, name, price in random.sample(ITEMS, random.randint(1, len(ITEMS))):
+        quantity = random.randint(1, 3)
+        lines.append({"item_id": item_id, "name": name, "quantity": quantity, "base_price": price,
+                      "customizations": [], "item_total": round(price * quantity, 2)})
+    completed_at = day_start + timedelta(seconds=random.randrange(24 * 3600))
+    return {
+        "id": f"order-{index}",
+        "session_id": f"session-{index}",
+        "status": "completed",
+        "created_at": completed_at,
+        "completed_at": completed_at,
+        "items": lines,
+        "total_amount": round(sum(line["item_total"] for line in lines), 2),
+    }
+
+
+def timed_ms(function, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", default="1000,10000,50000", help="order counts to measure at")
+    parser.add_argument("--batch", type=int, default=100, help="orders per write-behind batch")
+    args = parser.parse_args()
+
+    service = load_service(DATA_BACKEND="memory")
+    from sales_rollups import rollup_deltas
+
+    random.seed(7)
+    day_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    day = day_start.date()
+    rollups = service.sales_rollups
+
+    def scan():
+        return rollup_deltas(service.order_repository.list_orders())
+
+    written = 0
+    print(f"{'orders':>7} {'today, rollup':>14} {'per hour, rollup':>17} {'scan orders':>12}")
+    for target in (int(count) for count in args.orders.split(",")):
+        while written < target:
+            batch = [make_order(index, day_start) for index in range(written, min(target, written + args.batch))]
+            service.order_repository.save_orders(batch)
+            rollups.record_orders(batch)
+            written += len(batch)
+
+        today = rollups.query(day)
+        assert today["orders"] == target, today["orders"]
+        print(f"{target:>7} {timed_ms(lambda: rollups.query(day)):>11.2f} ms "
+              f"{timed_ms(lambda: rollups.query(day, by_hour=True)):>14.2f} ms "
+              f"{timed_ms(scan, repeat=1):>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark for live session memory (cart.Session vs. plain dicts).
+
+Holds N sessions with typical carts in memory twice: as the slotted
+Session/CartLine objects the session store keeps, and as the nested dicts
+sessions used to be. Reports bytes per session measured with tracemalloc,
+plus the cost of serializing one session to the response payload.
+
+    python benchmarks/bench_session_memory.py [--sessions 100000] [--lines 3]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cart import CartLine, Session  # noqa: E402
+
+# A burger with a customization, sized fries and a drink, repeated as needed
+LINE_TEMPLATES = [
+    lambda n: CartLine("1001", "Big Mac", 1 + n % 3, 599, customizations=["no onions"]),
+    lambda n: CartLine("1002", "Fries", 1, 249, sized=True, size="large", size_price_cents=100),
+    lambda n: CartLine("2001", "Coca Cola", 2, 199, sized=True, size="medium", size_price_cents=50),
+]
+
+
+def slotted_session(n: int, lines: int) -> Session:
+    session = Session()
+    for i in range(lines):
+        session.add(LINE_TEMPLATES[i % len(LINE_TEMPLATES)](n))
+    return session
+
+
+def dict_session(n: int, lines: int) -> dict:
+    session = slotted_session(n, lines)
+    return session.to_dict()
+
+
+def measure(build, count: int, lines: int):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = {f"session-{n}": build(n, lines) for n in range(count)}
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--lines", type=int, default=3)
+    args = parser.parse_args()
+
+    dict_bytes, _ = measure(dict_session, args.sessions, args.lines)
+    slotted_bytes, sessions = measure(slotted_session, args.sessions, args.lines)
+
+    sample = next(iter(sessions.values()))
+    rounds = 20000
+    started = time.perf_counter()
+    for _ in range(rounds):
+        sample.to_dict()
+    serialize_us = (time.perf_counter() - started) / rounds * 1e6
+
+    print(f"{args.sessions} sessions, {args.lines} lines each")
+    print(f"{'dict':>8} {dict_bytes:>8.0f} bytes/session  {dict_bytes * args.sessions / 2 ** 20:>8.1f} MiB")
+    print(f"{'slotted':>8} {slotted_bytes:>8.0f} bytes/session  {slotted_bytes * args.sessions / 2 ** 20:>8.1f} MiB")
+    print(f"saved {100 * (1 - slotted_bytes / dict_bytes):.0f}%; payload serialization {serialize_us:.1f} us/session")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark for per-store menu and config caches.
+
+Seeds the in-memory data backend with --stores stores of --items menu items
+each under stores/<store_id>/, then serves menu lookups the way
+main.dialogflow_webhook does (StoreDirectory.get(), a lookup, then
+account()) with store popularity skewed towards a few busy stores, under
+a memory budget and a cap on the number of stores that hold only some of
+them. Reports the lookup latency when the store's caches are warm and when
+they have to be loaded, how many stores were dropped, and the measured
+cache memory against the budget.
+
+    python benchmarks/bench_stores.py [--stores 200] [--items 150] [--budget-mb 16] [--max-stores 200]
+                                      [--requests 10000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from menu_catalog import MenuCatalog  # noqa: E402
+from order_limits import OrderLimitsConfig  # noqa: E402
+from repositories import ConfigRepository, InMemoryBackend, MenuRepository  # noqa: E402
+from stores import STORE_MAX_CACHED, StoreCaches, StoreDirectory, store_collection  # noqa: E402
+from upsell import UpsellConfig  # noqa: E402
+
+ORDER_LIMITS = {"order_limits": {"food": {"default_max_quantity": 10}, "drink": {"default_max_quantity": 10}}}
+
+
+def menu(items: int) -> dict:
+    return {
+        str(index): {"id": str(index), "name": f"Item {index}", "category": "food" if index % 3 else "drink",
+                     "base_price": 1.99 + index % 7, "available": True, "has_size": index % 3 == 0,
+                     "sizes": {"small": 0.0, "medium": 0.5, "large": 1.0},
+                     "customizations": {"removable": ["onions", "pickles"], "addable": ["cheese"],
+                                        "modifiable": []}}
+        for index in range(items)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--stores", type=int, default=200, help="stores seeded")
+    parser.add_argument("--items", type=int, default=150, help="menu items per store")
+    parser.add_argument("--budget-mb", type=float, default=16.0, help="memory budget of all stores' caches")
+    parser.add_argument("--max-stores", type=int, default=STORE_MAX_CACHED, help="stores held at most")
+    parser.add_argument("--requests", type=int, default=10000, help="requests served")
+    args = parser.parse_args()
+
+    backend = InMemoryBackend()
+    store_ids = [f"store{index}" for index in range(args.stores)]
+    for store_id in store_ids:
+        backend.put_many(store_collection(store_id, MenuRepository.collection), menu(args.items))
+        backend.put_many(store_collection(store_id, ConfigRepository.collection), {"order_limits": ORDER_LIMITS})
+
+    def create(store_id):
+        configs = ConfigRepository(backend, store_collection(store_id, ConfigRepository.collection))
+        return StoreCaches(store_id, MenuCatalog(MenuRepository(backend, store_collection(store_id, "menu_items")),
+                                                 use_listener=False),
+                           OrderLimitsConfig(configs, use_listener=False), UpsellConfig(configs, use_listener=False))
+
+    default = create(None)
+    directory = StoreDirectory(create, default, int(args.budget_mb * 1024 * 1024), args.max_stores)
+
+    random.seed(7)
+    weights = [1 / (rank + 1) for rank in range(args.stores)]
+    names = [f"Item {index}" for index in range(args.items)]
+    warm, cold = [], []
+    peak = 0
+    for store_id in random.choices(store_ids, weights, k=args.requests):
+        started = time.perf_counter()
+        loaded = directory.peek(store_id) is not None
+        store = directory.get(store_id)
+        store.menu_catalog.get_by_name(random.choice(names))
+        store.order_limits_config.current()
+        store.upsell_config.current()
+        directory.account(store)
+        (warm if loaded else cold).append(time.perf_counter() - started)
+        peak = max(peak, directory.size_bytes())
+
+    print(f"{args.stores} stores of {args.items} items, {args.requests} requests, budget {args.budget_mb:g} MB, "
+          f"at most {args.max_stores} stores")
+    print(f"{'lookups':>8} {'count':>7} {'p50 us':>9} {'p99 us':>9}")
+    for label, latencies in (("warm", warm), ("cold", cold)):
+        if len(latencies) > 1:
+            cuts = statistics.quantiles(latencies, n=100)
+            print(f"{label:>8} {len(latencies):>7} {statistics.median(latencies) * 1e6:>9.1f} {cuts[98] * 1e6:>9.1f}")
+    print(f"stores held {len(directory)}, dropped {directory.evictions}, "
+          f"cache memory {directory.size_bytes() / 1024 / 1024:.2f} MB (peak {peak / 1024 / 1024:.2f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark for upsell suggestions.
+
+Builds the item co-occurrence table from N synthetic orders over a menu of
+--items items, in pages as `python upsell.py build` reads them (with NumPy
+when installed, else the pure Python counter), then times
+UpsellTable.suggest() for carts of growing size, the lookup create_response
+makes on order.food and order.drink turns.
+
+    python benchmarks/bench_upsell.py [--orders 20000] [--items 150] [--cart-sizes 1,3,8]
+"""
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from upsell import UpsellTable, build_upsell_config  # noqa: E402
+
+
+def make_pages(orders: int, items: int, page_size: int = 500):
+    """Orders whose lines favour a few "partner" items per item, so the table has structure to find."""
+    item_ids = [f"item-{index}" for index in range(items)]
+    partners = {item_id: random.sample(item_ids, 3) for item_id in item_ids}
+    weights = [1 / (rank + 1) for rank in range(items)]
+    for start in range(0, orders, page_size):
+        page = []
+        for index in range(start, min(orders, start + page_size)):
+            basket = set(random.choices(item_ids, weights, k=random.randint(1, 3)))
+            for item_id in list(basket):
+                if random.random() < 0.5:
+                    basket.add(random.choice(partners[item_id]))
+            page.append({"id": f"order-{index}", "status": "completed",
+                         "items": [{"item_id": item_id, "quantity": 1} for item_id in basket]})
+        yield page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=20000, help="orders the table is built from")
+    parser.add_argument("--items", type=int, default=150, help="menu items")
+    parser.add_argument("--cart-sizes", default="1,3,8", help="cart lines to suggest for")
+    parser.add_argument("--iterations", type=int, default=20000, help="suggestions timed per cart size")
+    args = parser.parse_args()
+
+    counter = "numpy" if importlib.util.find_spec("numpy") else "python (NumPy not installed)"
+
+    random.seed(7)
+    started = time.perf_counter()
+    config = build_upsell_config(make_pages(args.orders, args.items), top_k=5, min_support=5)
+    print(f"built table for {len(config['suggestions'])} items from {config['orders']} orders "
+          f"in {time.perf_counter() - started:.2f}s with the {counter} counter")
+
+    table = UpsellTable(config)
+    item_ids = list(table.suggestions)
+    print(f"{'cart':>5} {'suggest us':>11}")
+    for cart_size in (int(size) for size in args.cart_sizes.split(",")):
+        carts = [random.sample(item_ids, cart_size) for _ in range(100)]
+        started = time.perf_counter()
+        for index in range(args.iterations):
+            table.suggest(carts[index % len(carts)])
+        print(f"{cart_size:>5} {(time.perf_counter() - started) / args.iterations * 1e6:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+In-memory stand-in for the parts of google.cloud.firestore.Client the
+service uses, for running the webhook offline.
+
+Every operation that would be a round trip to Firestore sleeps for the
+configured latency and is counted by kind in FakeFirestore.calls, so
+benchmarks can report Firestore traffic per request.
+"""
+import copy
+import threading
+import time
+from collections import Counter
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field: str):
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentReference:
+    def __init__(self, client, collection: str, doc_id: str):
+        self._client = client
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection}/{self.id}"
+
+    def get(self):
+        self._client._round_trip("get")
+        with self._client._lock:
+            data = self._client.store.get(self._collection, {}).get(self.id)
+        return FakeDocumentSnapshot(self, copy.deepcopy(data))
+
+    def set(self, data: dict, merge: bool = False):
+        self._client._round_trip("set")
+        self._client._write(self._collection, self.id, data, merge)
+
+    def update(self, data: dict):
+        self._client._round_trip("update")
+        self._client._write(self._collection, self.id, data, True)
+
+    def delete(self):
+        self._client._round_trip("delete")
+        with self._client._lock:
+            self._client.store.get(self._collection, {}).pop(self.id, None)
+
+    def on_snapshot(self, callback):
+        raise NotImplementedError("FakeFirestore does not support listeners")
+
+
+class FakeQuery:
+    def __init__(self, client, collection: str, filters=(), order=(), limit=None):
+        self._client = client
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._order = tuple(order)
+        self._limit = limit
+
+    def _derive(self, **changes):
+        state = dict(filters=self._filters, order=self._order, limit=self._limit)
+        state.update(changes)
+        return FakeQuery(self._client, self._collection, **state)
+
+    def where(self, field: str, op: str, value):
+        return self._derive(filters=self._filters + ((field, _OPERATORS[op], value),))
+
+    def order_by(self, field: str, direction: str = "ASCENDING"):
+        return self._derive(order=self._order + ((field, direction == "DESCENDING"),))
+
+    def limit(self, count: int):
+        return self._derive(limit=count)
+
+    def document(self, doc_id: str):
+        return FakeDocumentReference(self._client, self._collection, doc_id)
+
+    def get(self):
+        return list(self.stream())
+
+    def stream(self):
+        self._client._round_trip("query")
+        with self._client._lock:
+            rows = list(self._client.store.get(self._collection, {}).items())
+        rows = [(doc_id, data) for doc_id, data in rows
+                if all(op(data.get(field), value) for field, op, value in self._filters)]
+        for field, descending in reversed(self._order):
+            rows.sort(key=lambda row: (row[1].get(field) is None, row[1].get(field)), reverse=descending)
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for doc_id, data in rows:
+            yield FakeDocumentSnapshot(self.document(doc_id), copy.deepcopy(data))
+
+    def on_snapshot(self, callback):
+        raise NotImplementedError("FakeFirestore does not support listeners")
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, collection: str):
+        super().__init__(client, collection)
+        self.id = collection
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference: FakeDocumentReference, data: dict, merge: bool = False):
+        self._writes.append((reference, data, merge))
+
+    def update(self, reference: FakeDocumentReference, data: dict):
+        self._writes.append((reference, data, True))
+
+    def commit(self):
+        self._client._round_trip("batch_commit")
+        for reference, data, merge in self._writes:
+            self._client._write(reference._collection, reference.id, data, merge)
+        self._client.calls["batch_writes"] += len(self._writes)
+        self._writes = []
+
+
+class FakeFirestore:
+    """
+    Drop-in for firestore.Client backed by nested dicts:
+    store[collection][document_id] -> data.
+    """
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.store = {}
+        self.latency_seconds = latency_seconds
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def get_all(self, references):
+        """Reads several documents in one round trip."""
+        self._round_trip("get_all")
+        with self._lock:
+            found = [(reference, self.store.get(reference._collection, {}).get(reference.id))
+                     for reference in references]
+        return [FakeDocumentSnapshot(reference, copy.deepcopy(data)) for reference, data in found]
+
+    def seed(self, collection: str, documents: dict):
+        """Loads documents without counting calls or simulating latency."""
+        with self._lock:
+            self.store.setdefault(collection, {}).update(copy.deepcopy(documents))
+
+    def _round_trip(self, kind: str):
+        self.calls[kind] += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def _write(self, collection: str, doc_id: str, data: dict, merge: bool):
+        data = copy.deepcopy(data)
+        with self._lock:
+            documents = self.store.setdefault(collection, {})
+            if merge and doc_id in documents:
+                documents[doc_id].update(data)
+            else:
+                documents[doc_id] = data
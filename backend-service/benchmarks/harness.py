@@ -0,0 +1,34 @@
+"""
+Shared setup for the benchmarks that serve requests through main.py in
+process, without Firebase credentials.
+
+load_service() configures the service for an offline run before importing
+it: warnings-only logs, no warm snapshot file, and the benchmark's own
+settings. Given a FakeFirestore (fake_firestore.py), it also turns off the
+cache listeners and the sales rollups, which need listeners and transactions
+the fake does not support, and installs the fake as the Firestore client.
+"""
+import os
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+
+# The caches kept live by snapshot listeners
+LISTENER_SETTINGS = ("MENU_CACHE_USE_LISTENER", "ORDER_LIMITS_USE_LISTENER", "UPSELL_USE_LISTENER")
+
+
+def load_service(firestore=None, **settings):
+    """Imports main.py configured by settings (environment variable: value); returns the module."""
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["WARM_SNAPSHOT_PATH"] = ""
+    if firestore is not None:
+        for name in LISTENER_SETTINGS:
+            os.environ[name] = "false"
+        # Rollups are applied in Firestore transactions
+        os.environ["SALES_ROLLUPS_ENABLED"] = "false"
+    os.environ.update({name: str(value) for name, value in settings.items()})
+    import main
+    if firestore is not None:
+        main.set_db(firestore)
+    return main
@@ -0,0 +1,189 @@
+# Compact cart model for conversation sessions. Lines and sessions are slotted
+# objects rather than dicts, so a live session costs a fraction of the memory,
+# and the Dialogflow payload and orders documents are produced by one
+# serializer each instead of being hand-built in every handler. Prices and
+# totals are integer cents, so totals stay exact however often lines change.
+
+from money import to_amount, to_cents
+
+
+class CartLine:
+    """
+    One line of a customer's cart.
+
+    sized marks lines that carry size fields: every drink, and food items the
+    menu sells in sizes. Lines are serialized with size and size_price only
+    when sized, matching the orders schema. customizations is a tuple, so the
+    many lines without any share the empty tuple instead of each holding a list.
+    Sessions never change a line once it is in a cart, so copies of a
+    session can share their lines.
+    """
+
+    __slots__ = ("item_id", "name", "quantity", "base_price_cents",
+                 "customizations", "sized", "size", "size_price_cents")
+
+    def __init__(self, item_id: str, name: str, quantity: int, base_price_cents: int,
+                 customizations=(), sized: bool = False, size: str = None,
+                 size_price_cents: int = 0):
+        self.item_id = item_id
+        self.name = name
+        self.quantity = quantity
+        self.base_price_cents = base_price_cents
+        self.customizations = tuple(customizations) if customizations else ()
+        self.sized = sized
+        self.size = size
+        self.size_price_cents = size_price_cents
+
+    @classmethod
+    def for_menu_item(cls, menu_item, quantity: int, size: str = None, customizations=(), sized: bool = None):
+        """Prices a line for a compiled MenuItem; sized defaults to whether the item has sizes."""
+        return cls(
+            menu_item.id,
+            menu_item.name,
+            quantity,
+            menu_item.base_price_cents,
+            customizations=customizations,
+            sized=menu_item.has_size if sized is None else sized,
+            size=size,
+            size_price_cents=menu_item.size_price_cents(size),
+        )
+
+    def with_quantity(self, quantity: int):
+        """A copy of the line with another quantity."""
+        return CartLine(self.item_id, self.name, quantity, self.base_price_cents, self.customizations,
+                        self.sized, self.size, self.size_price_cents)
+
+    def with_customizations(self, customizations):
+        """A copy of the line with other customizations."""
+        return CartLine(self.item_id, self.name, self.quantity, self.base_price_cents, customizations,
+                        self.sized, self.size, self.size_price_cents)
+
+    @property
+    def item_total_cents(self) -> int:
+        return (self.base_price_cents + self.size_price_cents) * self.quantity
+
+    def to_dict(self) -> dict:
+        """Serializes the line for the response payload and the orders collection."""
+        data = {
+            "item_id": self.item_id,
+            "name": self.name,
+            "quantity": self.quantity,
+            "base_price": to_amount(self.base_price_cents),
+            "customizations": list(self.customizations),
+        }
+        if self.sized:
+            data["size"] = self.size
+            data["size_price"] = to_amount(self.size_price_cents)
+        data["item_total"] = to_amount(self.item_total_cents)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            data["item_id"],
+            data["name"],
+            data["quantity"],
+            to_cents(data["base_price"]),
+            customizations=data.get("customizations"),
+            sized="size" in data,
+            size=data.get("size"),
+            size_price_cents=to_cents(data.get("size_price") or 0),
+        )
+
+
+class Session:
+    """
+    A conversation's cart.
+
+    Every change goes through the methods below, which keep total_cents and
+    item_count current, so reading either never walks the cart, and drop the
+    serialized cart, so to_dict() only serializes the lines after a change.
+
+    last_response is (response_id, response) of the turn that last wrote the
+    session, which shared session stores keep next to it for a while so a
+    retried request is answered on any instance. It is not part of to_dict().
+    """
+
+    __slots__ = ("items", "total_cents", "item_count", "last_response", "_serialized")
+
+    def __init__(self, items: list = None):
+        self.items = items if items is not None else []
+        self.total_cents = sum(line.item_total_cents for line in self.items)
+        self.item_count = sum(line.quantity for line in self.items)
+        self.last_response = None
+        self._serialized = None
+
+    @property
+    def total_amount(self) -> float:
+        return to_amount(self.total_cents)
+
+    def add(self, line: CartLine):
+        """Appends an order line to the cart."""
+        self.items.append(line)
+        self.total_cents += line.item_total_cents
+        self.item_count += line.quantity
+        self._serialized = None
+
+    def replace(self, index: int, line: CartLine):
+        """Replaces the order line at index, e.g. after a size change."""
+        old = self.items[index]
+        self.items[index] = line
+        self.total_cents += line.item_total_cents - old.item_total_cents
+        self.item_count += line.quantity - old.quantity
+        self._serialized = None
+
+    def set_quantity(self, index: int, quantity: int):
+        """Changes the quantity (and so the total) of the order line at index."""
+        self.replace(index, self.items[index].with_quantity(quantity))
+
+    def remove(self, index: int):
+        """Removes the order line at index."""
+        line = self.items.pop(index)
+        self.total_cents -= line.item_total_cents
+        self.item_count -= line.quantity
+        self._serialized = None
+
+    def copy(self):
+        """A copy that can be changed without affecting this session; the lines are shared."""
+        session = Session.__new__(Session)
+        session.items = list(self.items)
+        session.total_cents = self.total_cents
+        session.item_count = self.item_count
+        session.last_response = self.last_response
+        session._serialized = self._serialized
+        return session
+
+    def replay(self, response_id: str):
+        """The response already given to the request with this ID, if it was the last turn; else None."""
+        if response_id is None or self.last_response is None or self.last_response[0] != response_id:
+            return None
+        return self.last_response[1]
+
+    def clear(self):
+        """Empties the cart."""
+        self.items = []
+        self.total_cents = 0
+        self.item_count = 0
+        self._serialized = None
+
+    def order_items(self) -> list:
+        """The cart lines in the shape of the orders collection's items."""
+        return [line.to_dict() for line in self.items]
+
+    def to_dict(self) -> dict:
+        """
+        Serializes the session: this is both the order_summary block of the
+        response payload and what out-of-process session stores save. The
+        result is kept until the cart changes, so callers must not modify it.
+        """
+        if self._serialized is None:
+            self._serialized = {
+                "items": self.order_items(), "total_amount": self.total_amount, "item_count": self.item_count
+            }
+        return self._serialized
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        # Totals are recomputed from the lines, so they are exact even for
+        # sessions stored with float totals by older code
+        return cls([CartLine.from_dict(item) for item in data["items"]])
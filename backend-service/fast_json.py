@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# JSON codec for webhook bodies: "auto" picks orjson, then msgspec, then the
+# standard library, whichever is installed first; naming one forces it
+JSON_CODEC = os.environ.get("JSON_CODEC", "auto").lower()
+
+CONTENT_TYPE = "application/json"
+
+
+def _stdlib_codec():
+    def loads(body):
+        return json.loads(body)
+
+    def dumps(value) -> bytes:
+        return json.dumps(value, default=str, separators=(",", ":")).encode()
+
+    return loads, dumps
+
+
+def _orjson_codec():
+    import orjson
+
+    def loads(body):
+        # orjson.JSONDecodeError is a ValueError
+        return orjson.loads(body)
+
+    def dumps(value) -> bytes:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+    return loads, dumps
+
+
+def _msgspec_codec():
+    import msgspec
+
+    decoder = msgspec.json.Decoder()
+    encoder = msgspec.json.Encoder(enc_hook=str)
+
+    def loads(body):
+        if isinstance(body, str):
+            body = body.encode()
+        try:
+            return decoder.decode(body)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def dumps(value) -> bytes:
+        return encoder.encode(value)
+
+    return loads, dumps
+
+
+_CODECS = {"orjson": _orjson_codec, "msgspec": _msgspec_codec, "stdlib": _stdlib_codec}
+
+
+def create_codec(name: str):
+    """Returns (codec name, loads, dumps) for a JSON_CODEC setting."""
+    if name == "auto":
+        for candidate in ("orjson", "msgspec"):
+            try:
+                return (candidate,) + _CODECS[candidate]()
+            except ImportError:
+                continue
+        return ("stdlib",) + _stdlib_codec()
+    if name not in _CODECS:
+        raise ValueError(f"Unknown JSON codec: {name}")
+    try:
+        return (name,) + _CODECS[name]()
+    except ImportError:
+        logger.warning(f"JSON codec {name} is not installed, falling back to the standard library")
+        return ("stdlib",) + _stdlib_codec()
+
+
+# loads(body) decodes bytes or str and raises ValueError on invalid JSON;
+# dumps(value) returns compact UTF-8 bytes, encoding unknown types as str()
+CODEC, loads, dumps = create_codec(JSON_CODEC)
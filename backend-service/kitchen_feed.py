@@ -0,0 +1,251 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from itertools import islice
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Where the kitchen feed learns of completed orders: "hook" publishes the
+# orders this instance completes; "listener" holds one listener on new
+# orders in the data backend, so a single feed instance serves the orders
+# completed on every webhook instance
+KITCHEN_FEED_SOURCE = os.environ.get("KITCHEN_FEED_SOURCE", "hook")
+
+# Recent events kept for displays that reconnect with a cursor
+KITCHEN_FEED_REPLAY_EVENTS = int(os.environ.get("KITCHEN_FEED_REPLAY_EVENTS", "1000"))
+
+# Events buffered for a slow subscriber; past this it catches up from the replay log
+KITCHEN_FEED_SUBSCRIBER_BUFFER = int(os.environ.get("KITCHEN_FEED_SUBSCRIBER_BUFFER", "100"))
+
+# How long a long-poll request waits for a new order before returning empty
+KITCHEN_FEED_POLL_TIMEOUT_SECONDS = float(os.environ.get("KITCHEN_FEED_POLL_TIMEOUT_SECONDS", "25"))
+
+
+def kitchen_ticket(order: dict) -> dict:
+    """What a kitchen display shows of an order: the lines to prepare, without prices."""
+    created_at = order.get("created_at")
+    if isinstance(created_at, datetime):
+        created_at = (created_at if created_at.tzinfo else created_at.replace(tzinfo=timezone.utc)).isoformat()
+    return {
+        "id": order["id"],
+        "session_id": order.get("session_id"),
+        "store_id": order.get("store_id"),
+        "created_at": created_at,
+        "items": [
+            {key: line[key] for key in ("item_id", "name", "quantity", "size", "customizations") if key in line}
+            for line in order.get("items", [])
+        ],
+    }
+
+
+class Subscription:
+    """
+    One display's view of the feed. Live events are buffered up to
+    buffer_size; if more arrive before the display takes them, the buffer
+    is dropped and the next read catches up from the feed's replay log.
+    wake() is called (from the publishing thread) whenever events arrive
+    for it. A display subscribed with a store_id is only sent, and only
+    woken for, that store's orders.
+    """
+
+    def __init__(self, feed, last_seq: int, reset: bool, buffer_size: int, wake=None, store_id=None):
+        self._feed = feed
+        self._store_id = store_id
+        self._pending = deque()
+        self._buffer_size = buffer_size
+        self._wake = wake
+        self._last_seq = last_seq
+        self._reset = reset
+        # Read from the replay log rather than the buffer, until caught up
+        self._catching_up = True
+
+    @property
+    def cursor(self) -> str:
+        return self._feed.cursor(self._last_seq)
+
+    def _push(self, event: dict) -> bool:
+        """
+        Adds a live event; returns whether the display has new events to
+        take because of it. The caller holds the feed's lock.
+        """
+        if self._catching_up or not self._wants(event):
+            # A display catching up reads this event from the log on its next take()
+            return False
+        if len(self._pending) >= self._buffer_size:
+            self._pending.clear()
+            self._catching_up = True
+            return True
+        self._pending.append(event)
+        return True
+
+    def _wants(self, event: dict) -> bool:
+        return self._store_id is None or event["order"]["store_id"] == self._store_id
+
+    def take(self) -> tuple:
+        """
+        Returns (events, reset): the events after the last ones taken, and
+        whether the display must discard what it shows and rebuild from
+        these events because some could not be replayed.
+        """
+        with self._feed._lock:
+            if self._catching_up:
+                events, gap = self._feed._events_after(self._last_seq)
+                self._catching_up = False
+                self._pending.clear()
+            else:
+                events, gap = list(self._pending), False
+                self._pending.clear()
+            reset = self._reset or gap
+            self._reset = False
+            if events:
+                # Past other stores' events too, so the cursor does not replay them
+                self._last_seq = events[-1]["seq"]
+                events = [event for event in events if self._wants(event)]
+            if reset:
+                self._feed.resets += 1
+        return events, reset
+
+    def close(self):
+        self._feed._unsubscribe(self)
+
+
+class KitchenFeed:
+    """
+    Fans completed orders out to kitchen displays, so screens are pushed
+    new orders instead of each polling Firestore.
+
+    Orders come in through publish(), called by the order completion hook
+    or by the one listener the feed holds (see KITCHEN_FEED_SOURCE), and are
+    numbered in sequence. The last replay_events are kept, so a display
+    that reconnects with the cursor of the last event it saw is sent what
+    it missed; a cursor from before the log (or from a previous process)
+    gets the whole log flagged as a reset. Cursors are "<epoch>:<seq>",
+    where the epoch is fixed for this process.
+    """
+
+    def __init__(self, replay_events: int = KITCHEN_FEED_REPLAY_EVENTS,
+                 buffer_size: int = KITCHEN_FEED_SUBSCRIBER_BUFFER, listen=None):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._log = deque(maxlen=replay_events)
+        self._seq = 0
+        self._buffer_size = buffer_size
+        self._subscribers = set()
+        # Recently published order IDs, so a redelivered order is not shown twice
+        self._published = OrderedDict()
+        self._lock = threading.Lock()
+        self._listen = listen
+        self._listen_lock = threading.Lock()
+        self._watch = None
+        self.resets = 0
+
+    @property
+    def listening(self) -> bool:
+        """Whether orders arrive through the feed's listener rather than publish() calls."""
+        return self._watch is not None
+
+    def __len__(self):
+        """The number of subscribed displays."""
+        return len(self._subscribers)
+
+    @property
+    def published(self) -> int:
+        return self._seq
+
+    def cursor(self, seq: int) -> str:
+        return f"{self.epoch}:{seq}"
+
+    def _parse_cursor(self, cursor: str) -> tuple:
+        """Returns (seq, reset) for a client's cursor; None starts from new events."""
+        if not cursor:
+            return self._seq, False
+        epoch, _, seq = cursor.partition(":")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return 0, True
+        return int(seq), False
+
+    def publish(self, orders):
+        """Adds the completed ones among orders to the feed and wakes their subscribers."""
+        wake = []
+        with self._lock:
+            for order in orders:
+                if order.get("status") != "completed" or order["id"] in self._published:
+                    continue
+                self._published[order["id"]] = True
+                if len(self._published) > max(self._log.maxlen, 1):
+                    self._published.popitem(last=False)
+                self._seq += 1
+                event = {"id": self.cursor(self._seq), "seq": self._seq, "order": kitchen_ticket(order)}
+                self._log.append(event)
+                for subscription in self._subscribers:
+                    if subscription._push(event) and subscription._wake is not None:
+                        wake.append(subscription._wake)
+        for callback in set(wake):
+            callback()
+
+    def _events_after(self, seq: int) -> tuple:
+        """Returns (events after seq, gap); gap if some were already dropped from the log. Holds _lock."""
+        if seq >= self._seq:
+            return [], False
+        first = self._log[0]["seq"] if self._log else self._seq + 1
+        if seq + 1 < first:
+            return list(self._log), True
+        return list(islice(self._log, seq + 1 - first, None)), False
+
+    def subscribe(self, cursor: str = None, wake=None, store_id=None) -> Subscription:
+        """
+        Subscribes a display, replaying what came after cursor (the id of
+        the last event it received) on its first take(). Without a cursor
+        only new orders are sent; an unknown one such as "0" replays the
+        whole log as a reset. With a store_id, only that store's orders are sent.
+        """
+        self._ensure_listening()
+        with self._lock:
+            last_seq, reset = self._parse_cursor(cursor)
+            subscription = Subscription(self, last_seq, reset, self._buffer_size, wake, store_id)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def poll(self, cursor: str = None, timeout: float = KITCHEN_FEED_POLL_TIMEOUT_SECONDS, store_id=None) -> dict:
+        """
+        Long-poll: returns the events after cursor, waiting up to timeout
+        seconds for one if there are none yet. Blocks the calling thread.
+        """
+        arrived = threading.Event()
+        subscription = self.subscribe(cursor, wake=arrived.set, store_id=store_id)
+        try:
+            events, reset = subscription.take()
+            if not events and not reset and arrived.wait(timeout):
+                events, reset = subscription.take()
+            return {"cursor": subscription.cursor, "reset": reset, "events": events}
+        finally:
+            subscription.close()
+
+    def _ensure_listening(self):
+        """Starts the single listener on first subscription, when the feed has one."""
+        if self._listen is None or self._watch is not None:
+            return
+        with self._listen_lock:
+            if self._listen is None or self._watch is not None:
+                return
+            try:
+                self._watch = self._listen(self.publish)
+            except Exception as e:
+                logger.warning(f"Kitchen feed listener unavailable, serving this instance's orders only: {str(e)}")
+                self._listen = None
+                return
+            logger.info("Kitchen feed attached to the orders listener")
+
+
+def parse_poll(params) -> dict:
+    """Arguments for KitchenFeed.poll() from request parameters; raises ValueError if invalid."""
+    timeout = KITCHEN_FEED_POLL_TIMEOUT_SECONDS
+    if params.get("timeout"):
+        timeout = min(max(float(params["timeout"]), 0.0), timeout)
+    return {"cursor": params.get("after") or None, "timeout": timeout, "store_id": params.get("store") or None}
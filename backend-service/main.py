@@ -1,190 +1,314 @@
 import functions_framework
-from pydantic import BaseModel
-from typing import List, Optional
 import logging
-import firebase_admin
-from firebase_admin import credentials, firestore
 import json
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timezone
 import os
-from functools import wraps
+import contextvars
+from functools import partial, wraps
 from concurrent.futures import ThreadPoolExecutor
 import asyncio
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(levelname)s: %(message)s'
-)
+from menu_catalog import MenuCatalog, MenuItem
+from order_limits import OrderLimitsConfig
+from session_store import create_session_store
+from response_cache import ResponseCache
+from order_queue import OrderWriter
+from repositories import ConfigRepository, MenuRepository, OrderRepository, SalesRollupRepository, create_backend
+from sales_rollups import SALES_ROLLUPS_ENABLED, SalesRollups, parse_query
+from kitchen_feed import KITCHEN_FEED_SOURCE, KitchenFeed, parse_poll
+from upsell import UPSELL_ENABLED, UpsellConfig
+from stores import (StoreCaches, StoreDirectory, UnknownStore, current_store, session_key, split_session_key,
+                    store_collection, store_id_for, use_store)
+from cart import CartLine, Session
+from warm_snapshot import load_warm_snapshot
+from webhook_request import WebhookRequest, decode_webhook_request, parse_webhook_request
+import fast_json
+import metrics
+import tracing
+from structured_logging import Payload, bind, configure_logging, request_context, should_log_bodies
+
+# Configure logging (structured JSON lines unless LOG_FORMAT=text)
+configure_logging()
 logger = logging.getLogger("VOS-FULFILMENT")
 
-# Initialize Firebase Admin SDK
-try:
-    # Check if already initialized
-    app = firebase_admin.get_app()
-    logger.info("Firebase app already initialized")
-except ValueError:
-    # Initialize with credentials
+# Firestore project and database the service reads and writes
+FIRESTORE_PROJECT = os.environ.get("FIRESTORE_PROJECT", "burner-abhdey0")
+FIRESTORE_DATABASE = os.environ.get("FIRESTORE_DATABASE", "mcd-vos")
+
+# Firestore client, created on first use so that importing this module (and
+# serving requests from warm caches) does not wait on Firebase initialization
+_db = None
+_db_lock = threading.Lock()
+
+def _init_firestore():
+    """Initializes the Firebase Admin SDK and returns a client for FIRESTORE_DATABASE."""
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
     try:
-        cred = credentials.Certificate('firebase-key.json')
-        firebase_admin.initialize_app(cred, {
-            'projectId': 'burner-abhdey0',
-        })
-        logger.info("Firebase app initialized successfully")
-    except Exception as e:
-        logger.error(f"Error initializing Firebase: {str(e)}")
-        raise
+        # Check if already initialized
+        firebase_admin.get_app()
+        logger.info("Firebase app already initialized")
+    except ValueError:
+        # Initialize with credentials
+        try:
+            cred = credentials.Certificate('firebase-key.json')
+            firebase_admin.initialize_app(cred, {
+                'projectId': FIRESTORE_PROJECT,
+            })
+            logger.info("Firebase app initialized successfully")
+        except Exception as e:
+            logger.error(f"Error initializing Firebase: {str(e)}")
+            raise
+
+    # Get Firestore client for the configured database
+    client = firestore.Client(
+        project=FIRESTORE_PROJECT,
+        database=FIRESTORE_DATABASE
+    )
+    logger.info(f"Initialized Firestore client with {FIRESTORE_DATABASE} database")
+    return client
+
+def get_db():
+    """Returns the Firestore client, initializing Firebase on first call (thread-safe)."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = _init_firestore()
+    return _db
+
+def set_db(client):
+    """Replaces the Firestore client, e.g. with an in-memory stand-in for offline benchmarks."""
+    global _db
+    with _db_lock:
+        _db = client
+
+# Data access: Firestore unless DATA_BACKEND selects the in-memory or SQLite
+# store, which are seeded from the schemas in firestore/ for offline runs
+data_backend = create_backend(db_factory=get_db)
+menu_repository = MenuRepository(data_backend)
+config_repository = ConfigRepository(data_backend)
+order_repository = OrderRepository(data_backend)
+
+# Per-day and per-hour sales counters, updated whenever completed orders are
+# written, so sales questions never scan the orders collection
+sales_rollups = SalesRollups(SalesRollupRepository(data_backend))
+
+def _orders_written(orders):
+    if SALES_ROLLUPS_ENABLED:
+        sales_rollups.record_orders(orders)
+
+# Completed orders pushed to kitchen displays (GET .../kitchen, or SSE through
+# asgi.py), from this instance's completions or from one listener on new orders
+kitchen_feed = KitchenFeed(
+    listen=(lambda publish: order_repository.watch_new_orders(datetime.now(timezone.utc), publish))
+    if KITCHEN_FEED_SOURCE == "listener" else None
+)
 
-# Get Firestore client for mcd-vos database updated connection details
-db = firestore.Client(
-    project='burner-abhdey0',
-    database='mcd-vos'
+# Write-behind persistence for the orders collection: orders are journaled
+# locally and written in batches by a background thread
+ORDER_WRITE_BEHIND = os.environ.get("ORDER_WRITE_BEHIND", "true").lower() == "true"
+order_writer = OrderWriter(order_repository, on_written=_orders_written)
+
+@tracing.traced("save_order")
+def save_order(order_data: dict):
+    """Persists an order document, write-behind unless ORDER_WRITE_BEHIND is off."""
+    if ORDER_WRITE_BEHIND:
+        order_writer.enqueue(order_data)
+    else:
+        order_repository.save_order(order_data)
+        try:
+            _orders_written([order_data])
+        except Exception as e:
+            # The order is saved; a retry of the turn would save it again under a new ID.
+            # The writer rewrites the same document and retries the rollups instead
+            logger.error(f"Sales rollups failed for order {order_data['id']}, queued for retry: {str(e)}")
+            order_writer.enqueue(order_data)
+    # The order is journaled or written, so the kitchen can start on it now
+    if not kitchen_feed.listening:
+        kitchen_feed.publish([order_data])
+
+# Save carts evicted from the session store as 'abandoned' orders
+PERSIST_ABANDONED_CARTS = os.environ.get("PERSIST_ABANDONED_CARTS", "false").lower() == "true"
+
+def persist_abandoned_cart(key: str, session: Session, reason: str):
+    """Writes a cart the customer never completed to the orders collection."""
+    if not session.items:
+        return
+    store_id, session_id = split_session_key(key)
+    order_id = OrderWriter.new_order_id()
+    order_data = {
+        "id": order_id,
+        "session_id": session_id,
+        "status": "abandoned",
+        "created_at": datetime.now(timezone.utc),
+        "items": session.order_items(),
+        "total_amount": session.total_amount
+    }
+    if store_id is not None:
+        order_data["store_id"] = store_id
+    save_order(order_data)
+    logger.info(f"Persisted abandoned cart for session {session_id} as order {order_id} ({reason})")
+
+# Session storage (for tracking current order during conversation), selected by SESSION_STORE_BACKEND
+session_store = create_session_store(
+    on_evict=persist_abandoned_cart if PERSIST_ABANDONED_CARTS else None
 )
-logger.info("Initialized Firestore client with mcd-vos database")
-
-class FoodItem(BaseModel):
-    item_id: str
-    name: str
-    quantity: int = 1
-    base_price: float
-    customizations: List[str] = []
-    item_total: float
-
-class DrinkItem(BaseModel):
-    item_id: str
-    name: str
-    quantity: int = 1
-    base_price: float
-    size: Optional[str] = None
-    size_price: float = 0
-    item_total: float
-
-# In-memory session storage (for tracking current order during conversation)
-active_sessions = {}
 
+# Responses of recent turns, replayed when Dialogflow retries a request
+# (same responseId) instead of adding items or saving an order twice
+response_cache = ResponseCache()
+
+# Metrics, served by metrics_endpoint and dumped to the log every METRICS_LOG_INTERVAL_SECONDS
+REQUEST_SECONDS = metrics.histogram("vos_webhook_request_seconds", "End-to-end latency of webhook requests.").labels()
+HANDLER_SECONDS = metrics.histogram(
+    "vos_intent_handler_seconds", "Latency of intent handlers, session load and save included.", ("intent",)
+)
+WEBHOOK_ERRORS = metrics.counter("vos_webhook_errors_total", "Requests answered with the generic error response.").labels()
+if session_store.counts_sessions:
+    metrics.gauge("vos_session_store_sessions", "Sessions currently held by the session store.",
+                  lambda: len(session_store))
+metrics.gauge("vos_session_store_evictions", "Sessions evicted by the session store since start.",
+              lambda: session_store.evictions)
+metrics.gauge("vos_response_cache_entries", "Responses held for replay to retried requests.",
+              lambda: len(response_cache))
+metrics.gauge("vos_response_replays", "Retried requests answered from the response cache since start.",
+              lambda: response_cache.replays)
+metrics.gauge("vos_order_queue_depth", "Orders journaled but not yet written.",
+              lambda: order_writer.stats()["queue_depth"])
+metrics.gauge("vos_order_queue_oldest_seconds", "Age of the oldest order waiting to be written.",
+              lambda: order_writer.stats()["oldest_pending_age_seconds"])
+metrics.gauge("vos_orders_flushed", "Orders written by the write-behind writer since start.",
+              lambda: order_writer.flushed)
+metrics.gauge("vos_orders_failed", "Orders the writer gave up on, waiting for `python order_queue.py requeue`.",
+              lambda: order_writer.stats()["failed_orders"])
+metrics.gauge("vos_store_caches", "Stores whose menu and config caches this instance holds.",
+              lambda: len(store_directory))
+metrics.gauge("vos_store_cache_bytes", "Measured memory of every store's caches, the default store's included.",
+              lambda: store_directory.size_bytes())
+metrics.gauge("vos_store_cache_evictions", "Stores whose caches were dropped to stay within the memory budget.",
+              lambda: store_directory.evictions)
+metrics.gauge("vos_store_rejections", "Requests refused because their store has no menu.",
+              lambda: store_directory.rejections)
+metrics.gauge("vos_kitchen_feed_subscribers", "Kitchen displays subscribed to the feed.",
+              lambda: len(kitchen_feed))
+metrics.gauge("vos_kitchen_feed_orders", "Orders published to the kitchen feed since start.",
+              lambda: kitchen_feed.published)
+metrics.gauge("vos_kitchen_feed_resets", "Displays that could not be caught up from the replay log and reloaded.",
+              lambda: kitchen_feed.resets)
+
+# Process-wide menu cache, kept current by a Firestore listener or TTL refresh
+menu_catalog = MenuCatalog(menu_repository)
+
+# Process-wide order limits cache, refreshed the same way
+order_limits_config = OrderLimitsConfig(config_repository)
+
+# Items bought together, published by `python upsell.py build` and refreshed the same way
+upsell_config = UpsellConfig(config_repository)
+
+# Multi-store deployments (STORE_ID_SOURCE): each store's menu and configs live
+# under stores/<store_id>/ and get their own caches, created on the store's
+# first request and dropped for cold stores beyond STORE_CACHE_BUDGET_MB.
+# Requests no store is derived for are served by the caches above
+def _create_store_caches(store_id: str) -> StoreCaches:
+    store_configs = ConfigRepository(data_backend, store_collection(store_id, ConfigRepository.collection))
+    return StoreCaches(
+        store_id,
+        MenuCatalog(MenuRepository(data_backend, store_collection(store_id, MenuRepository.collection))),
+        OrderLimitsConfig(store_configs),
+        UpsellConfig(store_configs),
+    )
+
+default_store = StoreCaches(None, menu_catalog, order_limits_config, upsell_config)
+store_directory = StoreDirectory(_create_store_caches, default_store)
+
+def _store() -> StoreCaches:
+    """The caches of the store the current request belongs to."""
+    return current_store() or default_store
+
+# Cold start: seed both caches from a local snapshot file, if one was shipped
+# with the function, and bring them up to date from Firestore in the background
+WARM_SNAPSHOT_PATH = os.environ.get(
+    "WARM_SNAPSHOT_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "warm_snapshot.json")
+)
+load_warm_snapshot(WARM_SNAPSHOT_PATH, menu_catalog, order_limits_config)
+
+# Optionally connect to Firestore and load the caches at import time, so the
+# platform's instance startup absorbs the cost instead of the first request
+WARM_UP_ON_IMPORT = os.environ.get("WARM_UP_ON_IMPORT", "false").lower() == "true"
+
+def warm_up():
+    """Connects to the data backend and loads the menu and limits caches."""
+    started = time.monotonic()
+    if data_backend.name == "firestore":
+        get_db()
+    menu_catalog.ensure_loaded()
+    order_limits_config.ensure_loaded()
+    if UPSELL_ENABLED:
+        upsell_config.ensure_loaded()
+    logger.info(f"Warm-up finished in {(time.monotonic() - started) * 1000:.1f}ms")
+
+if WARM_UP_ON_IMPORT:
+    try:
+        warm_up()
+    except Exception as e:
+        # The first request retries whatever failed here
+        logger.error(f"Error warming up: {str(e)}", exc_info=True)
+
+@tracing.traced("get_menu_item")
 def get_menu_item(item_name: str):
-    """Fetch menu item with case-insensitive search and ensure correct data types."""
+    """Fetch menu item with case-insensitive search from the in-process menu catalog."""
     try:
-        logger.info(f"Attempting to fetch menu item: {item_name}")
-        menu_ref = db.collection('menu_items')
-        
-        # Get all menu items and filter case-insensitively updated
-        menu_items = menu_ref.get()
-        for doc in menu_items:
-            item_data = doc.to_dict()
-            if item_data['name'].lower() == item_name.lower():
-                # Add document ID to the item data
-                item_data['id'] = doc.id
-                
-                # Ensure base_price is a float
-                try:
-                    item_data['base_price'] = float(item_data['base_price'])
-                except (ValueError, TypeError):
-                    logger.error(f"Invalid base_price format for {item_name}")
-                    continue
-                
-                # Ensure sizes are floats if they exist
-                if item_data.get('has_size') and 'sizes' in item_data:
-                    item_data['sizes'] = {
-                        size: float(price)
-                        for size, price in item_data['sizes'].items()
-                    }
-                
-                logger.info(f"Found menu item with validated data types: {item_data}")
-                return item_data
-        
-        logger.info(f"Menu item not found: {item_name}")
-        return None
+        logger.debug("Attempting to fetch menu item: %s", item_name)
+        item_data = _store().menu_catalog.get_by_name(item_name)
+        if item_data is None:
+            logger.info("Menu item not found: %s", item_name)
+            return None
+
+        logger.debug("Found menu item: %s", item_data)
+        return item_data
 
     except Exception as e:
         logger.error(f"Error fetching menu item: {e}")
         return None
 
-def calculate_item_total(menu_item, quantity: int, size: Optional[str] = None):
-    """Calculate total price for an item including size if applicable."""
-    try:
-        # Convert base_price from string to float if necessary
-        base_price = float(menu_item['base_price'])
-        size_price = 0.0
-        
-        if menu_item.get('has_size', False) and size and 'sizes' in menu_item:
-            size_price = float(menu_item['sizes'].get(size.lower(), 0))
-        
-        total = (base_price + size_price) * quantity
-        return total, size_price
-    except (ValueError, TypeError) as e:
-        logger.error(f"Error calculating item total: {str(e)}")
-        logger.error(f"Menu item data: {menu_item}")
-        raise
+def get_order_summary(session: Session):
+    """Creates the order summary payload, including customization details, for the session's cart."""
+    return {"order_summary": session.to_dict()}
 
-def get_order_summary(session_id: str):
-    """
-    Creates a formatted order summary including all items and total amount.
-    Now includes proper customization details in the response.
-    """
+def suggest_item(session: Session):
+    """The menu item most often bought with the cart, or None; never fails the turn."""
+    if not UPSELL_ENABLED or not session.items:
+        return None
     try:
-        # Always return a summary structure, even if empty updated
-        summary = {
-            "items": [],
-            "total_amount": 0,
-            "item_count": 0
-        }
-        
-        if session_id in active_sessions and active_sessions[session_id]["items"]:
-            session = active_sessions[session_id]
-            
-            # Format items with customizations
-            formatted_items = []
-            for item in session["items"]:
-                formatted_item = {
-                    "item_id": item["item_id"],
-                    "name": item["name"],
-                    "quantity": item["quantity"],
-                    "base_price": item["base_price"],
-                    "customizations": item.get("customizations", []),  # Ensure customizations are included
-                    "item_total": item["item_total"]
-                }
-                
-                # Add size info for drinks if present
-                if "size" in item:
-                    formatted_item["size"] = item["size"]
-                if "size_price" in item:
-                    formatted_item["size_price"] = item["size_price"]
-                
-                formatted_items.append(formatted_item)
-            
-            summary.update({
-                "items": formatted_items,
-                "total_amount": session["total_amount"],
-                "item_count": sum(item["quantity"] for item in session["items"])
-            })
-            
-        return {"order_summary": summary}
+        store = _store()
+        table = store.upsell_config.current()
+        if table is None:
+            return None
+        item_id = table.suggest((line.item_id for line in session.items),
+                                available=lambda candidate: store.menu_catalog.get_by_id(candidate) is not None)
+        return store.menu_catalog.get_by_id(item_id) if item_id is not None else None
     except Exception as e:
-        logger.error(f"Error creating order summary: {str(e)}")
-        return {"order_summary": {"items": [], "total_amount": 0, "item_count": 0}}
+        logger.warning(f"No upsell suggestion: {str(e)}")
+        return None
 
-def create_response(fulfillment_text: str, session_id: str, output_contexts=None):
-    """Creates a standardized response with detailed order summary."""
+@tracing.traced("create_response")
+def create_response(fulfillment_text: str, session: Session, output_contexts=None, suggest: bool = False):
+    """
+    Creates a standardized response with detailed order summary. With
+    suggest, an item often bought with the cart is offered as well.
+    """
     # Get order summary
-    order_summary = get_order_summary(session_id)
-    
-    # If this is a response about completed order, format items with customizations
-    if "completed" in fulfillment_text.lower() or "order is:" in fulfillment_text.lower():
-        if session_id in active_sessions and active_sessions[session_id]["items"]:
-            items_descriptions = [
-                format_item_description(item) 
-                for item in active_sessions[session_id]["items"]
-            ]
-            
-            total_amount = active_sessions[session_id]["total_amount"]
-            
-            fulfillment_text = (
-                f"Great! Your order is: {', '.join(items_descriptions)}. "
-                f"Total amount: ${total_amount:.2f}. "
-                "Please proceed to next window for payment."
-            )
-    
+    order_summary = get_order_summary(session)
+
+    suggestion = suggest_item(session) if suggest else None
+    if suggestion is not None:
+        fulfillment_text += f" How about adding {suggestion.name}?"
+        order_summary["suggestion"] = {"item_id": suggestion.id, "name": suggestion.name}
+
     response = {
         "fulfillmentText": fulfillment_text,
         "fulfillmentMessages": [
@@ -201,79 +325,229 @@ def create_response(fulfillment_text: str, session_id: str, output_contexts=None
     if output_contexts:
         response["outputContexts"] = output_contexts
     
-    logger.info(f"Response created with order summary and contexts: {output_contexts}")
+    logger.debug("Response created with order summary and contexts: %s", output_contexts)
     return response
 
+@functions_framework.http
+def metrics_endpoint(request):
+    """Serves every metric in the Prometheus text format."""
+    return metrics.REGISTRY.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+def sales_report(params) -> tuple:
+    """Answers a sales query (date, item, by=day|hour) from the rollups; returns (payload, status)."""
+    try:
+        arguments = parse_query(params)
+    except ValueError as e:
+        return {"error": f"Invalid sales query: {str(e)}"}, 400
+    return sales_rollups.query(**arguments), 200
+
+@functions_framework.http
+def sales_endpoint(request):
+    """Serves sales rollups as JSON: GET .../sales?date=YYYY-MM-DD&item=<name or ID>&by=hour"""
+    payload, status = sales_report(request.args)
+    return _json_response(payload, status)
+
+def kitchen_report(params) -> tuple:
+    """Long-polls the kitchen feed (after=<cursor>, timeout=<seconds>, store=<store_id>); returns (payload, status)."""
+    try:
+        arguments = parse_poll(params)
+    except ValueError as e:
+        return {"error": f"Invalid kitchen feed query: {str(e)}"}, 400
+    return kitchen_feed.poll(**arguments), 200
+
+@functions_framework.http
+def kitchen_endpoint(request):
+    """Serves new completed orders to kitchen displays by long-poll: GET .../kitchen?after=<cursor>"""
+    payload, status = kitchen_report(request.args)
+    return _json_response(payload, status)
+
+def _log_request_body(request_json) -> bool:
+    """Logs the request body if this request is sampled for body logging; returns the decision."""
+    # Bodies are large; only a sample of requests (or debug runs) log them
+    log_bodies = should_log_bodies(logger)
+    if log_bodies:
+        logger.info("Request body: %s", Payload(request_json))
+    return log_bodies
+
+def _json_response(payload, status: int = 200):
+    """Pre-encodes a response body, so the framework sends the bytes as they are."""
+    return fast_json.dumps(payload), status, {"Content-Type": fast_json.CONTENT_TYPE}
+
+def _error_response(e: Exception) -> dict:
+    WEBHOOK_ERRORS.inc()
+    logger.error(f"Error processing request: {str(e)}", exc_info=True)
+    return {
+        "error": str(e),
+        "fulfillmentText": "Sorry, there was an error processing your request."
+    }
+
+def _record_request(started: float):
+    elapsed = time.perf_counter() - started
+    REQUEST_SECONDS.observe(elapsed)
+    logger.info("Handled request", extra={"latency_ms": round(elapsed * 1000, 2)})
+    metrics.REGISTRY.log_if_due()
+
 @functions_framework.http
 def handle_request(request):
     """Main entry point for the Cloud Function."""
-    try:
-        logger.info("Received request")
-        request_json = request.get_json()
-        logger.info(f"Request body: {request_json}")
+    # Scrapers reach the metrics through the same function: GET .../metrics
+    if request.method == "GET" and request.path.endswith("/metrics"):
+        return metrics_endpoint(request)
+    if request.method == "GET" and request.path.endswith("/sales"):
+        return sales_endpoint(request)
+    if request.method == "GET" and request.path.endswith("/kitchen"):
+        return kitchen_endpoint(request)
+
+    started = time.perf_counter()
+    with request_context(), tracing.trace("handle_request"):
+        try:
+            webhook_request = decode_webhook_request(request.get_data())
+            log_bodies = _log_request_body(webhook_request.raw)
+            response = dialogflow_webhook(webhook_request)
+            if log_bodies:
+                logger.info("Response: %s", Payload(response))
+            return _json_response(response)
+
+        except Exception as e:
+            return _json_response(_error_response(e))
+
+        finally:
+            _record_request(started)
+
+# Async entry point (see asgi.py). Blocking work runs on a bounded thread
+# pool, so one event loop holds many in-flight drive-thru lanes while only
+# ASYNC_WORKER_THREADS threads exist, however many requests are waiting
+ASYNC_WORKER_THREADS = int(os.environ.get("ASYNC_WORKER_THREADS", "16"))
+io_executor = ThreadPoolExecutor(max_workers=ASYNC_WORKER_THREADS, thread_name_prefix="vos-io")
+
+async def run_blocking(function, *args):
+    """Runs a blocking call on io_executor, carrying the request's log fields and trace."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(io_executor, partial(context.run, function, *args))
+
+async def handle_request_async(webhook_request: WebhookRequest):
+    """Entry point for the ASGI app: handle_request for an already decoded body."""
+    started = time.perf_counter()
+    with request_context(), tracing.trace("handle_request"):
+        try:
+            log_bodies = _log_request_body(webhook_request.raw)
+            response = await dialogflow_webhook_async(webhook_request)
+            if log_bodies:
+                logger.info("Response: %s", Payload(response))
+            return response
 
-        response = dialogflow_webhook(request_json)
-        logger.info(f"Response: {response}")
-        return response
-    
-    except Exception as e:
-        logger.error(f"Error processing request: {str(e)}", exc_info=True)
-        return {
-            "error": str(e), 
-            "fulfillmentText": "Sorry, there was an error processing your request."
-        }
+        except Exception as e:
+            return _error_response(e)
+
+        finally:
+            _record_request(started)
 
-def dialogflow_webhook(data: dict):
-    """Handles webhook requests from Dialogflow."""
+async def dialogflow_webhook_async(data):
+    """
+    Async counterpart of dialogflow_webhook. When the menu or limits cache
+    needs loading, both are loaded concurrently (they are independent
+    Firestore reads) before the turn runs on the thread pool, so a cold or
+    stale turn waits for the slower read rather than for both in sequence.
+    """
+    store = store_directory.peek(store_id_for(data)) if isinstance(data, WebhookRequest) else default_store
+    # A store's first request creates (or refuses) its caches in the handler, off the event loop
+    if store is not None:
+        caches = [store.menu_catalog, store.order_limits_config] + ([store.upsell_config] if UPSELL_ENABLED else [])
+        if not all(cache.is_fresh() for cache in caches):
+            # A failed load is retried, and reported, by the handler itself
+            await asyncio.gather(*(run_blocking(cache.ensure_loaded) for cache in caches), return_exceptions=True)
+    return await run_blocking(dialogflow_webhook, data)
+
+@tracing.traced("dialogflow_webhook", root=True)
+def dialogflow_webhook(data):
+    """Handles webhook requests from Dialogflow, given as a payload dict or a decoded WebhookRequest."""
     try:
-        intent_name = data["queryResult"]["intent"]["displayName"]
-        
-        # Extract session ID from outputContexts
-        output_contexts = data["queryResult"].get("outputContexts", [])
-        if not output_contexts:
-            raise ValueError("No output contexts found in request")
-            
-        # Extract session ID from the first context's name
-        context_name = output_contexts[0]["name"]
-        session_id = context_name.split("/sessions/")[1].split("/contexts/")[0]
-
-        logger.info(f"Intent: {intent_name}")
-        logger.info(f"Session ID: {session_id}")
-
-        # Initialize session if it doesn't exist
-        if session_id not in active_sessions:
-            active_sessions[session_id] = {
-                "items": [],
-                "total_amount": 0
-            }
+        # Parse the payload once; handlers read everything from this view
+        request = data if isinstance(data, WebhookRequest) else parse_webhook_request(data)
+
+        # The turn is served from its store's menu and configs, and its
+        # session is kept apart from other stores' sessions
+        request.store_id = store_id_for(request)
+        request.session_key = session_key(request.store_id, request.session_id)
+        store = store_directory.get(request.store_id)
+
+        # Every later log line of this request carries these fields
+        bind(session_id=request.session_id, intent=request.intent, response_id=request.response_id)
+        if request.store_id is not None:
+            bind(store_id=request.store_id)
+        trace_id = tracing.current_trace_id()
+        if trace_id is not None:
+            bind(trace_id=trace_id)
+            tracing.set_trace_attributes({
+                "dialogflow.session_id": request.session_id,
+                "dialogflow.response_id": request.response_id,
+                "dialogflow.intent": request.intent,
+            })
 
-        # Map intents to their handlers
-        intent_handlers = {
-            "order.food": handle_order_food,
-            "order.modify": handle_order_modify,
-            "order.drink": handle_order_drink,
-            "order.size": handle_size_update,
-            "order.remove": handle_order_remove,
-            "order.complete": handle_order_complete,
-            "order.combined": handle_order_combined,
-            "order.quantity": handle_order_quantity,  # Add the new handler
-            "order.limit.acknowledge": handle_order_limit_acknowledge,
-            "order.complete.acknowledge": handle_order_complete_acknowledge
-        }
+        # A retry of a turn that already ran gets the same response again
+        replay = response_cache.get(request.session_key, request.response_id)
+        if replay is not None:
+            logger.info("Replaying response to retried request")
+            return replay
 
         # Get the appropriate handler for the intent
-        handler = intent_handlers.get(intent_name)
+        handler = INTENT_HANDLERS.get(request.intent)
         
-        if handler:
-            return handler(data, session_id)
-        else:
-            logger.warning(f"No handler found for intent: {intent_name}")
-            return create_response(
-                "I'm not sure how to handle that request. Could you please try again?",
-                session_id
-            )
+        # Run the turn as one atomic read-modify-write of the session; the
+        # session is written back only if the handler returns normally
+        handler_latency = HANDLER_SECONDS.labels(request.intent if handler else "unhandled")
+        started = time.perf_counter()
+        try:
+            with use_store(store), tracing.span("session_transaction"), \
+                    session_store.transaction(request.session_key) as session:
+                # A retry that arrived while the original turn held the session lock,
+                # or whose original turn ran on another instance or before a restart
+                replay = response_cache.get(request.session_key, request.response_id)
+                if replay is None:
+                    replay = session.replay(request.response_id)
+                if replay is not None:
+                    logger.info("Replaying response to retried request")
+                    return replay
+
+                if handler:
+                    with tracing.span(handler.__name__):
+                        response = handler(request, session)
+                else:
+                    logger.warning(f"No handler found for intent: {request.intent}")
+                    response = create_response(
+                        "I'm not sure how to handle that request. Could you please try again?",
+                        session
+                    )
+
+                # Stored before the session lock is released, so a waiting retry finds
+                # it; the session store commits last_response with the session
+                response_cache.put(request.session_key, request.response_id, response)
+                if request.response_id is not None:
+                    session.last_response = (request.response_id, response)
+                return response
+        except Exception:
+            # The session was not written back, so a retry has to run the turn again
+            response_cache.discard(request.session_key, request.response_id)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started)
+            store_directory.account(store)
     
+    except UnknownStore as e:
+        # Not served from another store's menu: its prices and items may differ
+        logger.warning(f"Refused request for unknown store {e}")
+        return {
+            "fulfillmentText": "Sorry, this restaurant isn't taking orders right now.",
+            "payload": {
+                "order_summary": {
+                    "items": [],
+                    "total_amount": 0,
+                    "item_count": 0
+                }
+            }
+        }
     except Exception as e:
+        WEBHOOK_ERRORS.inc()
         logger.error(f"Error in dialogflow_webhook: {str(e)}", exc_info=True)
         return {
             "fulfillmentText": "Sorry, there was an error processing your request.",
@@ -286,23 +560,19 @@ def dialogflow_webhook(data: dict):
             }
         }
 
-def handle_order_food(data: dict, session_id: str):
+def handle_order_food(request: WebhookRequest, session: Session):
     """Handles the 'order.food' intent with multiple customization support and size handling."""
     try:
         # Extract basic order details
-        parameters = data["queryResult"]["parameters"]
-        food_item_param = parameters.get("food-item")
-        modification_types = parameters.get("modification-type", [])
-        food_components = parameters.get("food-components", [])
-        size = parameters.get("drink-size")  # Reuse drink-size parameter for food sizes
-        
-        # Handle food item whether it's a string or array
-        food_item = food_item_param[0] if isinstance(food_item_param, list) else food_item_param
+        food_item = request.first("food-item")
+        modification_types = request.values("modification-type")
+        food_components = request.values("food-components")
+        size = request.first("drink-size")  # Reuse drink-size parameter for food sizes
         
         if not food_item:
             return create_response(
                 "I'm sorry, I didn't catch what food item you wanted. Could you please repeat that?",
-                session_id
+                session
             )
 
         # Get menu item details
@@ -310,32 +580,19 @@ def handle_order_food(data: dict, session_id: str):
         if not menu_item:
             return create_response(
                 f"I'm sorry, we don't have {food_item} on our menu.",
-                session_id
+                session
             )
 
         # Handle quantity parameter
-        quantity_param = parameters.get("number", 1)
-        try:
-            quantity = int(float(quantity_param))
-        except (ValueError, TypeError):
-            quantity = 1
-        logger.info(f"Quantity parsed: {quantity}")
-
-        # Extract project_id from session name
-        project_id = data["session"].split('/')[1]
+        quantity = request.quantity()
+        logger.debug("Quantity parsed: %s", quantity)
 
         # Initialize customizations list
         customizations = []
 
-        # Ensure modification_types and food_components are lists
-        if not isinstance(modification_types, list):
-            modification_types = [modification_types]
-        if not isinstance(food_components, list):
-            food_components = [food_components]
-
         # Process multiple customizations if provided
         if modification_types and food_components:
-            logger.info(f"Processing customizations: {modification_types} {food_components}")
+            logger.debug("Processing customizations: %s %s", modification_types, food_components)
             
             # Process each customization pair
             for mod_type, component in zip(modification_types, food_components):
@@ -343,7 +600,7 @@ def handle_order_food(data: dict, session_id: str):
                     # Validate each customization
                     is_valid, message = validate_customization(menu_item, mod_type, component)
                     if not is_valid:
-                        return create_response(message, session_id)
+                        return create_response(message, session)
 
                     # Format customization based on type
                     if mod_type in ["no", "without"]:
@@ -355,22 +612,21 @@ def handle_order_food(data: dict, session_id: str):
 
         # Validate quantity before processing
         is_valid, validation_message, contexts = validate_order_quantity(
-            menu_item["id"], 
+            menu_item.id, 
             "food",
             quantity,
-            session_id,
-            project_id
+            request
         )
         
         if not is_valid:
-            return create_response(validation_message, session_id, contexts)
+            return create_response(validation_message, session, contexts)
 
         # Check if this item supports sizes and if a size is needed
-        if menu_item.get("has_size", False):
+        if menu_item.has_size:
             if not size:
                 # Create context to remember we're waiting for size
                 size_context = [{
-                    "name": f"projects/{project_id}/agent/sessions/{session_id}/contexts/awaiting-size",
+                    "name": request.context_name("awaiting-size"),
                     "lifespanCount": 2,
                     "parameters": {
                         "item_name": food_item,
@@ -380,76 +636,48 @@ def handle_order_food(data: dict, session_id: str):
                 
                 return create_response(
                     f"What size would you like for your {food_item}?",
-                    session_id,
+                    session,
                     size_context
                 )
-            item_total, size_price = calculate_item_total(menu_item, quantity, size)
         else:
-            item_total = menu_item["base_price"] * quantity
-            size_price = 0
             size = None  # Ensure size is None for items that don't support sizes
 
-        # Create order item
-        order_item = {
-            "item_id": menu_item["id"],
-            "name": menu_item["name"],
-            "quantity": quantity,
-            "base_price": menu_item["base_price"],
-            "customizations": customizations,
-        }
+        # Create order item, priced from the compiled menu, with size
+        # information if the item supports sizes
+        order_item = CartLine.for_menu_item(menu_item, quantity, size, customizations)
 
-        # Add size information if the item supports sizes
-        if menu_item.get("has_size", False):
-            order_item.update({
-                "size": size,
-                "size_price": size_price,
-            })
-
-        order_item["item_total"] = item_total
-
-        # Initialize session if it doesn't exist
-        if session_id not in active_sessions:
-            active_sessions[session_id] = {"items": [], "total_amount": 0}
-        
         # Add item to session
-        active_sessions[session_id]["items"].append(order_item)
-        active_sessions[session_id]["total_amount"] += item_total
+        session.add(order_item)
 
         # Create response text based on whether customizations were requested
         response_text = f"Okay, I've added {quantity} "
         if size:
             response_text += f"{size} "
-        response_text += menu_item['name']
+        response_text += menu_item.name
         if customizations:
             response_text += f" with {', '.join(customizations)}"
         response_text += ". Would you like anything else?"
 
-        return create_response(response_text, session_id)
+        return create_response(response_text, session, suggest=True)
 
     except Exception as e:
         logger.error(f"Error in handle_order_food: {str(e)}", exc_info=True)
         raise
     
-def handle_order_drink(data: dict, session_id: str):
+def handle_order_drink(request: WebhookRequest, session: Session):
     """Handles the 'order.drink' intent."""
     try:
         # Extract parameters
-        parameters = data["queryResult"]["parameters"]
-        drink_item = parameters.get("drink-item")
-        size = parameters.get("drink-size")
-        quantity_param = parameters.get("number", 1)
-        
-        try:
-            quantity = int(float(quantity_param))
-        except (ValueError, TypeError):
-            quantity = 1
-        logger.info(f"Quantity parsed: {quantity}")
+        drink_item = request.first("drink-item")
+        size = request.parameters.get("drink-size")
+        quantity = request.quantity()
+        logger.debug("Quantity parsed: %s", quantity)
 
         # Skip processing if we only got a size parameter (likely meant for size intent)
         if not drink_item and size:
             return create_response(
                 "I didn't catch which drink you wanted. Could you please specify your drink?",
-                session_id
+                session
             )
 
         # Fetch menu item details
@@ -457,50 +685,30 @@ def handle_order_drink(data: dict, session_id: str):
         if not menu_item:
             return create_response(
                 f"I'm sorry, we don't have {drink_item} on our menu.",
-                session_id
+                session
             )
 
-        # Extract project_id from session name for context creation
-        project_id = data["session"].split('/')[1]
-
         # Validate quantity before processing
         is_valid, validation_message, contexts = validate_order_quantity(
-            menu_item["id"], 
+            menu_item.id, 
             "drink",
             quantity,
-            session_id,
-            project_id
+            request
         )
         
         if not is_valid:
-            return create_response(validation_message, session_id, contexts)
-
-        # Calculate total
-        item_total, size_price = calculate_item_total(menu_item, quantity, size)
-
-        # Create order item
-        order_item = {
-            "item_id": menu_item["id"],
-            "name": menu_item["name"],
-            "quantity": quantity,
-            "base_price": menu_item["base_price"],
-            "size": size,
-            "size_price": size_price,
-            "item_total": item_total
-        }
+            return create_response(validation_message, session, contexts)
 
-        # Initialize session if it doesn't exist
-        if session_id not in active_sessions:
-            active_sessions[session_id] = {"items": [], "total_amount": 0}
+        # Create order item; drinks always carry size fields
+        order_item = CartLine.for_menu_item(menu_item, quantity, size, sized=True)
 
         # Add item to session
-        active_sessions[session_id]["items"].append(order_item)
-        active_sessions[session_id]["total_amount"] += item_total
+        session.add(order_item)
 
-        if not size and menu_item.get("has_size", False):
+        if not size and menu_item.has_size:
             # Create awaiting-size context
             size_context = [{
-                "name": f"projects/{project_id}/agent/sessions/{session_id}/contexts/awaiting-size",
+                "name": request.context_name("awaiting-size"),
                 "lifespanCount": 2,
                 "parameters": {
                     "item_name": drink_item,
@@ -509,7 +717,7 @@ def handle_order_drink(data: dict, session_id: str):
             }]
             return create_response(
                 f"What size would you like for your {drink_item}?",
-                session_id,
+                session,
                 size_context
             )
         
@@ -519,287 +727,235 @@ def handle_order_drink(data: dict, session_id: str):
             response_text += f"{size} "
         response_text += f"{drink_item} to your order. Anything else?"
         
-        return create_response(response_text, session_id)
+        return create_response(response_text, session, suggest=True)
     
     except Exception as e:
         logger.error(f"Error in handle_order_drink: {str(e)}", exc_info=True)
         raise
 
-def handle_size_update(data: dict, session_id: str):
+def handle_size_update(request: WebhookRequest, session: Session):
     """Handles the 'order.size' intent for updating both food and drink sizes."""
     try:
-        # Get all contexts
-        contexts = data["queryResult"]["outputContexts"]
-        
-        # Get ongoing order context
-        ongoing_order_context = next(
-            (ctx for ctx in contexts if ctx["name"].endswith("/contexts/ongoing-order")),
-            None
-        )
-        
-        # Get awaiting-size context
-        awaiting_size_context = next(
-            (ctx for ctx in contexts if ctx["name"].endswith("/contexts/awaiting-size")),
-            None
-        )
+        ongoing_order_context = request.context("ongoing-order")
+        awaiting_size_context = request.context("awaiting-size")
         
         if not ongoing_order_context:
             return create_response(
                 "I couldn't find your order. Could you start over?",
-                session_id
+                session
             )
             
         # Extract parameters
-        params = ongoing_order_context["parameters"]
+        params = ongoing_order_context.parameters
         size = params.get("drink-size")
 
         if not size:
             return create_response(
                 "I didn't catch what size you wanted. Could you please specify small, medium, or large?",
-                session_id
+                session
             )
 
         # If no awaiting-size context, try to find the last item in session that needs size
         if not awaiting_size_context:
-            if session_id in active_sessions and active_sessions[session_id]["items"]:
-                session_items = active_sessions[session_id]["items"]
-                last_item = session_items[-1]
+            if session.items:
+                last_item = session.items[-1]
                 
                 # Check if the last item needs size
-                menu_item = get_menu_item(last_item["name"])
-                if menu_item and menu_item.get("has_size", False):
-                    item_name = last_item["name"]
-                    item_type = "drink" if "customizations" not in last_item else "food"
+                menu_item = get_menu_item(last_item.name)
+                if menu_item and menu_item.has_size:
+                    item_name = last_item.name
+                    item_type = menu_item.category or "food"
                 else:
                     return create_response(
                         "I'm not sure which item you want to set the size for. Could you please start over?",
-                        session_id
+                        session
                     )
             else:
                 return create_response(
                     "I'm not sure which item you want to set the size for. Could you please start over?",
-                    session_id
+                    session
                 )
         else:
             # Get item details from awaiting-size context
-            size_params = awaiting_size_context["parameters"]
+            size_params = awaiting_size_context.parameters
             item_name = size_params.get("item_name")
             item_type = size_params.get("item_type")
 
         if not item_name:
             return create_response(
                 "I'm sorry, I lost track of your order. Could you please let me know what you'd like to order?",
-                session_id
+                session
             )
 
-        logger.info(f"Processing size update for {item_type} item: {item_name} with size: {size}")
+        logger.info("Processing size update for %s item: %s with size: %s", item_type, item_name, size)
 
         # Get menu item details
         menu_item = get_menu_item(item_name)
         if not menu_item:
             return create_response(
                 f"I'm sorry, we don't have {item_name} on our menu anymore.",
-                session_id
+                session
             )
             
-        if not menu_item.get('has_size', False):
+        if not menu_item.has_size:
             return create_response(
                 f"I'm sorry, but {item_name} doesn't come in different sizes.",
-                session_id
+                session
             )
 
-        # Calculate total with the new size (initially for quantity 1)
-        item_total, size_price = calculate_item_total(menu_item, 1, size)
-        
-        # Create order item
-        order_item = {
-            "item_id": menu_item["id"],
-            "name": menu_item["name"],
-            "quantity": 1,
-            "base_price": menu_item["base_price"],
-            "size": size,
-            "size_price": size_price,
-            "item_total": item_total
-        }
-
-        # Add customizations if it's a food item
-        if item_type == "food":
-            order_item["customizations"] = []
+        # Create order item with the new size (initially for quantity 1)
+        order_item = CartLine.for_menu_item(menu_item, 1, size, sized=True)
 
-        # Initialize or get session
-        if session_id not in active_sessions:
-            active_sessions[session_id] = {"items": [], "total_amount": 0}
-            
         # Look for existing order and update
-        session = active_sessions[session_id]
         updated = False
         
-        for i, item in enumerate(session["items"]):
+        for i, item in enumerate(session.items):
             # Look for matching item (case-insensitive)
-            if item["name"].lower() == order_item["name"].lower():
-                # Update existing item, preserving its original quantity
-                order_item["quantity"] = item["quantity"]
-                # Preserve customizations for food items
-                if "customizations" in item:
-                    order_item["customizations"] = item["customizations"]
-                # Recalculate total with correct quantity
-                order_item["item_total"] = (menu_item["base_price"] + size_price) * order_item["quantity"]
-                old_total = item["item_total"]
-                session["items"][i] = order_item
-                session["total_amount"] = session["total_amount"] - old_total + order_item["item_total"]
+            if item.name.lower() == order_item.name.lower():
+                # Update existing item, preserving its original quantity and customizations
+                order_item.quantity = item.quantity
+                order_item.customizations = item.customizations
+                session.replace(i, order_item)
                 updated = True
                 break
                 
         if not updated:
-            session["items"].append(order_item)
-            session["total_amount"] += item_total
+            session.add(order_item)
         
-        # Extract project_id from session name
-        project_id = data["session"].split('/')[1]
-
         # Clear the awaiting-size context
         clear_context = [{
-            "name": f"projects/{project_id}/agent/sessions/{session_id}/contexts/awaiting-size",
+            "name": request.context_name("awaiting-size"),
             "lifespanCount": 0
         }]
         
         # Create response text
-        quantity_str = f"{order_item['quantity']} " if order_item['quantity'] > 1 else ""
+        quantity_str = f"{order_item.quantity} " if order_item.quantity > 1 else ""
         response_text = f"Got it! I've updated your {item_name} to {quantity_str}{size}"
-        if "customizations" in order_item and order_item["customizations"]:
-            response_text += f" with {', '.join(order_item['customizations'])}"
+        if order_item.customizations:
+            response_text += f" with {', '.join(order_item.customizations)}"
         response_text += ". Would you like anything else?"
 
-        return create_response(response_text, session_id, clear_context)
+        return create_response(response_text, session, clear_context)
     
     except Exception as e:
         logger.error(f"Error in handle_size_update: {str(e)}", exc_info=True)
         raise
 
-def handle_order_remove(data: dict, session_id: str):
+def handle_order_remove(request: WebhookRequest, session: Session):
     """Handles the 'order.remove' intent."""
     try:
         # Check if there's an active order
-        if session_id not in active_sessions or not active_sessions[session_id]["items"]:
+        if not session.items:
             return create_response(
                 "There's no active order to remove items from.",
-                session_id
+                session
             )
 
         # Get parameters
-        parameters = data["queryResult"]["parameters"]
-        food_items = parameters.get("food-item", [])
-        drink_item = parameters.get("drink-item", "")
+        food_items = request.values("food-item")
+        drink_item = request.first("drink-item")
+        quantity = request.quantity()
         
-        quantity_param = parameters.get("number", 1)
-        try:
-            quantity = int(float(quantity_param))
-        except (ValueError, TypeError):
-            quantity = 1
-        
-        logger.info(f"Removing - Food items: {food_items}, Drink item: {drink_item}, Quantity: {quantity}")
+        logger.info("Removing - Food items: %s, Drink item: %s, Quantity: %s", food_items, drink_item, quantity)
 
         # Get the item to remove (either food or drink)
         item_to_remove = food_items[0] if food_items else drink_item
         if not item_to_remove:
             return create_response(
                 "I'm not sure which item you want to remove. Could you please specify?",
-                session_id
+                session
             )
 
+        # Match cart lines by canonical menu name, so synonyms like "bigmac" work too
+        menu_item = get_menu_item(item_to_remove)
+        name_to_remove = (menu_item.name if menu_item else item_to_remove).lower()
+
         # Find and remove the item
-        session = active_sessions[session_id]
         removed = False
         
-        for i, item in enumerate(session["items"]):
-            if item["name"].lower() == item_to_remove.lower():
-                if item["quantity"] <= quantity:
+        for i, item in enumerate(session.items):
+            if item.name.lower() == name_to_remove:
+                if item.quantity <= quantity:
                     # Remove the entire item
-                    session["total_amount"] -= item["item_total"]
-                    session["items"].pop(i)
+                    session.remove(i)
                 else:
                     # Reduce the quantity
-                    old_total = item["item_total"]
-                    item["quantity"] -= quantity
-                    item["item_total"] = (item["item_total"] / (item["quantity"] + quantity)) * item["quantity"]
-                    session["total_amount"] -= (old_total - item["item_total"])
+                    remaining = item.quantity - quantity
+                    session.set_quantity(i, remaining)
                 removed = True
                 break
 
         if not removed:
             return create_response(
                 f"I couldn't find {item_to_remove} in your order.",
-                session_id
+                session
             )
 
         return create_response(
             f"You got it. I have removed {quantity} {item_to_remove}. Anything Else?",
-            session_id
+            session
         )
 
     except Exception as e:
         logger.error(f"Error in handle_order_remove: {str(e)}", exc_info=True)
         raise
 
-def handle_order_complete(data: dict, session_id: str):
+def handle_order_complete(request: WebhookRequest, session: Session):
     """Handles the 'order.complete' intent."""
     try:
-        if session_id not in active_sessions or not active_sessions[session_id]["items"]:
+        if not session.items:
             return create_response(
                 "Your order is empty. What would you like to order?",
-                session_id
+                session
             )
 
-        # Create order in Firestore
-        order_ref = db.collection('orders').document()
+        # Queue the order for Firestore. The ID comes from the turn, so retried
+        # writes, and retries of this turn if it fails after queueing, overwrite one order
+        completed_at = datetime.now(timezone.utc)
         order_data = {
-            "id": order_ref.id,
-            "session_id": session_id,
+            "id": OrderWriter.order_id_for(request.session_key, request.response_id),
+            "session_id": request.session_id,
             "status": "completed",
-            "created_at": firestore.SERVER_TIMESTAMP,
-            "completed_at": firestore.SERVER_TIMESTAMP,
-            "items": active_sessions[session_id]["items"],
-            "total_amount": active_sessions[session_id]["total_amount"]
+            "created_at": completed_at,
+            "completed_at": completed_at,
+            "items": session.order_items(),
+            "total_amount": session.total_amount
         }
+        if request.store_id is not None:
+            order_data["store_id"] = request.store_id
 
-        order_ref.set(order_data)
+        save_order(order_data)
 
         # Prepare order summary
-        items_summary = []
-        for item in active_sessions[session_id]["items"]:
-            summary = f"{item['quantity']} {item.get('size', '')} {item['name']}"
-            if item.get('customizations'):
-                summary += f" with {', '.join(item['customizations'])}"
-            items_summary.append(summary)
-
-        # Extract project_id from session name
-        project_id = data["session"].split('/')[1]
+        items_summary = [format_item_description(item) for item in session.items]
 
         # Create completion context and clear all other contexts
         completion_contexts = [
             {
-                "name": f"projects/{project_id}/agent/sessions/{session_id}/contexts/awaiting-completion-acknowledgment",
+                "name": request.context_name("awaiting-completion-acknowledgment"),
                 "lifespanCount": 1
             },
             {
-                "name": f"projects/{project_id}/agent/sessions/{session_id}/contexts/awaiting-size",
+                "name": request.context_name("awaiting-size"),
                 "lifespanCount": 0  # Clear awaiting-size context
             },
             {
-                "name": f"projects/{project_id}/agent/sessions/{session_id}/contexts/ongoing-order",
+                "name": request.context_name("ongoing-order"),
                 "lifespanCount": 0  # Clear ongoing-order context
             }
         ]
 
         # Get final summary before clearing session
         final_response = create_response(
-            f"Great! Your order is: {', '.join(items_summary)}. Total amount: ${active_sessions[session_id]['total_amount']:.2f}. Please proceed to next window for payment.",
-            session_id,
+            f"Great! Your order is: {', '.join(items_summary)}. "
+            f"Total amount: ${session.total_amount:.2f}. "
+            "Please proceed to next window for payment.",
+            session,
             completion_contexts
         )
 
-        # Clear session
-        del active_sessions[session_id]
+        # Clear session; the store drops sessions left with an empty cart
+        session.clear()
 
         return final_response
     
@@ -807,125 +963,96 @@ def handle_order_complete(data: dict, session_id: str):
         logger.error(f"Error in handle_order_complete: {str(e)}", exc_info=True)
         raise
 
-def handle_order_combined(data: dict, session_id: str):
+def handle_order_combined(request: WebhookRequest, session: Session):
     """
     Handles the 'order.combined' intent for multiple items in a single order.
+
+    Runs as a batch pipeline: every item is resolved against the menu first,
+    then every quantity is validated, and only then are all lines added to
+    the cart together, so a rejected item never leaves the cart half-updated.
     """
     try:
-        parameters = data["queryResult"]["parameters"]
-        food_items = parameters.get("food-item", [])
-        drink_items = parameters.get("drink-item", [])
-        drink_sizes = parameters.get("drink-size", [])
-        quantities = parameters.get("number", [1])  # Default to 1 if not specified
+        food_items = request.values("food-item")
+        drink_items = request.values("drink-item")
+        drink_sizes = request.values("drink-size")
+        quantities = request.quantities()
         
-        # Ensure quantities list has enough values
+        # Ensure quantities list has enough values, defaulting to 1
         while len(quantities) < len(food_items) + len(drink_items):
             quantities.append(quantities[-1] if quantities else 1)
-            
-        response_items = []
-        current_quantity_index = 0
 
-        # Extract project_id from session name
-        project_id = data["session"].split('/')[1]
-        
-        # Process food items
-        for food_item in food_items:
-            quantity = int(float(quantities[current_quantity_index]))
-            current_quantity_index += 1
-            
-            menu_item = get_menu_item(food_item)
-            if not menu_item:
-                return create_response(
-                    f"I'm sorry, we don't have {food_item} on our menu.",
-                    session_id
-                )
+        # Pair each requested item with its category, quantity and size
+        requested = [(food_item, "food", None) for food_item in food_items]
+        requested += [
+            (drink_item, "drink", drink_sizes[i] if i < len(drink_sizes) else None)
+            for i, drink_item in enumerate(drink_items)
+        ]
 
-            # Validate quantity for food items
-            is_valid, validation_message, contexts = validate_order_quantity(
-                menu_item["id"],
-                "food",
-                quantity,
-                session_id,
-                project_id
-            )
-            
-            if not is_valid:
-                return create_response(validation_message, session_id, contexts)
-                
-            # Calculate total
-            item_total, _ = calculate_item_total(menu_item, quantity)
-            
-            # Create order item
-            order_item = {
-                "item_id": menu_item["id"],
-                "name": menu_item["name"],
-                "quantity": quantity,
-                "base_price": menu_item["base_price"],
-                "customizations": [],  # No customizations in combined order yet
-                "item_total": item_total
-            }
-            
-            active_sessions[session_id]["items"].append(order_item)
-            active_sessions[session_id]["total_amount"] += item_total
-            response_items.append(f"{quantity} {menu_item['name']}")
-        
-        # Process drink items
-        for i, drink_item in enumerate(drink_items):
-            quantity = int(float(quantities[current_quantity_index]))
-            current_quantity_index += 1
-            
-            # Get size for this drink if available
-            size = drink_sizes[i] if i < len(drink_sizes) else None
-            
-            menu_item = get_menu_item(drink_item)
+        # Stage 1: resolve every item against the menu catalog
+        resolved = []
+        for index, (item_name, category, size) in enumerate(requested):
+            quantity = quantities[index]
+            menu_item = get_menu_item(item_name)
             if not menu_item:
                 return create_response(
-                    f"I'm sorry, we don't have {drink_item} on our menu.",
-                    session_id
+                    f"I'm sorry, we don't have {item_name} on our menu.",
+                    session
                 )
+            resolved.append((item_name, category, menu_item, quantity, size))
 
-            # Validate quantity for drink items
+        # Stage 2: validate every quantity before touching the cart
+        for item_name, category, menu_item, quantity, size in resolved:
             is_valid, validation_message, contexts = validate_order_quantity(
-                menu_item["id"],
-                "drink",
+                menu_item.id,
+                category,
                 quantity,
-                session_id,
-                project_id
+                request
             )
             
             if not is_valid:
-                return create_response(validation_message, session_id, contexts)
-                
-            # Calculate total with size
-            item_total, size_price = calculate_item_total(menu_item, quantity, size)
-            
-            # Create order item
-            order_item = {
-                "item_id": menu_item["id"],
-                "name": menu_item["name"],
-                "quantity": quantity,
-                "base_price": menu_item["base_price"],
-                "size": size,
-                "size_price": size_price,
-                "item_total": item_total
-            }
-            
-            active_sessions[session_id]["items"].append(order_item)
-            active_sessions[session_id]["total_amount"] += item_total
-            response_items.append(f"{quantity} {size if size else ''} {menu_item['name']}")
-            
-            # If drink needs size but none specified
-            if not size and menu_item.get("has_size", False):
-                return create_response(
-                    f"What size would you like for your {drink_item}?",
-                    session_id
-                )
-        
+                return create_response(validation_message, session, contexts)
+
+        # Stage 3: build every order line, then apply them all at once
+        new_items = []
+        response_items = []
+        awaiting_size_item = None
+        for item_name, category, menu_item, quantity, size in resolved:
+            # No customizations in combined order yet
+            if category == "food":
+                new_items.append(CartLine.for_menu_item(menu_item, quantity, sized=False))
+                response_items.append(f"{quantity} {menu_item.name}")
+            else:
+                new_items.append(CartLine.for_menu_item(menu_item, quantity, size, sized=True))
+                response_items.append(f"{quantity} {size if size else ''} {menu_item.name}")
+
+                # Remember the first drink that still needs a size
+                if not size and menu_item.has_size and awaiting_size_item is None:
+                    awaiting_size_item = item_name
+
         # Create response text
         if not response_items:
             return create_response(
                 "I'm sorry, I didn't catch what items you wanted to order. Could you please repeat that?",
-                session_id
+                session
+            )
+
+        for order_item in new_items:
+            session.add(order_item)
+
+        # If a drink needs a size but none was specified
+        if awaiting_size_item:
+            size_context = [{
+                "name": request.context_name("awaiting-size"),
+                "lifespanCount": 2,
+                "parameters": {
+                    "item_name": awaiting_size_item,
+                    "item_type": "drink"
+                }
+            }]
+            return create_response(
+                f"What size would you like for your {awaiting_size_item}?",
+                session,
+                size_context
             )
             
         response_text = "Okay, I've added "
@@ -937,44 +1064,37 @@ def handle_order_combined(data: dict, session_id: str):
             response_text += ", ".join(response_items[:-1]) + f", and {response_items[-1]}"
         response_text += " to your order. Anything else?"
         
-        return create_response(response_text, session_id)
+        return create_response(response_text, session)
         
     except Exception as e:
         logger.error(f"Error in handle_order_combined: {str(e)}", exc_info=True)
         raise
 
-def handle_order_modify(data: dict, session_id: str):
+def handle_order_modify(request: WebhookRequest, session: Session):
     """Handles modifications to the last ordered item."""
     try:
         # Extract modification details
-        parameters = data["queryResult"]["parameters"]
-        modification_types = parameters.get("modification-type", [])
-        food_components = parameters.get("food-components", [])
+        modification_types = request.values("modification-type")
+        food_components = request.values("food-components")
 
         # Check if there's an active order
-        if not session_id in active_sessions or not active_sessions[session_id]["items"]:
+        if not session.items:
             return create_response(
                 "I don't see any active orders to modify. What would you like to order?",
-                session_id
+                session
             )
 
         # Get the last ordered item
-        last_item = active_sessions[session_id]["items"][-1]
+        last_item = session.items[-1]
         
         # Get the menu item details to validate modifications
-        menu_item = get_menu_item(last_item["name"])
+        menu_item = get_menu_item(last_item.name)
         if not menu_item:
             return create_response(
-                f"I'm sorry, I'm having trouble modifying your {last_item['name']}.",
-                session_id
+                f"I'm sorry, I'm having trouble modifying your {last_item.name}.",
+                session
             )
 
-        # Ensure modification_types and food_components are lists
-        if not isinstance(modification_types, list):
-            modification_types = [modification_types]
-        if not isinstance(food_components, list):
-            food_components = [food_components]
-
         # Process each new customization
         new_customizations = []
         for mod_type, component in zip(modification_types, food_components):
@@ -982,7 +1102,7 @@ def handle_order_modify(data: dict, session_id: str):
                 # Validate the customization
                 is_valid, message = validate_customization(menu_item, mod_type, component)
                 if not is_valid:
-                    return create_response(message, session_id)
+                    return create_response(message, session)
 
                 # Format customization based on type
                 if mod_type in ["no", "without"]:
@@ -992,93 +1112,75 @@ def handle_order_modify(data: dict, session_id: str):
                 elif mod_type in ["light", "heavy"]:
                     new_customizations.append(f"{mod_type} {component}")
 
-        # Add new customizations to existing ones
-        last_item["customizations"].extend(new_customizations)
+        # Add new customizations to existing ones, on a new line: lines in a cart are never changed
+        if new_customizations:
+            session.replace(len(session.items) - 1,
+                            last_item.with_customizations(last_item.customizations + tuple(new_customizations)))
 
         # Create response text
-        response_text = f"I've updated your {last_item['name']}"
+        response_text = f"I've updated your {last_item.name}"
         if new_customizations:
             response_text += f" with {', '.join(new_customizations)}"
         response_text += ". Would you like anything else?"
 
-        return create_response(response_text, session_id)
+        return create_response(response_text, session)
 
     except Exception as e:
         logger.error(f"Error in handle_order_modify: {str(e)}", exc_info=True)
         raise
 
-def handle_order_quantity(data: dict, session_id: str):
+def handle_order_quantity(request: WebhookRequest, session: Session):
     """Handles updating the quantity of the last ordered item."""
     try:
         # Extract new quantity
-        parameters = data["queryResult"]["parameters"]
-        new_quantity_param = parameters.get("number")
-        
-        try:
-            new_quantity = int(float(new_quantity_param))
-        except (ValueError, TypeError):
+        new_quantity = request.quantity(default=None)
+        if new_quantity is None:
             return create_response(
                 "I'm sorry, I didn't catch how many you wanted. Could you please repeat that?",
-                session_id
+                session
             )
 
         # Check if there's an active order
-        if not session_id in active_sessions or not active_sessions[session_id]["items"]:
+        if not session.items:
             return create_response(
                 "I don't see any active orders to modify. What would you like to order?",
-                session_id
+                session
             )
 
         # Get the last ordered item
-        last_item = active_sessions[session_id]["items"][-1]
-        
-        # Extract project_id from session name for validation context
-        project_id = data["session"].split('/')[1]
+        last_item = session.items[-1]
         
         # Validate the new quantity
         is_valid, validation_message, contexts = validate_order_quantity(
-            last_item["item_id"],
-            "food" if "size" not in last_item else "drink",
+            last_item.item_id,
+            "drink" if last_item.sized else "food",
             new_quantity,
-            session_id,
-            project_id
+            request
         )
         
         if not is_valid:
-            return create_response(validation_message, session_id, contexts)
+            return create_response(validation_message, session, contexts)
 
-        # Calculate old and new totals
-        old_total = last_item["item_total"]
-        
-        # Calculate new item total based on whether it's a drink with size or not
-        if "size" in last_item and "size_price" in last_item:
-            new_item_total = (last_item["base_price"] + last_item["size_price"]) * new_quantity
-        else:
-            new_item_total = last_item["base_price"] * new_quantity
-
-        # Update the session
-        last_item["quantity"] = new_quantity
-        last_item["item_total"] = new_item_total
-        active_sessions[session_id]["total_amount"] = (
-            active_sessions[session_id]["total_amount"] - old_total + new_item_total
-        )
+        # Update the session; the line total follows from its unit price
+        session.set_quantity(len(session.items) - 1, new_quantity)
 
         # Create response text
-        response_text = f"I've updated the quantity to {new_quantity} {last_item['name']}"
-        if "size" in last_item and last_item["size"]:
-            response_text = f"I've updated the quantity to {new_quantity} {last_item['size']} {last_item['name']}"
+        response_text = f"I've updated the quantity to {new_quantity} {last_item.name}"
+        if last_item.sized and last_item.size:
+            response_text = f"I've updated the quantity to {new_quantity} {last_item.size} {last_item.name}"
         
-        if last_item.get("customizations"):
-            response_text += f" with {', '.join(last_item['customizations'])}"
+        if last_item.customizations:
+            response_text += f" with {', '.join(last_item.customizations)}"
         response_text += ". Would you like anything else?"
 
-        return create_response(response_text, session_id)
+        return create_response(response_text, session)
 
     except Exception as e:
         logger.error(f"Error in handle_order_quantity: {str(e)}", exc_info=True)
         raise
 
-def validate_order_quantity(item_id: str, category: str, quantity: int, session_id: str, project_id: str):
+@tracing.traced("validate_order_quantity")
+def validate_order_quantity(item_id: str, category: str, quantity: int, request: WebhookRequest):
     """
     Validates if the order quantity is within acceptable limits.
     Returns (is_valid: bool, message: str, contexts: List[dict])
@@ -1087,35 +1189,27 @@ def validate_order_quantity(item_id: str, category: str, quantity: int, session_
     - item_id: str - The ID of the item being ordered
     - category: str - The category of the item ("food" or "drink")
     - quantity: int - The quantity being ordered
-    - session_id: str - The current session ID
-    - project_id: str - The Dialogflow project ID
+    - request: WebhookRequest - The current request, for naming the limit context
     """
     try:
-        # Get config document from Firestore
-        config_ref = db.collection('configs').document('order_limits')
-        config_doc = config_ref.get()
+        # Get cached order limits (kept current by a listener or TTL refresh)
+        limits = _store().order_limits_config.current()
         
-        if not config_doc.exists:
+        if limits is None:
             logger.warning("Order limits config not found, using default validation")
             return True, None, None
-            
-        config = config_doc.to_dict()
-        category_limits = config.get('order_limits', {}).get(category, {})
         
-        # Check item-specific limit first, then fall back to category default
-        max_quantity = (
-            category_limits.get('item_specific_limits', {}).get(item_id) or 
-            category_limits.get('default_max_quantity', 999)
-        )
+        # Item-specific limit, already resolved against the category default
+        max_quantity = limits.max_quantity(category, item_id)
         
         if quantity > max_quantity:
-            message = config.get('order_limits', {}).get('messages', {}).get('exceed_limit')
+            message = limits.exceed_message
             if not message:
                 message = f"For orders of {quantity} items, please visit our counter for special handling. How else can I help you?"
                 
             # Add output context for limit acknowledgment
             context = [{
-                "name": f"projects/{project_id}/agent/sessions/{session_id}/contexts/awaiting-limit-acknowledgment",
+                "name": request.context_name("awaiting-limit-acknowledgment"),
                 "lifespanCount": 1
             }]
             return False, message.format(quantity=quantity, item_name=item_id), context
@@ -1127,34 +1221,35 @@ def validate_order_quantity(item_id: str, category: str, quantity: int, session_
         # Fail safe - allow order to proceed if validation fails
         return True, None, None
     
-def handle_order_limit_acknowledge(data: dict, session_id: str):
+def handle_order_limit_acknowledge(request: WebhookRequest, session: Session):
     """Handles customer acknowledgment after receiving order limit message."""
     try:
         return create_response(
             "You're welcome!",
-            session_id
+            session
         )
     except Exception as e:
         logger.error(f"Error in handle_order_limit_acknowledge: {str(e)}", exc_info=True)
         raise
 
-def handle_order_complete_acknowledge(data: dict, session_id: str):
+def handle_order_complete_acknowledge(request: WebhookRequest, session: Session):
     """Handles customer acknowledgment after order completion."""
     try:
         return create_response(
             "You're welcome! Have a great day!",
-            session_id
+            session
         )
     except Exception as e:
         logger.error(f"Error in handle_order_complete_acknowledge: {str(e)}", exc_info=True)
         raise
 
-def validate_customization(menu_item: dict, mod_type: str, component: str) -> tuple[bool, str]:
+@tracing.traced("validate_customization")
+def validate_customization(menu_item: MenuItem, mod_type: str, component: str) -> tuple[bool, str]:
     """
     Validates if a customization is allowed for the menu item.
     
     Args:
-        menu_item: The menu item dictionary from Firestore
+        menu_item: The compiled menu item from the menu catalog
         mod_type: The type of modification requested (no, extra, light, heavy)
         component: The component to be modified
         
@@ -1163,22 +1258,20 @@ def validate_customization(menu_item: dict, mod_type: str, component: str) -> tu
     """
     try:
         # Check if item has customizations defined
-        if "customizations" not in menu_item:
-            return False, f"I'm sorry, {menu_item['name']} cannot be customized."
+        if not menu_item.customizable:
+            return False, f"I'm sorry, {menu_item.name} cannot be customized."
 
-        customizations = menu_item["customizations"]
-        
         # Validate based on modification type
         if mod_type in ["no", "without"]:
-            if component not in customizations.get("removable", []):
+            if component not in menu_item.removable:
                 return False, f"I'm sorry, we cannot remove {component} from this item."
                 
         elif mod_type in ["extra", "add"]:
-            if component not in customizations.get("addable", []):
+            if component not in menu_item.addable:
                 return False, f"I'm sorry, we cannot add extra {component} to this item."
                 
         elif mod_type in ["light", "heavy"]:
-            if component not in customizations.get("modifiable", []):
+            if component not in menu_item.modifiable:
                 return False, f"I'm sorry, we cannot modify the amount of {component}."
                 
         return True, "Valid customization"
@@ -1187,19 +1280,33 @@ def validate_customization(menu_item: dict, mod_type: str, component: str) -> tu
         logger.error(f"Error validating customization: {str(e)}")
         return False, "Sorry, there was an error processing your customization request."
     
-def format_item_description(item):
+def format_item_description(item: CartLine):
     """
     Formats an item description including customizations for the fulfillment text.
     """
-    description = f"{item['quantity']} {item['name']}"
+    description = f"{item.quantity} {item.name}"
     
     # Add size for drinks
-    if "size" in item:
-        description = f"{item['quantity']} {item['size']} {item['name']}"
+    if item.sized:
+        description = f"{item.quantity} {item.size} {item.name}"
     
     # Add customizations if present
-    if item.get("customizations"):
-        customization_text = ", ".join(item["customizations"])
+    if item.customizations:
+        customization_text = ", ".join(item.customizations)
         description += f" with {customization_text}"
     
-    return description
\ No newline at end of file
+    return description
+
+# Intent routing table, built once at import
+INTENT_HANDLERS = {
+    "order.food": handle_order_food,
+    "order.modify": handle_order_modify,
+    "order.drink": handle_order_drink,
+    "order.size": handle_size_update,
+    "order.remove": handle_order_remove,
+    "order.complete": handle_order_complete,
+    "order.combined": handle_order_combined,
+    "order.quantity": handle_order_quantity,
+    "order.limit.acknowledge": handle_order_limit_acknowledge,
+    "order.complete.acknowledge": handle_order_complete_acknowledge
+}
@@ -0,0 +1,155 @@
+import logging
+import os
+from operator import attrgetter
+
+from money import to_cents
+from name_index import NameIndex, load_entity_synonyms
+from snapshot_cache import SnapshotCache
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# How long a catalog loaded without a snapshot listener stays fresh
+MENU_CACHE_TTL_SECONDS = float(os.environ.get("MENU_CACHE_TTL_SECONDS", "300"))
+
+# Keep the catalog live through a snapshot listener when the data backend supports one
+MENU_CACHE_USE_LISTENER = os.environ.get("MENU_CACHE_USE_LISTENER", "true").lower() == "true"
+
+
+class MenuItem:
+    """
+    Compiled form of a menu_items document, shared read-only between requests.
+
+    Prices are integer cents and customization rules are frozensets, so
+    pricing a line and validating a customization are plain lookups.
+    """
+
+    __slots__ = ("id", "name", "category", "base_price_cents", "has_size", "size_prices",
+                 "customizable", "removable", "addable", "modifiable")
+
+    def __init__(self, item_id: str, name: str, category: str, base_price_cents: int, has_size: bool,
+                 size_prices: dict, customizations: dict = None):
+        self.id = item_id
+        self.name = name
+        self.category = category
+        self.base_price_cents = base_price_cents
+        self.has_size = has_size
+        self.size_prices = size_prices
+        # Items without a customizations map cannot be customized at all
+        self.customizable = customizations is not None
+        customizations = customizations or {}
+        self.removable = frozenset(customizations.get('removable', ()))
+        self.addable = frozenset(customizations.get('addable', ()))
+        self.modifiable = frozenset(customizations.get('modifiable', ()))
+
+    def size_price_cents(self, size: str) -> int:
+        """Surcharge for a size, in cents; 0 for unsized items, no size or an unknown size."""
+        if not self.has_size or not size:
+            return 0
+        return self.size_prices.get(size.lower(), 0)
+
+    def __repr__(self):
+        return f"MenuItem(id={self.id!r}, name={self.name!r}, base_price_cents={self.base_price_cents})"
+
+
+def compile_menu_item(doc_id: str, item_data: dict):
+    """
+    Compiles a raw menu_items document into a MenuItem.
+    Returns None if the document has no name or an unusable price.
+    """
+    if not item_data.get('name'):
+        logger.error(f"Menu item {doc_id} has no name")
+        return None
+
+    try:
+        base_price_cents = to_cents(item_data['base_price'])
+    except (KeyError, ValueError, TypeError):
+        logger.error(f"Invalid base_price format for {item_data.get('name', doc_id)}")
+        return None
+
+    has_size = bool(item_data.get('has_size', False))
+    size_prices = {}
+    if has_size:
+        try:
+            size_prices = {
+                size: to_cents(price)
+                for size, price in (item_data.get('sizes') or {}).items()
+            }
+        except (AttributeError, ValueError, TypeError):
+            logger.error(f"Invalid sizes format for {item_data['name']}")
+            return None
+
+    customizations = item_data.get('customizations')
+    return MenuItem(
+        doc_id,
+        item_data['name'],
+        item_data.get('category'),
+        base_price_cents,
+        has_size,
+        size_prices,
+        customizations if isinstance(customizations, dict) else None,
+    )
+
+
+class MenuCatalog(SnapshotCache):
+    """
+    Process-wide, read-only view of the menu_items collection.
+
+    The whole collection is loaded once, compiled into MenuItem objects and indexed by document ID and by a
+    NameIndex over item names and the Dialogflow entity synonyms, so lookups
+    never touch the MenuRepository.
+
+    Items returned by the catalog are shared between requests.
+    """
+
+    name = "Menu catalog"
+
+    def __init__(self, repository, ttl_seconds: float = MENU_CACHE_TTL_SECONDS,
+                 use_listener: bool = MENU_CACHE_USE_LISTENER):
+        super().__init__(ttl_seconds, use_listener)
+        self._repository = repository
+        self._synonyms = load_entity_synonyms()
+        # (name_index, by_id) is swapped as a single tuple so readers never
+        # see one index updated without the other
+        self._index = (NameIndex([]), {})
+
+    def get_by_name(self, item_name: str):
+        """
+        Returns the menu item a spoken name refers to, or None. Matches names
+        and synonyms regardless of case, spacing and plurals, then falls back
+        to a close spelling.
+        """
+        if not item_name:
+            return None
+        self.ensure_loaded()
+        return self._index[0].resolve(item_name)
+
+    def get_by_id(self, item_id: str):
+        """Returns the menu item with the given document ID, or None."""
+        self.ensure_loaded()
+        return self._index[1].get(item_id)
+
+    def items(self):
+        """Returns all menu items currently in the catalog."""
+        self.ensure_loaded()
+        return list(self._index[1].values())
+
+    def cached_state(self):
+        return self._index
+
+    def _listen(self, callback):
+        return self._repository.watch(callback)
+
+    def _fetch(self):
+        return self._repository.list_items()
+
+    def _apply(self, docs):
+        by_id = {}
+        for doc in docs:
+            menu_item = compile_menu_item(doc.id, doc.to_dict())
+            if menu_item is not None:
+                by_id[doc.id] = menu_item
+
+        # Names are indexed in document order, so the first of any duplicates wins
+        name_index = NameIndex(by_id.values(), self._synonyms, name_of=attrgetter("name"))
+        self._index = (name_index, by_id)
+        logger.info(f"Menu catalog indexed {len(by_id)} items under {len(name_index)} names")
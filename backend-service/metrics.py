@@ -0,0 +1,269 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# How often request handling also logs a dump of every metric, for
+# environments without a Prometheus scraper (0 disables the dump)
+METRICS_LOG_INTERVAL_SECONDS = float(os.environ.get("METRICS_LOG_INTERVAL_SECONDS", "300"))
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One slot per bucket plus the +Inf overflow; cumulated when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile, an estimate good to one bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class _Metric:
+    """A named metric with optional labels; labels(...) returns the child that records values."""
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Returns the child for these label values. Bind it once where the values are fixed."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Yields (suffix, label values, extra label text, value) for every sample."""
+        raise NotImplementedError
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_label_text(self.label_names, values, extra)} {_format_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def values(self) -> dict:
+        """Returns {label values tuple: count}."""
+        return {values: child.value for values, child in list(self._children.items())}
+
+    def _samples(self):
+        for values, value in self.values().items():
+            yield "", values, "", value
+
+    def snapshot(self):
+        return {",".join(values) or "value": value for values, value in self.values().items()}
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", values, f'le="{_format_number(bound)}"', cumulative
+            yield "_sum", values, "", child.sum
+            yield "_count", values, "", child.count
+
+    def snapshot(self):
+        return {
+            ",".join(values) or "value": {
+                "count": child.count,
+                "mean_ms": round(child.sum / child.count * 1000, 3) if child.count else 0.0,
+                "p50_ms": child.quantile(0.5) * 1000,
+                "p95_ms": child.quantile(0.95) * 1000,
+                "p99_ms": child.quantile(0.99) * 1000,
+            }
+            for values, child in list(self._children.items())
+        }
+
+
+class Gauge(_Metric):
+    """
+    A value read when metrics are collected. function returns a number, or
+    for labelled gauges a {label values tuple: number} dict, so nothing is
+    recorded on the request path at all.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._function = function
+
+    def _values(self) -> dict:
+        try:
+            value = self._function()
+        except Exception as e:
+            logger.warning(f"Could not read gauge {self.name}: {str(e)}")
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+
+    def _samples(self):
+        for values, value in self._values().items():
+            yield "", values, "", value
+
+    def snapshot(self):
+        return {",".join(values) or "value": value for values, value in self._values().items()}
+
+
+class MetricsRegistry:
+    """
+    Process-wide collection of metrics.
+
+    Metrics are created once, at import time of the module that records
+    them; recording on the request path is then a bisect and a locked
+    increment, well under a microsecond each.
+    """
+
+    def __init__(self, log_interval_seconds: float = METRICS_LOG_INTERVAL_SECONDS):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._log_interval_seconds = log_interval_seconds
+        self._next_log = time.monotonic() + log_interval_seconds
+
+    def _register(self, metric_type, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_type(name, *args, **kwargs)
+            elif not isinstance(metric, metric_type):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names=()) -> Counter:
+        return self._register(Counter, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, label_names, buckets)
+
+    def gauge(self, name: str, documentation: str, function, label_names=()) -> Gauge:
+        """Registers (or replaces the function of) a gauge."""
+        metric = self._register(Gauge, name, documentation, function, label_names)
+        metric._function = function
+        return metric
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Every metric as plain data, with histograms summarized as count, mean and quantiles."""
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+    def log_if_due(self):
+        """Logs a snapshot of every metric when the dump interval has passed; cheap to call per request."""
+        if self._log_interval_seconds <= 0 or time.monotonic() < self._next_log:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_log:
+                return
+            self._next_log = now + self._log_interval_seconds
+        logger.info("Metrics snapshot", extra={"metrics": self.snapshot()})
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, documentation: str, label_names=()) -> Counter:
+    return REGISTRY.counter(name, documentation, label_names)
+
+
+def histogram(name: str, documentation: str, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, documentation, label_names, buckets)
+
+
+def gauge(name: str, documentation: str, function, label_names=()) -> Gauge:
+    return REGISTRY.gauge(name, documentation, function, label_names)
@@ -0,0 +1,12 @@
+# Prices and totals are kept as integer cents, so cart arithmetic is exact;
+# they become float amounts only at the edges (payloads and stored documents).
+
+
+def to_cents(amount) -> int:
+    """Converts a price given as a number or numeric string (e.g. '5.99') to integer cents."""
+    return int(round(float(amount) * 100))
+
+
+def to_amount(cents: int) -> float:
+    """Converts integer cents back to the float amount stored in Firestore and sent to clients."""
+    return cents / 100
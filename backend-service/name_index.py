@@ -0,0 +1,230 @@
+import glob
+import json
+import logging
+import os
+import re
+from collections import Counter
+from operator import itemgetter
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Dialogflow entity exports whose synonyms name menu items
+ENTITIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dialogflow", "entities")
+MENU_ENTITY_FILES = ("food-item_entries_en.json", "drink-item_entries_en.json")
+
+# Upper bound on edits the fuzzy matcher accepts; shorter names allow fewer
+NAME_FUZZY_MAX_DISTANCE = int(os.environ.get("NAME_FUZZY_MAX_DISTANCE", "2"))
+
+# Fuzzy candidates are found through shared character trigrams
+NGRAM_SIZE = 3
+
+# Extra rare n-grams probed beyond the pigeonhole minimum, to prune candidates harder
+PROBE_EXTRA = 3
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_name(name: str) -> str:
+    """Case, spacing and punctuation-insensitive key: 'Big Mac' and 'big-mac' both become 'bigmac'."""
+    return _NON_ALNUM.sub("", name.lower())
+
+
+def singular_keys(key: str):
+    """Candidate singular forms of a normalized key, most likely first."""
+    if key.endswith("ies") and len(key) > 4:
+        yield key[:-3] + "y"
+    if key.endswith("es") and len(key) > 4:
+        yield key[:-2]
+    if key.endswith("s") and len(key) > 3:
+        yield key[:-1]
+
+
+def allowed_distance(key: str) -> int:
+    """Edit budget for a query: none for very short names, where typos collide with real words."""
+    if len(key) <= 4:
+        return 0
+    if len(key) <= 8:
+        return min(1, NAME_FUZZY_MAX_DISTANCE)
+    return NAME_FUZZY_MAX_DISTANCE
+
+
+def ngrams(key: str) -> set:
+    """Distinct padded character n-grams of a normalized key."""
+    padded = "^" * (NGRAM_SIZE - 1) + key + "$" * (NGRAM_SIZE - 1)
+    return {padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Levenshtein distance between a and b, computed only inside a band of
+    width 2 * limit + 1. Returns limit + 1 as soon as the distance is known
+    to exceed limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    # A typo only disturbs a small window; the shared prefix and suffix cost nothing
+    start = 0
+    shortest = min(len(a), len(b))
+    while start < shortest and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < shortest - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+
+    if len(a) > len(b):
+        a, b = b, a
+
+    over = limit + 1
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        lo = max(1, i - limit)
+        hi = min(len(b), i + limit)
+        current = [over] * (len(b) + 1)
+        current[0] = i if i <= limit else over
+        ca = a[i - 1]
+        row_min = current[0]
+        for j in range(lo, hi + 1):
+            cost = 0 if ca == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return over
+        previous = current
+    return min(previous[len(b)], over)
+
+
+def load_entity_synonyms(entities_dir: str = ENTITIES_DIR) -> dict:
+    """Returns {synonym: canonical entity value} from the Dialogflow menu entity exports."""
+    synonyms = {}
+    for file_name in MENU_ENTITY_FILES:
+        for path in glob.glob(os.path.join(entities_dir, file_name)):
+            try:
+                with open(path) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Error reading entity synonyms from {path}: {str(e)}")
+                continue
+            for entry in entries:
+                value = entry.get("value")
+                if not value:
+                    continue
+                for synonym in [value] + entry.get("synonyms", []):
+                    synonyms.setdefault(synonym, value)
+    return synonyms
+
+
+class NameIndex:
+    """
+    Maps what a customer said to a canonical menu item. Items can be any
+    objects; name_of extracts each one's menu name.
+
+    Built once per menu load: every menu name and every Dialogflow synonym is
+    reduced to a normalized key in a single dict, so exact and synonym hits
+    are one lookup. Misses try singular forms, then a precomputed trigram
+    index. A key within d edits of the query shares all but at most 3 * d of
+    the query's trigrams, so it must appear in the posting list of at least
+    one of the query's 3 * d + 1 rarest trigrams (a few more are probed to
+    prune harder). Posting lists are split by
+    key length, so only keys within d characters of the query's length are
+    read at all. Candidates are filtered by shared-trigram count and finally
+    confirmed with a banded edit distance, which keeps typo lookups well
+    under a millisecond on menus of thousands of items.
+    """
+
+    def __init__(self, items, synonyms: dict = None, name_of=itemgetter("name")):
+        self._name_of = name_of
+        self._exact = {}
+        for item in items:
+            self._exact.setdefault(normalize_name(name_of(item)), item)
+
+        # Synonyms never shadow a real menu name, and only count if their
+        # canonical value names something on the menu
+        for synonym, canonical in (synonyms or {}).items():
+            item = self._exact.get(normalize_name(canonical))
+            if item is not None:
+                self._exact.setdefault(normalize_name(synonym), item)
+
+        self._keys = list(self._exact)
+        self._key_grams = [ngrams(key) for key in self._keys]
+        # (gram, key length) -> ids of keys of that length containing gram
+        self._postings = {}
+        for key_id, grams in enumerate(self._key_grams):
+            length = len(self._keys[key_id])
+            for gram in grams:
+                self._postings.setdefault((gram, length), []).append(key_id)
+
+    def __len__(self):
+        return len(self._exact)
+
+    def resolve(self, name: str):
+        """Returns the menu item best matching name, or None."""
+        if not name:
+            return None
+        key = normalize_name(name)
+        if not key:
+            return None
+
+        item = self._exact.get(key)
+        if item is not None:
+            return item
+
+        for singular in singular_keys(key):
+            item = self._exact.get(singular)
+            if item is not None:
+                return item
+
+        match = self._closest(key)
+        if match is not None:
+            logger.info(f"Fuzzy matched '{name}' to '{self._name_of(self._exact[match])}'")
+            return self._exact[match]
+        return None
+
+    def _closest(self, key: str):
+        limit = allowed_distance(key)
+        if limit == 0:
+            return None
+
+        query_grams = ngrams(key)
+        # Each edit can destroy at most NGRAM_SIZE of the query's n-grams
+        needed = len(query_grams) - NGRAM_SIZE * limit
+        if needed < 1:
+            return None
+
+        # A match misses at most NGRAM_SIZE * limit query n-grams, so counting
+        # hits in the posting lists of just the rarest few finds every match
+        lengths = range(len(key) - limit, len(key) + limit + 1)
+        postings = sorted(
+            (
+                [self._postings[(gram, length)] for length in lengths if (gram, length) in self._postings]
+                for gram in query_grams
+            ),
+            key=lambda lists: sum(map(len, lists)),
+        )
+        probed = min(len(postings), NGRAM_SIZE * limit + 1 + PROBE_EXTRA)
+        hits = Counter()
+        for lists in postings[:probed]:
+            for posting in lists:
+                hits.update(posting)
+        # Of the probed n-grams, a match can be missing at most NGRAM_SIZE * limit
+        required = probed - NGRAM_SIZE * limit
+
+        best_key = None
+        best_distance = limit + 1
+        for key_id, count in hits.items():
+            if count < required:
+                continue
+            candidate = self._keys[key_id]
+            if len(query_grams & self._key_grams[key_id]) < needed:
+                continue
+            distance = edit_distance(key, candidate, limit)
+            if distance > limit:
+                continue
+            # Ties go to the alphabetically first key so results are stable
+            if distance < best_distance or (distance == best_distance and candidate < best_key):
+                best_key, best_distance = candidate, distance
+        return best_key
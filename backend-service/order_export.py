@@ -0,0 +1,290 @@
+import logging
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import fast_json
+from money import to_cents
+from repositories import decode_document, encode_document
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Orders read per query page; each page is written out before the next is read
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "500"))
+
+# Orders per output file before the export moves on to the next part
+EXPORT_ROWS_PER_FILE = int(os.environ.get("EXPORT_ROWS_PER_FILE", "100000"))
+
+# Orders created less than this long ago are left for the next run, so an
+# order still waiting in the write-behind queue is not skipped by the cursor
+EXPORT_SETTLE_SECONDS = float(os.environ.get("EXPORT_SETTLE_SECONDS", "60"))
+
+FORMATS = ("ndjson", "parquet")
+
+
+def _timestamp(value):
+    """An order timestamp as a UTC ISO 8601 string; naive times are taken as UTC."""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat()
+    return value
+
+
+def _cents(amount):
+    """A stored float amount as integer cents, so exported money adds up exactly."""
+    return to_cents(amount) if amount is not None else None
+
+
+def _aware(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def order_row(order: dict) -> dict:
+    """One row of the orders table: the order without its line items."""
+    items = order.get("items", [])
+    return {
+        "id": order.get("id"),
+        "session_id": order.get("session_id"),
+        "store_id": order.get("store_id"),
+        "status": order.get("status"),
+        "created_at": _timestamp(order.get("created_at")),
+        "completed_at": _timestamp(order.get("completed_at")),
+        "total_cents": _cents(order.get("total_amount")),
+        "line_count": len(items),
+        "item_count": sum(int(item.get("quantity", 0)) for item in items),
+    }
+
+
+def line_item_rows(order: dict) -> list:
+    """Rows of the order_items table: the order's nested items, one per line, keyed by order ID."""
+    created_at = _timestamp(order.get("created_at"))
+    return [
+        {
+            "order_id": order.get("id"),
+            "line_number": line_number,
+            "item_id": item.get("item_id"),
+            "name": item.get("name"),
+            "quantity": item.get("quantity"),
+            "base_price_cents": _cents(item.get("base_price")),
+            "size": item.get("size"),
+            "size_price_cents": _cents(item.get("size_price")),
+            "item_total_cents": _cents(item.get("item_total")),
+            "customizations": list(item.get("customizations", [])),
+            "created_at": created_at,
+        }
+        for line_number, item in enumerate(order.get("items", []), start=1)
+    ]
+
+
+class NDJSONWriter:
+    """Writes rows as newline-delimited JSON, one object per line."""
+
+    extension = "ndjson"
+
+    def __init__(self, path: str, table: str):
+        self._file = open(path, "wb")
+
+    def write(self, rows: list):
+        self._file.write(b"".join(fast_json.dumps(row) + b"\n" for row in rows))
+
+    def close(self):
+        self._file.close()
+
+
+def _parquet_schemas(pa) -> dict:
+    timestamp = pa.timestamp("us", tz="UTC")
+    return {
+        "orders": pa.schema([
+            ("id", pa.string()), ("session_id", pa.string()), ("store_id", pa.string()), ("status", pa.string()),
+            ("created_at", timestamp), ("completed_at", timestamp), ("total_cents", pa.int64()),
+            ("line_count", pa.int32()), ("item_count", pa.int32()),
+        ]),
+        "order_items": pa.schema([
+            ("order_id", pa.string()), ("line_number", pa.int32()), ("item_id", pa.string()),
+            ("name", pa.string()), ("quantity", pa.int32()), ("base_price_cents", pa.int64()),
+            ("size", pa.string()), ("size_price_cents", pa.int64()), ("item_total_cents", pa.int64()),
+            ("customizations", pa.list_(pa.string())), ("created_at", timestamp),
+        ]),
+    }
+
+
+class ParquetWriter:
+    """
+    Writes rows to a Parquet file with pyarrow, one row group per page, so
+    only the page being written is held in memory.
+    """
+
+    extension = "parquet"
+
+    def __init__(self, path: str, table: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow: pip install -r requirements-export.txt") from None
+        self._pa = pa
+        self._schema = _parquet_schemas(pa)[table]
+        self._writer = pq.ParquetWriter(path, self._schema, compression="snappy")
+
+    def write(self, rows: list):
+        columns = {field.name: [row[field.name] for row in rows] for field in self._schema}
+        for field in self._schema:
+            # Parquet timestamps are typed; the rows carry ISO strings for NDJSON
+            if self._pa.types.is_timestamp(field.type):
+                columns[field.name] = [
+                    datetime.fromisoformat(value) if value else None for value in columns[field.name]
+                ]
+        self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {"ndjson": NDJSONWriter, "parquet": ParquetWriter}
+
+
+class _Part:
+    """One numbered part of the export: an orders and an order_items file per format."""
+
+    def __init__(self, out_dir: str, number: int, formats):
+        self.paths = []
+        self._writers = []
+        for table in ("orders", "order_items"):
+            for fmt in formats:
+                path = os.path.join(out_dir, f"{table}-{number:05d}.{WRITERS[fmt].extension}")
+                # Written under a temporary name and renamed when complete, so a
+                # file under its final name is always whole
+                self._writers.append((table, WRITERS[fmt](path + ".tmp", table), path))
+        self.orders = 0
+
+    def write(self, orders: list, items: list):
+        for table, writer, _ in self._writers:
+            rows = orders if table == "orders" else items
+            if rows:
+                writer.write(rows)
+        self.orders += len(orders)
+
+    def close(self) -> list:
+        for _, writer, path in self._writers:
+            writer.close()
+            os.replace(path + ".tmp", path)
+            self.paths.append(path)
+        return self.paths
+
+
+def load_cursor(path: str) -> dict:
+    """The state saved by the last export to path, or a fresh one."""
+    if path and os.path.exists(path):
+        with open(path) as handle:
+            return decode_document(handle.read())
+    return {"after": None, "part": 0, "orders": 0, "line_items": 0}
+
+
+def save_cursor(path: str, state: dict):
+    # Replaced atomically: a crash leaves the previous cursor, never half of one
+    with open(path + ".tmp", "w") as handle:
+        handle.write(encode_document(state))
+    os.replace(path + ".tmp", path)
+
+
+def export_orders(repository, out_dir: str, formats=("ndjson",), cursor_path: str = None,
+                  page_size: int = EXPORT_PAGE_SIZE, rows_per_file: int = EXPORT_ROWS_PER_FILE,
+                  settle_seconds: float = EXPORT_SETTLE_SECONDS) -> dict:
+    """
+    Exports the orders collection to out_dir as an orders table and an
+    order_items table (the nested items flattened, one row per line), in
+    each of formats. Orders are read page by page with query cursors ordered
+    by created_at, and each page is written out before the next is read, so
+    memory stays flat however many orders there are.
+
+    With cursor_path, the export resumes after the last order the previous
+    run exported and saves its progress each time a part is completed; a
+    run that dies mid-part redoes that part. Returns run statistics.
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown export formats: {', '.join(sorted(unknown))}")
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_cursor(cursor_path)
+    after = (state["after"]["created_at"], state["after"]["id"]) if state["after"] else None
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=settle_seconds)
+
+    stats = {"orders": 0, "line_items": 0, "files": [], "started": time.perf_counter()}
+    part = None
+
+    def finish_part():
+        stats["files"].extend(part.close())
+        state["part"] += 1
+        if cursor_path:
+            save_cursor(cursor_path, state)
+
+    while True:
+        orders = repository.page_orders(after, page_size)
+        settled = [order for order in orders if _aware(order["created_at"]) <= cutoff]
+        if not settled:
+            break
+        order_rows = []
+        item_rows = []
+        for order in settled:
+            order_rows.append(order_row(order))
+            item_rows.extend(line_item_rows(order))
+        if part is None:
+            part = _Part(out_dir, state["part"], formats)
+        part.write(order_rows, item_rows)
+
+        last = settled[-1]
+        after = (last["created_at"], last["id"])
+        state["after"] = {"created_at": last["created_at"], "id": last["id"]}
+        state["orders"] += len(order_rows)
+        state["line_items"] += len(item_rows)
+        stats["orders"] += len(order_rows)
+        stats["line_items"] += len(item_rows)
+
+        if part.orders >= rows_per_file:
+            finish_part()
+            part = None
+        if len(settled) < len(orders) or len(orders) < page_size:
+            break
+
+    if part is not None:
+        finish_part()
+    stats["seconds"] = time.perf_counter() - stats.pop("started")
+    stats["bytes"] = sum(os.path.getsize(path) for path in stats["files"])
+    return stats
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+if __name__ == "__main__":
+    # Export orders for analytics, e.g. nightly:
+    #   python order_export.py --out-dir exports/ --format ndjson,parquet --cursor-file exports/cursor.json
+    # Each run picks up after the last order the previous one exported.
+    import argparse
+    import main
+
+    parser = argparse.ArgumentParser(description="Export orders to NDJSON and Parquet")
+    parser.add_argument("--out-dir", required=True, help="directory the part files are written to")
+    parser.add_argument("--format", default="ndjson", help=f"comma-separated, of: {', '.join(FORMATS)}")
+    parser.add_argument("--cursor-file", default=None, help="resume from and save progress to this file")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    parser.add_argument("--rows-per-file", type=int, default=EXPORT_ROWS_PER_FILE)
+    parser.add_argument("--settle-seconds", type=float, default=EXPORT_SETTLE_SECONDS)
+    args = parser.parse_args()
+
+    stats = export_orders(
+        main.order_repository, args.out_dir, formats=args.format.split(","), cursor_path=args.cursor_file,
+        page_size=args.page_size, rows_per_file=args.rows_per_file, settle_seconds=args.settle_seconds,
+    )
+    seconds = max(stats["seconds"], 1e-9)
+    logger.info(
+        f"Exported {stats['orders']} orders and {stats['line_items']} line items to {len(stats['files'])} files "
+        f"({stats['bytes'] / 1e6:.1f} MB) in {seconds:.1f}s: {stats['orders'] / seconds:.0f} orders/s, "
+        f"{stats['line_items'] / seconds:.0f} line items/s, peak RSS {peak_rss_mb():.0f} MB"
+    )
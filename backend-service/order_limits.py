@@ -0,0 +1,90 @@
+import logging
+import os
+
+from snapshot_cache import SnapshotCache
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# How long limits loaded without a snapshot listener stay fresh
+ORDER_LIMITS_TTL_SECONDS = float(os.environ.get("ORDER_LIMITS_TTL_SECONDS", "60"))
+
+# Keep the limits live through a snapshot listener when the data backend supports one
+ORDER_LIMITS_USE_LISTENER = os.environ.get("ORDER_LIMITS_USE_LISTENER", "true").lower() == "true"
+
+# Limit applied when neither the item nor its category defines one
+DEFAULT_MAX_QUANTITY = 999
+
+
+class OrderLimits:
+    """
+    Parsed form of the configs/order_limits document.
+
+    Every per-item limit is resolved against its category default up front,
+    so max_quantity is a single dict lookup.
+    """
+
+    __slots__ = ("category_defaults", "item_limits", "exceed_message")
+
+    def __init__(self, config: dict):
+        order_limits = config.get('order_limits', {})
+
+        self.category_defaults = {}
+        self.item_limits = {}
+        for category, category_limits in order_limits.items():
+            if category == 'messages' or not isinstance(category_limits, dict):
+                continue
+            default = category_limits.get('default_max_quantity', DEFAULT_MAX_QUANTITY)
+            self.category_defaults[category] = default
+            for item_id, limit in category_limits.get('item_specific_limits', {}).items():
+                # A zero or empty item limit falls back to the category default
+                self.item_limits[(category, item_id)] = limit or default
+
+        self.exceed_message = order_limits.get('messages', {}).get('exceed_limit')
+
+    def max_quantity(self, category: str, item_id: str):
+        """Returns the maximum quantity allowed for an item in a single order line."""
+        limit = self.item_limits.get((category, item_id))
+        if limit is not None:
+            return limit
+        return self.category_defaults.get(category, DEFAULT_MAX_QUANTITY)
+
+
+class OrderLimitsConfig(SnapshotCache):
+    """
+    Process-wide cache of configs/order_limits.
+
+    current() returns None while the document does not exist, so callers can
+    keep failing open exactly as they did when reading Firestore directly.
+    """
+
+    name = "Order limits config"
+
+    def __init__(self, repository, ttl_seconds: float = ORDER_LIMITS_TTL_SECONDS,
+                 use_listener: bool = ORDER_LIMITS_USE_LISTENER):
+        super().__init__(ttl_seconds, use_listener)
+        self._repository = repository
+        self._limits = None
+
+    def current(self):
+        """Returns the current OrderLimits, or None if the config is missing."""
+        self.ensure_loaded()
+        return self._limits
+
+    def cached_state(self):
+        return self._limits
+
+    def _listen(self, callback):
+        return self._repository.watch_config('order_limits', callback)
+
+    def _fetch(self):
+        return [self._repository.get_config('order_limits')]
+
+    def _apply(self, docs):
+        doc = docs[0] if docs else None
+        if doc is None or not doc.exists:
+            self._limits = None
+            logger.warning("Order limits config not found, orders will not be limited")
+            return
+
+        self._limits = OrderLimits(doc.to_dict() or {})
+        logger.info(f"Order limits config loaded for categories: {sorted(self._limits.category_defaults)}")
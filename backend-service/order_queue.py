@@ -0,0 +1,360 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from repositories import decode_document, encode_document
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Local journal holding orders until they reach Firestore. On Cloud Functions
+# /tmp is instance memory, so point this at a mounted volume for durability
+# across instance loss; it always survives a process crash or redeploy of the
+# worker on the same disk.
+ORDER_JOURNAL_PATH = os.environ.get("ORDER_JOURNAL_PATH", "/tmp/vos-order-journal.sqlite3")
+
+# Orders per WriteBatch commit (Firestore allows at most 500 writes per batch)
+ORDER_FLUSH_BATCH_SIZE = int(os.environ.get("ORDER_FLUSH_BATCH_SIZE", "100"))
+
+# Retry backoff for failed commits: base * 2^attempts, capped
+ORDER_RETRY_BASE_SECONDS = float(os.environ.get("ORDER_RETRY_BASE_SECONDS", "0.5"))
+ORDER_RETRY_MAX_SECONDS = float(os.environ.get("ORDER_RETRY_MAX_SECONDS", "60"))
+
+# Log loudly once an order has failed this many times; it is still retried
+ORDER_RETRY_ALERT_ATTEMPTS = 10
+
+# An order that has failed this many times, written on its own, is moved to
+# the journal's failed_orders table instead of being retried forever
+ORDER_DEAD_LETTER_ATTEMPTS = int(os.environ.get("ORDER_DEAD_LETTER_ATTEMPTS", "30"))
+
+# After a batch fails its orders are written one at a time, to get the good
+# ones past a bad one; this many failures in a row mean the backend itself is
+# failing, and the rest of the batch waits for the next retry
+ORDER_SINGLE_RETRY_FAILURES = 3
+
+
+class OrderJournal:
+    """
+    Append-only SQLite journal of orders waiting to be written to Firestore.
+    Rows are removed only after the batch containing them has committed.
+    Orders that keep failing are moved to a failed_orders table, where they
+    wait for requeue_failed().
+    """
+
+    def __init__(self, path: str = ORDER_JOURNAL_PATH):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending_orders ("
+                "order_id TEXT PRIMARY KEY, "
+                "payload TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "enqueued_at REAL NOT NULL, "
+                "next_attempt_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS failed_orders ("
+                "order_id TEXT PRIMARY KEY, "
+                "payload TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL, "
+                "error TEXT NOT NULL, "
+                "failed_at REAL NOT NULL)"
+            )
+
+    def append(self, order_id: str, order_data: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending_orders (order_id, payload, enqueued_at, next_attempt_at) "
+                "VALUES (?, ?, ?, ?)",
+                (order_id, encode_document(order_data), now, now),
+            )
+
+    def due(self, limit: int):
+        """Returns up to limit (order_id, order_data, attempts) rows ready to be written."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT order_id, payload, attempts FROM pending_orders "
+                "WHERE next_attempt_at <= ? ORDER BY enqueued_at LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+        return [(order_id, decode_document(payload), attempts) for order_id, payload, attempts in rows]
+
+    def remove(self, order_ids):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM pending_orders WHERE order_id = ?", [(order_id,) for order_id in order_ids]
+            )
+
+    def defer(self, order_ids, delay_seconds: float):
+        """Records a failed attempt and schedules the next one."""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE pending_orders SET attempts = attempts + 1, next_attempt_at = ? WHERE order_id = ?",
+                [(time.time() + delay_seconds, order_id) for order_id in order_ids],
+            )
+
+    def dead_letter(self, order_id: str, attempts: int, error: str):
+        """Moves an order that keeps failing out of the pending orders."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO failed_orders (order_id, payload, attempts, error, failed_at) "
+                    "SELECT order_id, payload, ?, ?, ? FROM pending_orders WHERE order_id = ?",
+                    (attempts, error, time.time(), order_id),
+                )
+                self._conn.execute("DELETE FROM pending_orders WHERE order_id = ?", (order_id,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def requeue_failed(self) -> int:
+        """Moves every failed order back to the pending orders, due now; returns how many."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                moved = self._conn.execute(
+                    "INSERT OR REPLACE INTO pending_orders (order_id, payload, enqueued_at, next_attempt_at) "
+                    "SELECT order_id, payload, ?, ? FROM failed_orders",
+                    (now, now),
+                ).rowcount
+                self._conn.execute("DELETE FROM failed_orders")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return moved
+
+    def failed_depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM failed_orders").fetchone()[0]
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pending_orders").fetchone()[0]
+
+    def oldest_age_seconds(self) -> float:
+        with self._lock:
+            oldest = self._conn.execute("SELECT MIN(enqueued_at) FROM pending_orders").fetchone()[0]
+        return time.time() - oldest if oldest is not None else 0.0
+
+    def next_attempt_in(self) -> float:
+        """Seconds until the earliest pending order is due, or None if empty."""
+        with self._lock:
+            earliest = self._conn.execute("SELECT MIN(next_attempt_at) FROM pending_orders").fetchone()[0]
+        return max(0.0, earliest - time.time()) if earliest is not None else None
+
+
+class OrderWriter:
+    """
+    Write-behind persistence for the orders collection.
+
+    enqueue() journals the order locally and returns at once; a background
+    thread flushes journaled orders through the OrderRepository in batched
+    writes. Document IDs are
+    assigned before enqueue time, so a batch retried after an ambiguous
+    failure overwrites the same documents instead of duplicating them. After
+    a batch fails its orders are written one at a time, so one bad order
+    cannot hold up the rest; each failed order is retried with capped
+    exponential backoff, and moved to the journal's failed orders once it
+    has failed dead_letter_attempts times.
+
+    on_written(orders), if given, runs after every batch is written (e.g. to
+    update rollups). If it raises, the batch is retried as a whole, and a
+    batch is replayed whenever its outcome is unknown, so on_written must
+    tolerate orders it has already seen.
+    """
+
+    def __init__(self, repository, journal: OrderJournal = None, batch_size: int = ORDER_FLUSH_BATCH_SIZE,
+                 on_written=None, dead_letter_attempts: int = ORDER_DEAD_LETTER_ATTEMPTS):
+        self._repository = repository
+        self._on_written = on_written
+        self._journal = journal if journal is not None else OrderJournal()
+        self._batch_size = batch_size
+        self._dead_letter_attempts = dead_letter_attempts
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        # Held while journaling an order and while deciding to go idle, so
+        # the writer never reports idle with an order just enqueued
+        self._idle_lock = threading.Lock()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+        self.flushed = 0
+        self.retries = 0
+        self.failed_batches = 0
+        self.last_flush_latency_ms = 0.0
+        self.max_flush_latency_ms = 0.0
+
+        # Pick up orders left over from a previous process
+        if self._journal.depth():
+            logger.info(f"Order journal has {self._journal.depth()} pending orders from a previous run")
+            self._start()
+
+    @staticmethod
+    def new_order_id() -> str:
+        return uuid.uuid4().hex[:20]
+
+    @staticmethod
+    def order_id_for(session_id: str, response_id: str) -> str:
+        """
+        The order ID of the turn that completes an order, the same for every
+        retry of that turn, so an order saved by a turn that then failed is
+        overwritten rather than duplicated when Dialogflow retries it.
+        """
+        if not response_id:
+            return OrderWriter.new_order_id()
+        return hashlib.sha256(f"{session_id}\n{response_id}".encode()).hexdigest()[:20]
+
+    def enqueue(self, order_data: dict):
+        """Journals an order (which must carry its 'id') and schedules it for writing."""
+        with self._idle_lock:
+            self._journal.append(order_data["id"], order_data)
+            self._idle.clear()
+        self._start()
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._journal.depth(),
+            "oldest_pending_age_seconds": self._journal.oldest_age_seconds(),
+            "flushed": self.flushed,
+            "retries": self.retries,
+            "failed_batches": self.failed_batches,
+            "failed_orders": self._journal.failed_depth(),
+            "last_flush_latency_ms": self.last_flush_latency_ms,
+            "max_flush_latency_ms": self.max_flush_latency_ms,
+        }
+
+    def requeue_failed(self) -> int:
+        """Schedules the orders given up on for writing again; returns how many."""
+        moved = self._journal.requeue_failed()
+        if moved:
+            with self._idle_lock:
+                self._idle.clear()
+            self._start()
+            self._wakeup.set()
+        return moved
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits until every due order has been written; returns False on timeout."""
+        if not self._journal.depth():
+            return True
+        self._start()
+        self._wakeup.set()
+        return self._idle.wait(timeout)
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="order-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            # Cleared before looking for work, so an enqueue() from here on wakes the wait below
+            self._wakeup.clear()
+            try:
+                wrote = self._flush_once()
+            except Exception as e:
+                logger.error(f"Order writer error: {str(e)}", exc_info=True)
+                wrote = False
+            if wrote:
+                continue
+
+            # Nothing due: sleep until the next retry is due or new work arrives
+            with self._idle_lock:
+                wait = self._journal.next_attempt_in()
+                if wait is None:
+                    self._idle.set()
+            self._wakeup.wait(wait)
+
+    def _write(self, orders: list):
+        self._repository.save_orders(orders)
+        if self._on_written is not None:
+            self._on_written(orders)
+
+    def _flush_once(self) -> bool:
+        """Commits one batch of due orders; returns True if anything was written."""
+        pending = self._journal.due(self._batch_size)
+        if not pending:
+            return False
+
+        order_ids = [order_id for order_id, _, _ in pending]
+        started = time.monotonic()
+        try:
+            self._write([order_data for _, order_data, _ in pending])
+        except Exception as e:
+            self.failed_batches += 1
+            if len(pending) == 1:
+                self._failed(pending, e)
+                return False
+            logger.warning(f"Failed to write a batch of {len(pending)} orders, writing them one at a time: {str(e)}")
+            return self._write_singly(pending)
+
+        latency_ms = (time.monotonic() - started) * 1000
+        self._journal.remove(order_ids)
+        self.flushed += len(order_ids)
+        self.last_flush_latency_ms = latency_ms
+        self.max_flush_latency_ms = max(self.max_flush_latency_ms, latency_ms)
+        logger.info(f"Wrote {len(order_ids)} orders in {latency_ms:.1f}ms")
+        return True
+
+    def _write_singly(self, pending: list) -> bool:
+        """Writes a failed batch order by order; returns True if any was written."""
+        wrote = False
+        failures = 0
+        for index, row in enumerate(pending):
+            try:
+                self._write([row[1]])
+            except Exception as e:
+                self._failed([row], e)
+                failures += 1
+                if failures >= ORDER_SINGLE_RETRY_FAILURES and not wrote:
+                    self._failed(pending[index + 1:], e)
+                    break
+                continue
+            self._journal.remove([row[0]])
+            self.flushed += 1
+            wrote = True
+        return wrote
+
+    def _failed(self, pending: list, error: Exception):
+        """Schedules the retry of orders whose write failed, or gives up on those failing alone too often."""
+        if not pending:
+            return
+        attempts = max(attempts for _, _, attempts in pending) + 1
+        if len(pending) == 1 and attempts >= self._dead_letter_attempts:
+            order_id = pending[0][0]
+            self._journal.dead_letter(order_id, attempts, str(error))
+            logger.error(f"Gave up on order {order_id} after {attempts} attempts, moved to failed orders: {str(error)}")
+            return
+        delay = min(ORDER_RETRY_MAX_SECONDS, ORDER_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+        self._journal.defer([order_id for order_id, _, _ in pending], delay)
+        self.retries += len(pending)
+        log = logger.error if attempts >= ORDER_RETRY_ALERT_ATTEMPTS else logger.warning
+        log(f"Failed to write {len(pending)} orders (attempt {attempts}), retrying in {delay:.1f}s: {str(error)}")
+
+
+if __name__ == "__main__":
+    # Write the orders given up on again, e.g. once what made them fail is fixed:
+    #   python order_queue.py requeue
+    import argparse
+    import main
+
+    parser = argparse.ArgumentParser(description="Order journal maintenance")
+    parser.add_argument("command", choices=["requeue"])
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the writes")
+    args = parser.parse_args()
+
+    moved = main.order_writer.requeue_failed()
+    written = main.order_writer.flush(args.timeout)
+    logger.info(f"Requeued {moved} failed orders; {'all written' if written else 'still writing'}")
@@ -0,0 +1,891 @@
+import copy
+import heapq
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+import metrics
+import tracing
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Where the menu_items, configs and orders collections live: "firestore",
+# "memory" or "sqlite". The latter two are seeded from firestore/*.json and
+# let the service run and be load-tested without Firebase.
+DATA_BACKEND = os.environ.get("DATA_BACKEND", "firestore").lower()
+
+# Database file for the sqlite backend
+DATA_SQLITE_PATH = os.environ.get("DATA_SQLITE_PATH", "/tmp/vos-data.sqlite3")
+
+# Collection schemas with example documents, as documented in the repo
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "firestore")
+
+# Firestore accepts at most 500 writes per WriteBatch
+FIRESTORE_MAX_BATCH_WRITES = 500
+
+# The schema files annotate examples with // comments, which JSON does not allow
+_LINE_COMMENT = re.compile(r'^((?:[^"\n/]|"(?:\\.|[^"\\\n])*"|/(?!/))*)//.*$', re.MULTILINE)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot store value of type {type(value).__name__}")
+
+
+def _decode_object(obj):
+    if "__datetime__" in obj and len(obj) == 1:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def encode_document(data: dict) -> str:
+    """JSON-encodes a document, keeping datetimes (e.g. order timestamps) round-trippable."""
+    return json.dumps(data, default=_encode_value, separators=(",", ":"))
+
+
+def decode_document(raw: str) -> dict:
+    return json.loads(raw, object_hook=_decode_object)
+
+
+def _is_increment(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def apply_increments(document: dict, deltas: dict) -> dict:
+    """Adds the numeric fields of deltas to document, merging nested maps; other fields are set."""
+    for key, value in deltas.items():
+        current = document.get(key)
+        if isinstance(value, dict):
+            document[key] = apply_increments(current if isinstance(current, dict) else {}, value)
+        elif _is_increment(value):
+            document[key] = (current if _is_increment(current) else 0) + value
+        else:
+            document[key] = value
+    return document
+
+
+def _order_key(value):
+    """Sort key for a field value in page(): values of one type compare among themselves, like Firestore."""
+    if isinstance(value, bool):
+        return (0, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, datetime):
+        return (2, (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp())
+    if isinstance(value, str):
+        return (3, value)
+    return (4, str(value))
+
+
+class SnapshotDocument:
+    """
+    Stands in for a Firestore DocumentSnapshot outside Firestore: documents
+    read from the in-memory and SQLite backends or restored from a warm
+    snapshot file.
+    """
+
+    __slots__ = ("id", "_data")
+
+    def __init__(self, doc_id: str, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+def load_schema_examples(schemas_dir: str = SCHEMAS_DIR) -> dict:
+    """
+    Returns {collection: {doc_id: document}} from the example documents in
+    the schema files. Orders are left out: the local backends start with
+    reference data only.
+    """
+    examples = {}
+    for file_name in ("menu_items.json", "configs.json"):
+        path = os.path.join(schemas_dir, file_name)
+        try:
+            with open(path) as f:
+                schema = json.loads(_LINE_COMMENT.sub(r"\1", f.read()))
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading schema examples from {path}: {str(e)}")
+            continue
+
+        documents = examples.setdefault(schema["collection"], {})
+        if "documents" in schema:
+            for doc_id, document in schema["documents"].items():
+                if "example" in document:
+                    documents[doc_id] = document["example"]
+        elif "example" in schema:
+            documents[str(schema["example"]["id"])] = schema["example"]
+    return examples
+
+
+class DataBackend:
+    """
+    Interface for the store holding the service's collections.
+
+    Reads return document snapshots (id, exists, to_dict()), so caches built
+    on Firestore snapshots work unchanged on every backend. Bulk reads and
+    batched writes take many documents per call, so callers pay one round
+    trip rather than one per document.
+    """
+
+    name = "data"
+
+    def get_all(self, collection: str) -> list:
+        """Returns snapshots of every document in a collection."""
+        raise NotImplementedError
+
+    def get_many(self, collection: str, doc_ids) -> dict:
+        """Returns {doc_id: snapshot} for doc_ids; missing documents have exists False."""
+        raise NotImplementedError
+
+    def put_many(self, collection: str, documents: dict):
+        """Writes (replaces) every {doc_id: data} document in as few batches as possible."""
+        raise NotImplementedError
+
+    def increment_many(self, collection: str, documents: dict):
+        """
+        Adds every numeric field of each {doc_id: deltas} document to the
+        stored value (0 if missing), creating documents as needed; nested
+        maps are merged and non-numeric fields are set. Each document is
+        updated atomically, without the caller reading it first.
+        """
+        raise NotImplementedError
+
+    def increment_once(self, collection: str, marker_collection: str, keys, deltas_for) -> list:
+        """
+        Applies increments at most once per key: atomically finds the keys
+        without a marker document in marker_collection, increments the
+        {doc_id: deltas} documents deltas_for(those keys) returns, as
+        increment_many() does, and writes a marker for each of them.
+        Returns the keys applied, so calling again with the same keys (e.g.
+        after an ambiguous failure) adds nothing twice.
+        """
+        raise NotImplementedError
+
+    def page(self, collection: str, order_by: str, start_after=None, limit: int = 500) -> list:
+        """
+        Returns up to limit snapshots ordered by a field, then by document ID,
+        for paging through a large collection with constant memory.
+        start_after is the (field value, doc_id) cursor of the last document
+        of the previous page. Documents without the field are skipped, as
+        Firestore's ordered queries do.
+        """
+        raise NotImplementedError
+
+    def watch(self, collection: str, callback, doc_id: str = None):
+        """
+        Calls callback(docs, changes, read_time) with the collection (or one
+        document) now and after every change, like Firestore's on_snapshot.
+        Returns a handle with unsubscribe() and is_active, which turns False
+        once the listener has stopped (e.g. after a stream error). Raises
+        NotImplementedError where the backend cannot notify, so caches fall
+        back to TTL refresh.
+        """
+        raise NotImplementedError
+
+    def watch_new(self, collection: str, order_by: str, after, callback):
+        """
+        Calls callback(docs) with the documents added to the collection
+        whose order_by field is greater than after, as they are added,
+        without reading what is already there. Returns a handle with
+        unsubscribe(); raises NotImplementedError like watch().
+        """
+        raise NotImplementedError
+
+
+class FirestoreBackend(DataBackend):
+    """Collections in Firestore, reached through a client factory so the client is created lazily."""
+
+    name = "firestore"
+
+    def __init__(self, db_factory):
+        self._db_factory = db_factory
+
+    def get_all(self, collection: str) -> list:
+        return list(self._db_factory().collection(collection).get())
+
+    def get_many(self, collection: str, doc_ids) -> dict:
+        db = self._db_factory()
+        references = [db.collection(collection).document(doc_id) for doc_id in doc_ids]
+        if len(references) <= 1:
+            return {doc.id: doc for doc in (reference.get() for reference in references)}
+        # get_all fetches every reference in one RPC, in no particular order
+        return {doc.id: doc for doc in db.get_all(references)}
+
+    def put_many(self, collection: str, documents: dict):
+        db = self._db_factory()
+        collection_ref = db.collection(collection)
+        items = list(documents.items())
+        for start in range(0, len(items), FIRESTORE_MAX_BATCH_WRITES):
+            batch = db.batch()
+            for doc_id, data in items[start:start + FIRESTORE_MAX_BATCH_WRITES]:
+                batch.set(collection_ref.document(doc_id), data)
+            batch.commit()
+
+    @staticmethod
+    def _server_increments(deltas: dict) -> dict:
+        from firebase_admin import firestore
+
+        return {
+            key: FirestoreBackend._server_increments(value) if isinstance(value, dict)
+            else firestore.Increment(value) if _is_increment(value) else value
+            for key, value in deltas.items()
+        }
+
+    def increment_many(self, collection: str, documents: dict):
+        db = self._db_factory()
+        collection_ref = db.collection(collection)
+        items = list(documents.items())
+        for start in range(0, len(items), FIRESTORE_MAX_BATCH_WRITES):
+            batch = db.batch()
+            for doc_id, deltas in items[start:start + FIRESTORE_MAX_BATCH_WRITES]:
+                # A merged set with Increment transforms is applied by the server, so
+                # concurrent writers to one document never overwrite each other
+                batch.set(collection_ref.document(doc_id), self._server_increments(deltas), merge=True)
+            batch.commit()
+
+    def increment_once(self, collection: str, marker_collection: str, keys, deltas_for) -> list:
+        from firebase_admin import firestore
+
+        db = self._db_factory()
+        collection_ref = db.collection(collection)
+        marker_ref = db.collection(marker_collection)
+
+        @firestore.transactional
+        def apply(transaction, chunk):
+            # Read in the transaction, so a concurrent apply of the same keys makes this one retry
+            applied = {doc.id for doc in transaction.get_all([marker_ref.document(key) for key in chunk])
+                       if doc.exists}
+            new_keys = [key for key in chunk if key not in applied]
+            if new_keys:
+                for doc_id, deltas in deltas_for(new_keys).items():
+                    transaction.set(collection_ref.document(doc_id), self._server_increments(deltas), merge=True)
+                for key in new_keys:
+                    transaction.set(marker_ref.document(key), {"applied_at": firestore.SERVER_TIMESTAMP})
+            return new_keys
+
+        keys = list(keys)
+        # Each key writes its marker and may touch two more documents, within
+        # a transaction's 500 writes
+        size = FIRESTORE_MAX_BATCH_WRITES // 3
+        return [
+            key for start in range(0, len(keys), size)
+            for key in apply(db.transaction(), keys[start:start + size])
+        ]
+
+    def page(self, collection: str, order_by: str, start_after=None, limit: int = 500) -> list:
+        from firebase_admin import firestore
+
+        document_id = firestore.FieldPath.document_id()
+        query = self._db_factory().collection(collection).order_by(order_by).order_by(document_id)
+        if start_after is not None:
+            # A query cursor: the server resumes after this position without re-reading earlier pages
+            query = query.start_after({order_by: start_after[0], document_id: start_after[1]})
+        return list(query.limit(limit).stream())
+
+    def watch(self, collection: str, callback, doc_id: str = None):
+        reference = self._db_factory().collection(collection)
+        if doc_id is not None:
+            reference = reference.document(doc_id)
+        return reference.on_snapshot(callback)
+
+    def watch_new(self, collection: str, order_by: str, after, callback):
+        def on_snapshot(docs, changes, read_time):
+            # The first snapshot is empty unless documents were added since `after`
+            added = [change.document for change in changes if change.type.name == "ADDED"]
+            if added:
+                callback(added)
+        query = self._db_factory().collection(collection).where(order_by, ">", after).order_by(order_by)
+        return query.on_snapshot(on_snapshot)
+
+
+class _InMemoryWatch:
+    """Subscription handle returned by InMemoryBackend.watch() and watch_new()."""
+
+    def __init__(self, backend, watchers: list, callback):
+        self._backend = backend
+        self._watchers = watchers
+        self._callback = callback
+
+    @property
+    def is_active(self) -> bool:
+        return self._callback in self._watchers
+
+    def unsubscribe(self):
+        with self._backend._lock:
+            if self._callback in self._watchers:
+                self._watchers.remove(self._callback)
+
+
+class InMemoryBackend(DataBackend):
+    """
+    Collections held in process, for offline runs and load tests. Documents
+    are copied on the way in, so callers can never mutate stored data, and
+    watchers are notified synchronously after every write.
+    """
+
+    name = "memory"
+
+    def __init__(self, seed: dict = None):
+        self._collections = {
+            collection: copy.deepcopy(documents) for collection, documents in (seed or {}).items()
+        }
+        self._lock = threading.RLock()
+        # (collection, doc_id or None) -> callbacks
+        self._watchers = {}
+        # collection -> (order_by, after, callback) of watch_new() subscribers
+        self._new_watchers = {}
+
+    def get_all(self, collection: str) -> list:
+        with self._lock:
+            documents = list(self._collections.get(collection, {}).items())
+        return [SnapshotDocument(doc_id, data) for doc_id, data in documents]
+
+    def get_many(self, collection: str, doc_ids) -> dict:
+        with self._lock:
+            documents = self._collections.get(collection, {})
+            return {doc_id: SnapshotDocument(doc_id, documents.get(doc_id)) for doc_id in doc_ids}
+
+    def put_many(self, collection: str, documents: dict):
+        with self._lock:
+            stored = self._collections.setdefault(collection, {})
+            added = [doc_id for doc_id in documents if doc_id not in stored]
+            stored.update(copy.deepcopy(documents))
+            callbacks = self._callbacks(collection, documents)
+            new_watchers = list(self._new_watchers.get(collection, ()))
+            added = [SnapshotDocument(doc_id, stored[doc_id]) for doc_id in added]
+        for doc_id, callback in callbacks:
+            self._notify(collection, doc_id, callback, list(documents))
+        for order_by, after, callback in new_watchers:
+            docs = [
+                doc for doc in added
+                if doc.to_dict().get(order_by) is not None and _order_key(doc.to_dict()[order_by]) > _order_key(after)
+            ]
+            if docs:
+                try:
+                    callback(docs)
+                except Exception as e:
+                    logger.error(f"Error in {collection} watcher: {str(e)}", exc_info=True)
+
+    def _increment(self, collection: str, documents: dict):
+        stored = self._collections.setdefault(collection, {})
+        for doc_id, deltas in documents.items():
+            # Copied, not updated in place: snapshots handed out earlier share the old dict
+            stored[doc_id] = apply_increments(copy.deepcopy(stored.get(doc_id, {})), deltas)
+
+    def increment_many(self, collection: str, documents: dict):
+        with self._lock:
+            self._increment(collection, documents)
+            callbacks = self._callbacks(collection, documents)
+        for doc_id, callback in callbacks:
+            self._notify(collection, doc_id, callback, list(documents))
+
+    def increment_once(self, collection: str, marker_collection: str, keys, deltas_for) -> list:
+        with self._lock:
+            markers = self._collections.setdefault(marker_collection, {})
+            new_keys = list(dict.fromkeys(key for key in keys if key not in markers))
+            documents = deltas_for(new_keys) if new_keys else {}
+            self._increment(collection, documents)
+            applied_at = datetime.now(timezone.utc)
+            markers.update((key, {"applied_at": applied_at}) for key in new_keys)
+            callbacks = self._callbacks(collection, documents)
+        for doc_id, callback in callbacks:
+            self._notify(collection, doc_id, callback, list(documents))
+        return new_keys
+
+    def page(self, collection: str, order_by: str, start_after=None, limit: int = 500) -> list:
+        with self._lock:
+            keyed = [
+                ((_order_key(data[order_by]), doc_id), data)
+                for doc_id, data in self._collections.get(collection, {}).items()
+                if data.get(order_by) is not None
+            ]
+        if start_after is not None:
+            cursor = (_order_key(start_after[0]), start_after[1])
+            keyed = [entry for entry in keyed if entry[0] > cursor]
+        return [SnapshotDocument(key[1], data) for key, data in heapq.nsmallest(limit, keyed, key=lambda entry: entry[0])]
+
+    def _callbacks(self, collection: str, doc_ids) -> list:
+        """Watchers of the collection or of any of doc_ids; callers hold _lock."""
+        return [
+            (doc_id, callback)
+            for doc_id in [None] + list(doc_ids)
+            for callback in self._watchers.get((collection, doc_id), ())
+        ]
+
+    def watch(self, collection: str, callback, doc_id: str = None):
+        with self._lock:
+            self._watchers.setdefault((collection, doc_id), []).append(callback)
+        self._notify(collection, doc_id, callback, [])
+        return _InMemoryWatch(self, self._watchers[(collection, doc_id)], callback)
+
+    def watch_new(self, collection: str, order_by: str, after, callback):
+        entry = (order_by, after, callback)
+        with self._lock:
+            watchers = self._new_watchers.setdefault(collection, [])
+            watchers.append(entry)
+        return _InMemoryWatch(self, watchers, entry)
+
+    def _notify(self, collection: str, doc_id: str, callback, changes: list):
+        if doc_id is None:
+            docs = self.get_all(collection)
+        else:
+            docs = [self.get_many(collection, [doc_id])[doc_id]]
+        try:
+            callback(docs, changes, datetime.now())
+        except Exception as e:
+            logger.error(f"Error in {collection} watcher: {str(e)}", exc_info=True)
+
+
+class SQLiteBackend(DataBackend):
+    """
+    Collections in a local SQLite file, one row per document. Seed documents
+    are inserted only where no document with that ID exists, so local edits
+    survive restarts. SQLite has no change notifications, so watch() is not
+    supported.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = DATA_SQLITE_PATH, seed: dict = None):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._page_indexes = set()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "collection TEXT NOT NULL, "
+                "doc_id TEXT NOT NULL, "
+                "data TEXT NOT NULL, "
+                "PRIMARY KEY (collection, doc_id))"
+            )
+            for collection, documents in (seed or {}).items():
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO documents (collection, doc_id, data) VALUES (?, ?, ?)",
+                    [(collection, doc_id, encode_document(data)) for doc_id, data in documents.items()],
+                )
+
+    def get_all(self, collection: str) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_id, data FROM documents WHERE collection = ? ORDER BY rowid", (collection,)
+            ).fetchall()
+        return [SnapshotDocument(doc_id, decode_document(data)) for doc_id, data in rows]
+
+    def get_many(self, collection: str, doc_ids) -> dict:
+        doc_ids = list(doc_ids)
+        found = {}
+        # Stay under SQLite's default limit on bound parameters
+        for start in range(0, len(doc_ids), 500):
+            chunk = doc_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT doc_id, data FROM documents WHERE collection = ? AND doc_id IN ({placeholders})",
+                    [collection] + chunk,
+                ).fetchall()
+            found.update(rows)
+        return {
+            doc_id: SnapshotDocument(doc_id, decode_document(found[doc_id]) if doc_id in found else None)
+            for doc_id in doc_ids
+        }
+
+    def put_many(self, collection: str, documents: dict):
+        rows = [(collection, doc_id, encode_document(data)) for doc_id, data in documents.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO documents (collection, doc_id, data) VALUES (?, ?, ?)", rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _increment(self, collection: str, documents: dict):
+        """Read-modify-writes documents; the caller holds the lock and an open transaction."""
+        rows = []
+        for doc_id, deltas in documents.items():
+            row = self._conn.execute(
+                "SELECT data FROM documents WHERE collection = ? AND doc_id = ?", (collection, doc_id)
+            ).fetchone()
+            current = decode_document(row[0]) if row else {}
+            rows.append((collection, doc_id, encode_document(apply_increments(current, deltas))))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO documents (collection, doc_id, data) VALUES (?, ?, ?)", rows
+        )
+
+    def increment_many(self, collection: str, documents: dict):
+        with self._lock:
+            # Read and write in one transaction, so other processes sharing the file wait
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._increment(collection, documents)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def increment_once(self, collection: str, marker_collection: str, keys, deltas_for) -> list:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                new_keys = [
+                    key for key in dict.fromkeys(keys)
+                    if self._conn.execute(
+                        "SELECT 1 FROM documents WHERE collection = ? AND doc_id = ?", (marker_collection, key)
+                    ).fetchone() is None
+                ]
+                if new_keys:
+                    self._increment(collection, deltas_for(new_keys))
+                    marker = encode_document({"applied_at": datetime.now(timezone.utc)})
+                    self._conn.executemany(
+                        "INSERT INTO documents (collection, doc_id, data) VALUES (?, ?, ?)",
+                        [(marker_collection, key, marker) for key in new_keys],
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return new_keys
+
+    def page(self, collection: str, order_by: str, start_after=None, limit: int = 500) -> list:
+        # Datetimes are stored as {"__datetime__": isoformat}, which sorts as text
+        path = json.dumps(order_by)
+        sort_key = f"COALESCE(json_extract(data, '$.{path}.__datetime__'), json_extract(data, '$.{path}'))"
+        query = f"SELECT doc_id, data FROM documents WHERE collection = ? AND {sort_key} IS NOT NULL"
+        parameters = [collection]
+        if start_after is not None:
+            value, doc_id = start_after
+            query += f" AND ({sort_key}, doc_id) > (?, ?)"
+            parameters += [value.isoformat() if isinstance(value, datetime) else value, doc_id]
+        query += f" ORDER BY {sort_key}, doc_id LIMIT ?"
+        with self._lock:
+            if order_by not in self._page_indexes:
+                # An index on the same expression lets each page seek to the
+                # cursor instead of sorting the whole collection
+                index_name = "documents_by_" + re.sub(r"\W", "_", order_by)
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON documents (collection, {sort_key}, doc_id)")
+                self._page_indexes.add(order_by)
+            rows = self._conn.execute(query, parameters + [limit]).fetchall()
+        return [SnapshotDocument(doc_id, decode_document(data)) for doc_id, data in rows]
+
+    def watch(self, collection: str, callback, doc_id: str = None):
+        raise NotImplementedError("the sqlite data backend has no change notifications")
+
+    def watch_new(self, collection: str, order_by: str, after, callback):
+        raise NotImplementedError("the sqlite data backend has no change notifications")
+
+
+DATA_OPERATION_SECONDS = metrics.histogram(
+    "vos_data_operation_seconds", "Latency of data backend calls.", ("backend", "operation", "collection")
+)
+DATA_DOCUMENTS = metrics.counter(
+    "vos_data_documents_total", "Documents read or written through the data backend.",
+    ("backend", "operation", "collection")
+)
+DATA_ERRORS = metrics.counter(
+    "vos_data_errors_total", "Data backend calls that raised.", ("backend", "operation", "collection")
+)
+
+
+def _collection_label(collection: str) -> str:
+    """Metric label for a collection: a store's stores/<id>/menu_items counts as menu_items."""
+    return collection.rpartition("/")[2]
+
+
+class InstrumentedBackend(DataBackend):
+    """
+    Wraps a backend to record the latency of every call, the documents read
+    and written, and failures, labelled by backend, operation and collection.
+    Inside a sampled trace, every call also gets a span.
+    """
+
+    def __init__(self, backend: DataBackend):
+        self._backend = backend
+        self.name = backend.name
+
+    def _record(self, operation: str, collection: str, started: float, documents: int, kind: str):
+        label = _collection_label(collection)
+        DATA_OPERATION_SECONDS.labels(self.name, operation, label).observe(time.perf_counter() - started)
+        DATA_DOCUMENTS.labels(self.name, kind, label).inc(documents)
+
+    def get_all(self, collection: str) -> list:
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"{self.name} get_all", {"db.system": self.name, "db.collection.name": collection}):
+                docs = self._backend.get_all(collection)
+        except Exception:
+            DATA_ERRORS.labels(self.name, "get_all", _collection_label(collection)).inc()
+            raise
+        self._record("get_all", collection, started, len(docs), "read")
+        return docs
+
+    def get_many(self, collection: str, doc_ids) -> dict:
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"{self.name} get_many", {"db.system": self.name, "db.collection.name": collection}):
+                docs = self._backend.get_many(collection, doc_ids)
+        except Exception:
+            DATA_ERRORS.labels(self.name, "get_many", _collection_label(collection)).inc()
+            raise
+        self._record("get_many", collection, started, len(docs), "read")
+        return docs
+
+    def put_many(self, collection: str, documents: dict):
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"{self.name} put_many", {"db.system": self.name, "db.collection.name": collection}):
+                self._backend.put_many(collection, documents)
+        except Exception:
+            DATA_ERRORS.labels(self.name, "put_many", _collection_label(collection)).inc()
+            raise
+        self._record("put_many", collection, started, len(documents), "write")
+
+    def increment_many(self, collection: str, documents: dict):
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"{self.name} increment_many",
+                              {"db.system": self.name, "db.collection.name": collection}):
+                self._backend.increment_many(collection, documents)
+        except Exception:
+            DATA_ERRORS.labels(self.name, "increment_many", _collection_label(collection)).inc()
+            raise
+        self._record("increment_many", collection, started, len(documents), "write")
+
+    def increment_once(self, collection: str, marker_collection: str, keys, deltas_for) -> list:
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"{self.name} increment_once",
+                              {"db.system": self.name, "db.collection.name": collection}):
+                applied = self._backend.increment_once(collection, marker_collection, keys, deltas_for)
+        except Exception:
+            DATA_ERRORS.labels(self.name, "increment_once", _collection_label(collection)).inc()
+            raise
+        self._record("increment_once", collection, started, len(applied), "write")
+        return applied
+
+    def page(self, collection: str, order_by: str, start_after=None, limit: int = 500) -> list:
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"{self.name} page", {"db.system": self.name, "db.collection.name": collection}):
+                docs = self._backend.page(collection, order_by, start_after, limit)
+        except Exception:
+            DATA_ERRORS.labels(self.name, "page", _collection_label(collection)).inc()
+            raise
+        self._record("page", collection, started, len(docs), "read")
+        return docs
+
+    def watch(self, collection: str, callback, doc_id: str = None):
+        def counted(docs, changes, read_time):
+            DATA_DOCUMENTS.labels(self.name, "listen", _collection_label(collection)).inc(len(docs))
+            return callback(docs, changes, read_time)
+        return self._backend.watch(collection, counted, doc_id=doc_id)
+
+    def watch_new(self, collection: str, order_by: str, after, callback):
+        def counted(docs):
+            DATA_DOCUMENTS.labels(self.name, "listen", _collection_label(collection)).inc(len(docs))
+            return callback(docs)
+        return self._backend.watch_new(collection, order_by, after, counted)
+
+
+class MenuRepository:
+    """The menu_items collection."""
+
+    collection = "menu_items"
+
+    def __init__(self, backend: DataBackend, collection: str = None):
+        self._backend = backend
+        if collection is not None:
+            # A store's own collection, e.g. stores/<store_id>/menu_items
+            self.collection = collection
+
+    def list_items(self) -> list:
+        """Returns snapshots of every menu item document."""
+        return self._backend.get_all(self.collection)
+
+    def get_items(self, item_ids) -> dict:
+        """Returns {item_id: snapshot} for several items in one read."""
+        return self._backend.get_many(self.collection, item_ids)
+
+    def put_items(self, items: dict):
+        """Writes {item_id: data} menu item documents in batches."""
+        self._backend.put_many(self.collection, items)
+
+    def watch(self, callback):
+        """Subscribes callback(docs, changes, read_time) to the whole collection."""
+        return self._backend.watch(self.collection, callback)
+
+
+class ConfigRepository:
+    """The configs collection, one document per named configuration."""
+
+    collection = "configs"
+
+    def __init__(self, backend: DataBackend, collection: str = None):
+        self._backend = backend
+        if collection is not None:
+            # A store's own collection, e.g. stores/<store_id>/configs
+            self.collection = collection
+
+    def get_config(self, name: str):
+        """Returns the snapshot of one config document (exists is False if missing)."""
+        return self._backend.get_many(self.collection, [name])[name]
+
+    def get_configs(self, names) -> dict:
+        """Returns {name: snapshot} for several config documents in one read."""
+        return self._backend.get_many(self.collection, names)
+
+    def put_configs(self, configs: dict):
+        """Writes {name: data} config documents in batches."""
+        self._backend.put_many(self.collection, configs)
+
+    def watch_config(self, name: str, callback):
+        """Subscribes callback(docs, changes, read_time) to one config document."""
+        return self._backend.watch(self.collection, callback, doc_id=name)
+
+
+class OrderRepository:
+    """The orders collection. Orders carry their document ID in 'id'."""
+
+    collection = "orders"
+
+    def __init__(self, backend: DataBackend):
+        self._backend = backend
+
+    def get_orders(self, order_ids) -> dict:
+        """Returns {order_id: order} for the orders that exist among order_ids."""
+        docs = self._backend.get_many(self.collection, order_ids)
+        return {order_id: doc.to_dict() for order_id, doc in docs.items() if doc.exists}
+
+    def save_orders(self, orders):
+        """Writes orders in batches; saving an order again overwrites it, so retries are safe."""
+        self._backend.put_many(self.collection, {order["id"]: order for order in orders})
+
+    def save_order(self, order: dict):
+        self.save_orders([order])
+
+    def list_orders(self) -> list:
+        """Returns every order; a full collection scan, for batch jobs only."""
+        return [doc.to_dict() for doc in self._backend.get_all(self.collection) if doc.exists]
+
+    def page_orders(self, after=None, limit: int = 500) -> list:
+        """
+        Returns the next limit orders by created_at, then ID, after the
+        (created_at, id) cursor of the last order already read.
+        """
+        return self._orders(self._backend.page(self.collection, "created_at", after, limit))
+
+    def watch_new_orders(self, since: datetime, callback):
+        """Calls callback(orders) with orders created after since as they are written; returns the handle."""
+        return self._backend.watch_new(self.collection, "created_at", since,
+                                       lambda docs: callback(self._orders(docs)))
+
+    @staticmethod
+    def _orders(docs) -> list:
+        orders = []
+        for doc in docs:
+            order = doc.to_dict()
+            order.setdefault("id", doc.id)
+            orders.append(order)
+        return orders
+
+
+class SalesRollupRepository:
+    """
+    The sales_rollups collection: sales counters per time bucket (e.g.
+    "day-2024-02-06"), each split over shards stored as documents
+    "<bucket>-s<shard>", so concurrent writers rarely touch the same document.
+    """
+
+    collection = "sales_rollups"
+    # One marker document per order already counted, keyed by order ID
+    orders_collection = "sales_rollup_orders"
+
+    def __init__(self, backend: DataBackend):
+        self._backend = backend
+
+    @staticmethod
+    def shard_id(bucket_id: str, shard: int) -> str:
+        return f"{bucket_id}-s{shard}"
+
+    def increment(self, deltas: dict, shard: int):
+        """Adds {bucket_id: deltas} to one shard of each bucket, in batched writes."""
+        self._backend.increment_many(
+            self.collection, {self.shard_id(bucket_id, shard): data for bucket_id, data in deltas.items()}
+        )
+
+    def increment_orders(self, order_ids, deltas_for, shard: int) -> list:
+        """
+        Adds deltas_for(order_ids), {bucket_id: deltas}, to one shard of each
+        bucket for the orders not counted yet, and marks them counted in the
+        same atomic write. Returns the order IDs counted now.
+        """
+        def documents_for(new_ids):
+            return {self.shard_id(bucket_id, shard): data for bucket_id, data in deltas_for(new_ids).items()}
+
+        return self._backend.increment_once(self.collection, self.orders_collection, order_ids, documents_for)
+
+    def mark_orders(self, order_ids):
+        """Marks orders as counted, e.g. after their buckets were rebuilt from them."""
+        applied_at = datetime.now(timezone.utc)
+        self._backend.put_many(
+            self.orders_collection, {order_id: {"applied_at": applied_at} for order_id in order_ids}
+        )
+
+    def get_shards(self, bucket_ids, shards: int) -> dict:
+        """Returns {bucket_id: [shard documents that exist]} for several buckets in one read."""
+        bucket_ids = list(bucket_ids)
+        docs = self._backend.get_many(
+            self.collection, [self.shard_id(bucket_id, shard) for bucket_id in bucket_ids for shard in range(shards)]
+        )
+        return {
+            bucket_id: [
+                doc.to_dict() for doc in (docs[self.shard_id(bucket_id, shard)] for shard in range(shards))
+                if doc.exists
+            ]
+            for bucket_id in bucket_ids
+        }
+
+    def put_buckets(self, totals: dict, shards: int):
+        """Replaces {bucket_id: totals}: shard 0 takes the totals, the other shards are emptied."""
+        documents = {}
+        for bucket_id, data in totals.items():
+            header = {key: value for key, value in data.items() if isinstance(value, str)}
+            for shard in range(1, shards):
+                documents[self.shard_id(bucket_id, shard)] = dict(header)
+            documents[self.shard_id(bucket_id, 0)] = data
+        self._backend.put_many(self.collection, documents)
+
+
+def create_backend(backend: str = DATA_BACKEND, db_factory=None) -> DataBackend:
+    """
+    Builds the data backend selected by configuration, instrumented for
+    metrics. db_factory returns the Firestore client and is only called once
+    Firestore is first used.
+    """
+    if backend == "firestore":
+        data_backend = FirestoreBackend(db_factory)
+    elif backend == "memory":
+        data_backend = InMemoryBackend(seed=load_schema_examples())
+    elif backend == "sqlite":
+        data_backend = SQLiteBackend(seed=load_schema_examples())
+    else:
+        raise ValueError(f"Unknown data backend: {backend}")
+
+    logger.info(f"Using {backend} data backend")
+    return InstrumentedBackend(data_backend)
@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# How long a webhook response is kept for replay to a retried request;
+# Dialogflow retries within seconds of a timeout. 0 turns replay off
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "300"))
+
+# Upper bound on cached responses; the oldest are dropped first
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+
+
+class ResponseCache:
+    """
+    Recent webhook responses keyed by (session ID, Dialogflow responseId),
+    so a retried request is answered with the response of the turn it
+    repeats instead of running the turn again.
+
+    Entries expire ttl_seconds after they are stored, and once max_entries is
+    exceeded the oldest go first; both are trimmed on put(), so no background
+    thread is needed. Responses are held in this process only.
+    """
+
+    def __init__(self, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        # key -> (response, stored_at), oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.replays = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl_seconds > 0 and self._max_entries > 0
+
+    def get(self, session_id: str, response_id: str):
+        """Returns the response stored for this request, or None."""
+        if response_id is None or not self.enabled:
+            return None
+        key = (session_id, response_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] >= self._ttl_seconds:
+                del self._entries[key]
+                return None
+            self.replays += 1
+            return entry[0]
+
+    def put(self, session_id: str, response_id: str, response: dict):
+        """Stores the response for a request; the caller must not mutate it afterwards."""
+        if response_id is None or not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._entries[(session_id, response_id)] = (response, now)
+            self._entries.move_to_end((session_id, response_id))
+            # Entries are in storage order, so expired ones are at the front
+            while self._entries:
+                _, (_, stored_at) = next(iter(self._entries.items()))
+                if now - stored_at < self._ttl_seconds:
+                    break
+                self._entries.popitem(last=False)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, session_id: str, response_id: str):
+        """Forgets the response for a request, e.g. when its turn was not saved."""
+        with self._lock:
+            self._entries.pop((session_id, response_id), None)
+
+    def __len__(self):
+        return len(self._entries)
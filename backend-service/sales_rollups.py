@@ -0,0 +1,240 @@
+import logging
+import os
+import random
+from datetime import date, datetime, timedelta, timezone
+
+from money import to_amount, to_cents
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Maintain sales rollups as completed orders are written
+SALES_ROLLUPS_ENABLED = os.environ.get("SALES_ROLLUPS_ENABLED", "true").lower() == "true"
+
+# Shards per rollup bucket. Each write goes to one random shard, so raise this
+# if Firestore reports contention on sales_rollups documents at peak
+SALES_ROLLUP_SHARDS = int(os.environ.get("SALES_ROLLUP_SHARDS", "8"))
+
+# Timezone whose calendar days and hours the rollups are bucketed by (IANA name)
+SALES_ROLLUP_TIMEZONE = os.environ.get("SALES_ROLLUP_TIMEZONE", "UTC")
+
+
+def _timezone(name: str):
+    if name.upper() == "UTC":
+        return timezone.utc
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(name)
+
+
+def _completed_at(order: dict):
+    """The order's completion time as an aware datetime; naive and string times are taken as UTC."""
+    moment = order.get("completed_at") or order.get("created_at")
+    if isinstance(moment, str):
+        moment = datetime.fromisoformat(moment.replace("Z", "+00:00"))
+    if not isinstance(moment, datetime):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def day_bucket(day: date) -> str:
+    return f"day-{day.isoformat()}"
+
+
+def hour_bucket(day: date, hour: int) -> str:
+    return f"hour-{day.isoformat()}T{hour:02d}"
+
+
+def rollup_deltas(orders, tz=timezone.utc, deltas: dict = None) -> dict:
+    """
+    Returns {bucket_id: deltas} adding completed orders to the day and hour
+    buckets they fall in: order, revenue and item counts, and per item the
+    quantity and revenue. Other orders (e.g. abandoned carts) are skipped.
+    Given deltas, adds to those instead, so orders can be folded in a page
+    at a time.
+    """
+    deltas = {} if deltas is None else deltas
+    for order in orders:
+        if order.get("status") != "completed":
+            continue
+        moment = _completed_at(order)
+        if moment is None:
+            logger.warning(f"Order {order.get('id')} has no completion time; left out of sales rollups")
+            continue
+        local = moment.astimezone(tz)
+        day = local.date()
+        for bucket_id, period, start in (
+            (day_bucket(day), "day", day.isoformat()),
+            (hour_bucket(day, local.hour), "hour", local.strftime("%Y-%m-%dT%H:00")),
+        ):
+            bucket = deltas.setdefault(bucket_id, {
+                "period": period, "start": start, "orders": 0, "revenue_cents": 0, "items_sold": 0, "items": {}
+            })
+            bucket["orders"] += 1
+            bucket["revenue_cents"] += to_cents(order.get("total_amount", 0))
+            for line in order.get("items", []):
+                quantity = int(line.get("quantity", 0))
+                item = bucket["items"].setdefault(
+                    line["item_id"], {"name": line.get("name"), "quantity": 0, "revenue_cents": 0}
+                )
+                item["quantity"] += quantity
+                item["revenue_cents"] += to_cents(line.get("item_total", 0))
+                bucket["items_sold"] += quantity
+    return deltas
+
+
+def _sum_shards(shards: list) -> dict:
+    totals = {"orders": 0, "revenue_cents": 0, "items_sold": 0, "items": {}}
+    for shard in shards:
+        for field in ("orders", "revenue_cents", "items_sold"):
+            totals[field] += shard.get(field, 0)
+        for item_id, item in shard.get("items", {}).items():
+            total = totals["items"].setdefault(item_id, {"name": item.get("name"), "quantity": 0, "revenue_cents": 0})
+            total["quantity"] += item.get("quantity", 0)
+            total["revenue_cents"] += item.get("revenue_cents", 0)
+    return totals
+
+
+def _report(totals: dict) -> dict:
+    items = sorted(totals["items"].items(), key=lambda entry: (-entry[1]["quantity"], entry[0]))
+    return {
+        "orders": totals["orders"],
+        "revenue": to_amount(totals["revenue_cents"]),
+        "items_sold": totals["items_sold"],
+        "items": [
+            {"item_id": item_id, "name": item["name"], "quantity": item["quantity"],
+             "revenue": to_amount(item["revenue_cents"])}
+            for item_id, item in items
+        ],
+    }
+
+
+class SalesRollups:
+    """
+    Sales counters per day and per hour, kept up to date as completed orders
+    are written, so dashboard questions ("Big Macs sold today", "revenue per
+    hour") read a fixed number of documents however many orders there are.
+
+    record_orders() folds a batch of orders into one increment per bucket,
+    written to a random shard of each together with a marker per order, so
+    a batch replayed after a failed or ambiguous write counts each order
+    once; queries read every shard of the buckets they cover in one bulk
+    read and add them up.
+    """
+
+    def __init__(self, repository, shards: int = SALES_ROLLUP_SHARDS, tz_name: str = SALES_ROLLUP_TIMEZONE):
+        self._repository = repository
+        self._shards = shards
+        self.timezone = _timezone(tz_name)
+
+    def record_orders(self, orders):
+        """Adds the completed ones among orders not yet counted to the rollups; returns their IDs."""
+        completed = {order["id"]: order for order in orders if order.get("status") == "completed"}
+        if not completed:
+            return []
+        return self._repository.increment_orders(
+            list(completed),
+            lambda order_ids: rollup_deltas([completed[order_id] for order_id in order_ids], self.timezone),
+            random.randrange(self._shards),
+        )
+
+    def today(self) -> date:
+        return datetime.now(self.timezone).date()
+
+    def query(self, day: date = None, item: str = None, by_hour: bool = False) -> dict:
+        """
+        Sales for one day: totals and per-item counts, or with by_hour the
+        same for each of its 24 hours. item (an item ID or name, any case)
+        narrows the items to that one.
+        """
+        day = day or self.today()
+        if by_hour:
+            bucket_ids = [hour_bucket(day, hour) for hour in range(24)]
+        else:
+            bucket_ids = [day_bucket(day)]
+        shards = self._repository.get_shards(bucket_ids, self._shards)
+        reports = [_report(_sum_shards(shards[bucket_id])) for bucket_id in bucket_ids]
+
+        if item is not None:
+            wanted = item.lower()
+            for report in reports:
+                report["items"] = [
+                    line for line in report["items"]
+                    if line["item_id"].lower() == wanted or (line["name"] or "").lower() == wanted
+                ]
+
+        result = {"date": day.isoformat(), "timezone": str(self.timezone)}
+        if by_hour:
+            result["hours"] = [dict(hour=hour, **report) for hour, report in enumerate(reports)]
+        else:
+            result.update(reports[0])
+        return result
+
+    def rebuild(self, pages) -> int:
+        """
+        Recomputes the rollups of every bucket the orders fall in and
+        replaces them, marking the orders counted; returns the number of
+        buckets written. Buckets no order falls in are left alone.
+
+        pages is an iterable of lists of orders, read once, so a generator
+        paging through the collection keeps only the totals in memory.
+        """
+        deltas = {}
+        order_ids = []
+        for orders in pages:
+            rollup_deltas(orders, self.timezone, deltas)
+            order_ids.extend(order["id"] for order in orders if order.get("status") == "completed")
+        self._repository.put_buckets(deltas, self._shards)
+        self._repository.mark_orders(order_ids)
+        return len(deltas)
+
+
+def parse_query(params) -> dict:
+    """Arguments for SalesRollups.query() from request parameters; raises ValueError if invalid."""
+    arguments = {"by_hour": params.get("by") == "hour", "item": params.get("item") or None}
+    if params.get("by") not in (None, "", "day", "hour"):
+        raise ValueError("by must be 'day' or 'hour'")
+    if params.get("date"):
+        arguments["day"] = date.fromisoformat(params["date"])
+    return arguments
+
+
+if __name__ == "__main__":
+    # Rebuild the rollups from the orders collection, e.g. after enabling them
+    # or changing SALES_ROLLUP_TIMEZONE:
+    #   python sales_rollups.py backfill [--days N]
+    # Pause order writes while it runs: increments made during the rebuild of
+    # a bucket are overwritten. Orders are read page by page.
+    import argparse
+    import main
+
+    parser = argparse.ArgumentParser(description="Sales rollup maintenance")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--days", type=int, default=None, help="only today and the N days before it")
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    # Whole days only, so no bucket is rebuilt from part of its orders
+    first_day = None
+    if args.days is not None:
+        first_day = main.sales_rollups.today() - timedelta(days=args.days)
+    stats = {"orders": 0}
+
+    def pages():
+        after = None
+        while True:
+            page = main.order_repository.page_orders(after, args.page_size)
+            if not page:
+                return
+            after = (page[-1]["created_at"], page[-1]["id"])
+            if first_day is not None:
+                page = [
+                    order for order in page
+                    if _completed_at(order) is not None
+                    and _completed_at(order).astimezone(main.sales_rollups.timezone).date() >= first_day
+                ]
+            stats["orders"] += len(page)
+            yield page
+
+    buckets = main.sales_rollups.rebuild(pages())
+    logger.info(f"Rebuilt {buckets} sales rollup buckets from {stats['orders']} orders")
@@ -0,0 +1,589 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from cart import Session
+from response_cache import RESPONSE_CACHE_TTL_SECONDS
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Which backend holds conversation sessions: "memory", "sqlite" or "redis"
+SESSION_STORE_BACKEND = os.environ.get("SESSION_STORE_BACKEND", "memory").lower()
+
+# Database file for the sqlite backend (Cloud Functions can only write under /tmp)
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", "/tmp/vos-sessions.sqlite3")
+
+# Server URL for the redis backend
+SESSION_STORE_URL = os.environ.get("SESSION_STORE_URL", "redis://localhost:6379/0")
+
+# How long a turn may hold a session lock, and how long another turn waits for it
+SESSION_LOCK_TIMEOUT_SECONDS = float(os.environ.get("SESSION_LOCK_TIMEOUT_SECONDS", "10"))
+SESSION_LOCK_WAIT_SECONDS = float(os.environ.get("SESSION_LOCK_WAIT_SECONDS", "5"))
+
+# Sessions untouched for this long are treated as abandoned and evicted
+SESSION_IDLE_TTL_SECONDS = float(os.environ.get("SESSION_IDLE_TTL_SECONDS", "1800"))
+
+# Upper bound on sessions held by the in-memory backend; least recently used are evicted first
+SESSION_MAX_ENTRIES = int(os.environ.get("SESSION_MAX_ENTRIES", "10000"))
+
+
+class SessionLockTimeout(Exception):
+    """Raised when a session stays locked by another turn for too long."""
+
+
+def new_session() -> Session:
+    """Returns the state of a conversation that has not ordered anything yet."""
+    return Session()
+
+
+def encode_session(session: Session) -> str:
+    return json.dumps(session.to_dict(), separators=(",", ":"))
+
+
+def decode_session(raw) -> Session:
+    if raw is None:
+        return new_session()
+    return Session.from_dict(json.loads(raw))
+
+
+def encode_response(last_response) -> str:
+    response_id, response = last_response
+    return json.dumps({"id": response_id, "response": response}, separators=(",", ":"))
+
+
+def decode_response(raw):
+    """Returns (response_id, response) from encode_response(), or None."""
+    if not raw:
+        return None
+    stored = json.loads(raw)
+    return stored["id"], stored["response"]
+
+
+class SessionStore:
+    """
+    Interface for conversation session storage.
+
+    transaction() is the only way handlers touch a session: it yields the
+    Session under a per-session lock, and writes it back when the block
+    exits normally. If the block raises, the stored session is left as it was.
+    A session whose cart is empty at the end of a turn is deleted instead of
+    written, so completed orders and idle greetings cost no storage.
+
+    Shared backends also commit the turn's Session.last_response in the same
+    write, kept apart from the session for response_ttl_seconds whether or not
+    the cart is empty, and load it back into the next transaction. A retried
+    request then finds its response even on another instance or after a cold
+    start, and can never see the session written without it.
+
+    Backends that evict sessions themselves call on_evict(session_id, session,
+    reason) for every session they drop, with reason "idle" or "lru", and
+    count them in evictions.
+
+    len() is the number of stored sessions, for backends where counting is
+    cheap; counts_sessions is False where it is not.
+    """
+
+    counts_sessions = True
+
+    def __init__(self, on_evict=None):
+        self._on_evict = on_evict
+        self.evictions = 0
+
+    def _notify_evicted(self, evicted):
+        """Counts evicted sessions and hands them to the eviction hook."""
+        for session_id, session, reason in evicted:
+            self.evictions += 1
+            logger.info(f"Evicted {reason} session {session_id} with {len(session.items)} items")
+            if self._on_evict is None:
+                continue
+            try:
+                self._on_evict(session_id, session, reason)
+            except Exception as e:
+                logger.error(f"Error in session eviction hook for {session_id}: {str(e)}", exc_info=True)
+
+    @contextmanager
+    def transaction(self, session_id: str):
+        raise NotImplementedError
+        yield
+
+    def get(self, session_id: str):
+        """Returns a copy of the stored session, or None. Does not lock."""
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Sessions held in this process only; the default for local development and
+    single-instance deployments.
+
+    Memory is bounded: sessions idle for longer than idle_ttl_seconds are
+    evicted, and once max_entries is exceeded the least recently used session
+    goes first. Eviction is amortized over turns: every write sweeps at most
+    SWEEP_BATCH expired sessions off the cold end and then drops any LRU
+    overflow, so no background thread is needed.
+
+    A turn works on a copy of the stored session (its lines are shared, as
+    they are never changed in place), so a handler that raises halfway
+    through leaves the stored session as it was.
+    """
+
+    # Locks are striped by session ID so the lock table never grows
+    LOCK_STRIPES = 64
+
+    # Most expired sessions examined per turn by the amortized sweep
+    SWEEP_BATCH = 8
+
+    def __init__(self, max_entries: int = SESSION_MAX_ENTRIES,
+                 idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS, on_evict=None):
+        super().__init__(on_evict)
+        self._max_entries = max_entries
+        self._idle_ttl_seconds = idle_ttl_seconds
+        # session_id -> (session, last_used), least recently used first
+        self._sessions = OrderedDict()
+        self._index_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    @contextmanager
+    def transaction(self, session_id: str):
+        evicted = []
+        try:
+            with self._locks[hash(session_id) % self.LOCK_STRIPES]:
+                now = time.monotonic()
+                with self._index_lock:
+                    entry = self._sessions.get(session_id)
+                    if entry is not None and now - entry[1] >= self._idle_ttl_seconds:
+                        # Expired but not swept yet; the customer starts over
+                        del self._sessions[session_id]
+                        evicted.append((session_id, entry[0], "idle"))
+                        entry = None
+                session = entry[0].copy() if entry is not None else new_session()
+
+                yield session
+
+                # This process's response cache already replays its own turns
+                session.last_response = None
+                with self._index_lock:
+                    if session.items:
+                        self._sessions[session_id] = (session, now)
+                        self._sessions.move_to_end(session_id)
+                    else:
+                        self._sessions.pop(session_id, None)
+                    evicted.extend(self._collect_evictions(now, self.SWEEP_BATCH))
+        finally:
+            # The hook may do I/O, so it runs after the session lock is released
+            self._notify_evicted(evicted)
+
+    def _collect_evictions(self, now: float, sweep_limit):
+        """Pops LRU overflow and expired sessions; callers hold _index_lock."""
+        evicted = []
+        swept = 0
+        while self._sessions and (sweep_limit is None or swept < sweep_limit):
+            session_id, (session, last_used) = next(iter(self._sessions.items()))
+            if now - last_used < self._idle_ttl_seconds:
+                break
+            del self._sessions[session_id]
+            evicted.append((session_id, session, "idle"))
+            swept += 1
+
+        while len(self._sessions) > self._max_entries:
+            session_id, (session, _) = self._sessions.popitem(last=False)
+            evicted.append((session_id, session, "lru"))
+        return evicted
+
+    def sweep(self):
+        """Evicts every expired session now, rather than a few per turn."""
+        with self._index_lock:
+            evicted = self._collect_evictions(time.monotonic(), None)
+        self._notify_evicted(evicted)
+
+    def get(self, session_id: str):
+        entry = self._sessions.get(session_id)
+        return entry[0].copy() if entry is not None else None
+
+    def delete(self, session_id: str):
+        with self._index_lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions in a local SQLite file, shared by every worker process on the
+    same host. Each turn runs inside a BEGIN IMMEDIATE transaction, which
+    holds the database write lock from the read until the write.
+
+    Sessions idle for longer than idle_ttl_seconds are evicted by a sweep
+    that runs every SWEEP_EVERY turns, which also drops expired responses.
+    The file lives on disk, so there is no entry limit.
+    """
+
+    SWEEP_EVERY = 100
+    SWEEP_BATCH = 100
+
+    def __init__(self, path: str = SESSION_STORE_PATH,
+                 idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS, on_evict=None,
+                 response_ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS):
+        super().__init__(on_evict)
+        self._path = path
+        self._idle_ttl_seconds = idle_ttl_seconds
+        self._response_ttl_seconds = response_ttl_seconds
+        self._turns = 0
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, "
+            "data TEXT NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        # The last turn's response per session, for replay to a retried request
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_responses ("
+            "session_id TEXT PRIMARY KEY, "
+            "data TEXT NOT NULL, "
+            "stored_at REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly below
+            conn = sqlite3.connect(
+                self._path,
+                timeout=SESSION_LOCK_WAIT_SECONDS,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self, session_id: str):
+        conn = self._connection()
+        now = time.time()
+        evicted = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data, updated_at FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is not None and now - row[1] >= self._idle_ttl_seconds:
+                # Expired but not swept yet; the customer starts over
+                evicted.append((session_id, decode_session(row[0]), "idle"))
+                row = None
+            session = decode_session(row[0] if row else None)
+            if self._response_ttl_seconds > 0:
+                stored = conn.execute(
+                    "SELECT data FROM session_responses WHERE session_id = ? AND stored_at > ?",
+                    (session_id, now - self._response_ttl_seconds),
+                ).fetchone()
+                session.last_response = decode_response(stored[0]) if stored else None
+            loaded_response = session.last_response
+            yield session
+            if session.items:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?)",
+                    (session_id, encode_session(session), now),
+                )
+            else:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            if self._response_ttl_seconds > 0 and session.last_response is not loaded_response:
+                conn.execute(
+                    "INSERT OR REPLACE INTO session_responses (session_id, data, stored_at) VALUES (?, ?, ?)",
+                    (session_id, encode_response(session.last_response), now),
+                )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+        self._turns += 1
+        if self._turns % self.SWEEP_EVERY == 0:
+            evicted.extend(self._collect_expired(now, self.SWEEP_BATCH))
+        self._notify_evicted(evicted)
+
+    def _collect_expired(self, now: float, limit: int):
+        """Deletes up to limit expired sessions and returns them."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT session_id, data FROM sessions WHERE updated_at <= ? ORDER BY updated_at LIMIT ?",
+                (now - self._idle_ttl_seconds, limit),
+            ).fetchall()
+            conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(row[0],) for row in rows])
+            conn.execute("DELETE FROM session_responses WHERE stored_at <= ?", (now - self._response_ttl_seconds,))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return [(session_id, decode_session(data), "idle") for session_id, data in rows]
+
+    def sweep(self):
+        """Evicts every expired session now."""
+        while True:
+            evicted = self._collect_expired(time.time(), self.SWEEP_BATCH)
+            self._notify_evicted(evicted)
+            if len(evicted) < self.SWEEP_BATCH:
+                return
+
+    def get(self, session_id: str):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return decode_session(row[0]) if row else None
+
+    def delete(self, session_id: str):
+        conn = self._connection()
+        conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM session_responses WHERE session_id = ?", (session_id,))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions in any server that speaks the Redis protocol, shared by every
+    instance of the function.
+
+    Each end of a turn is one round trip running one script: the first takes
+    the session lock (SET NX PX) and returns the session with it, the last
+    writes the session and releases the lock, or on failure only releases
+    it. Both compare the lock's token, so a turn that overran its lock
+    refuses to write, and never releases a lock another turn has taken
+    since. The lock expires on its own after SESSION_LOCK_TIMEOUT_SECONDS if
+    an instance dies mid-turn.
+
+    Every write also records when the session was last used in a sorted
+    set. Sessions idle for longer than idle_ttl_seconds are evicted, and
+    handed to on_evict, by a sweep that runs every SWEEP_EVERY turns (or by a
+    turn that finds its own session expired). The sweep is a script, so when
+    several instances sweep at once each session is evicted by only one.
+    Keys also carry a TTL of twice the idle TTL, refreshed on every write,
+    so sessions still go away if no instance is left to sweep. The server's
+    own maxmemory policy bounds the entry count. Counting sessions would mean
+    scanning the keyspace, so the store does not report its size.
+
+    The last turn's response sits in its own key with a TTL of
+    response_ttl_seconds; the acquire script returns it with the session and
+    the commit script writes it with the session, so replay costs no extra
+    round trip.
+
+    The scripts also run against fakeredis (with Lua support) in tests.
+    """
+
+    KEY_PREFIX = "vos:session:"
+    LOCK_PREFIX = "vos:session-lock:"
+    RESPONSE_PREFIX = "vos:session-response:"
+    # Sorted set of session IDs scored by when they were last written (ms)
+    LAST_USED_KEY = "vos:sessions-last-used"
+    LOCK_RETRY_SECONDS = 0.005
+
+    SWEEP_EVERY = 100
+    SWEEP_BATCH = 100
+
+    counts_sessions = False
+
+    # KEYS: lock, session, last used, response; ARGV: token, lock ms, idle cutoff ms,
+    # session ID. Returns {0} if the lock is taken, else {1, session, response},
+    # or {2, session, response} for a session idle past the cutoff, which is removed
+    ACQUIRE_SCRIPT = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return {0}
+end
+local data = redis.call('GET', KEYS[2])
+local response = redis.call('GET', KEYS[4])
+local used = redis.call('ZSCORE', KEYS[3], ARGV[4])
+if data and used and tonumber(used) <= tonumber(ARGV[3]) then
+    redis.call('DEL', KEYS[2])
+    redis.call('ZREM', KEYS[3], ARGV[4])
+    return {2, data, response}
+end
+return {1, data, response}
+"""
+
+    # KEYS: lock, session, last used, response; ARGV: token, session ('' deletes it),
+    # TTL ms, session ID, now ms, response ('' leaves it), response TTL ms.
+    # Returns 0 if the lock was lost
+    COMMIT_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[2])
+    redis.call('ZREM', KEYS[3], ARGV[4])
+else
+    redis.call('SET', KEYS[2], ARGV[2], 'PX', ARGV[3])
+    redis.call('ZADD', KEYS[3], ARGV[5], ARGV[4])
+end
+if ARGV[6] ~= '' then
+    redis.call('SET', KEYS[4], ARGV[6], 'PX', ARGV[7])
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+    # KEYS: last used; ARGV: idle cutoff ms, limit, session prefix, lock prefix.
+    # Removes up to limit idle sessions not locked by a turn; returns {id, session, ...}
+    SWEEP_SCRIPT = """
+local evicted = {}
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])) do
+    if redis.call('EXISTS', ARGV[4] .. id) == 0 then
+        local data = redis.call('GET', ARGV[3] .. id)
+        redis.call('DEL', ARGV[3] .. id)
+        redis.call('ZREM', KEYS[1], id)
+        if data then
+            table.insert(evicted, id)
+            table.insert(evicted, data)
+        end
+    end
+end
+return evicted
+"""
+
+    # KEYS: lock; ARGV: token. Deletes the lock only if this turn still holds it
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, client=None, url: str = SESSION_STORE_URL,
+                 idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS, on_evict=None,
+                 response_ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS):
+        super().__init__(on_evict)
+        self._idle_ttl_ms = int(idle_ttl_seconds * 1000)
+        self._response_ttl_ms = int(response_ttl_seconds * 1000)
+        self._turns = 0
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self._client = client
+        # Sent by SHA after the first call, so each turn ships only keys and arguments
+        self._acquire_script = client.register_script(self.ACQUIRE_SCRIPT)
+        self._commit_script = client.register_script(self.COMMIT_SCRIPT)
+        self._release_script = client.register_script(self.RELEASE_SCRIPT)
+        self._sweep_script = client.register_script(self.SWEEP_SCRIPT)
+
+    @contextmanager
+    def transaction(self, session_id: str):
+        key = self.KEY_PREFIX + session_id
+        lock_key = self.LOCK_PREFIX + session_id
+        response_key = self.RESPONSE_PREFIX + session_id
+        keys = [lock_key, key, self.LAST_USED_KEY, response_key]
+        token = uuid.uuid4().hex
+        lock_ms = int(SESSION_LOCK_TIMEOUT_SECONDS * 1000)
+
+        evicted = []
+        raw, raw_response, expired = self._acquire(session_id, keys, token, lock_ms)
+        try:
+            if expired:
+                # Idle past the TTL but not swept yet; the customer starts over
+                evicted.append((session_id, decode_session(raw), "idle"))
+                raw = None
+            session = decode_session(raw)
+            if self._response_ttl_ms > 0:
+                session.last_response = decode_response(raw_response)
+            loaded_response = session.last_response
+            yield session
+        except BaseException:
+            self._release_script(keys=[lock_key], args=[token])
+            self._notify_evicted(evicted)
+            raise
+
+        data = encode_session(session) if session.items else ""
+        response = ""
+        if self._response_ttl_ms > 0 and session.last_response is not loaded_response:
+            response = encode_response(session.last_response)
+        now_ms = int(time.time() * 1000)
+        committed = self._commit_script(keys=keys, args=[token, data, 2 * self._idle_ttl_ms, session_id, now_ms,
+                                                         response, self._response_ttl_ms])
+
+        self._turns += 1
+        if self._turns % self.SWEEP_EVERY == 0:
+            evicted.extend(self._collect_expired(now_ms, self.SWEEP_BATCH))
+        self._notify_evicted(evicted)
+        if not committed:
+            raise SessionLockTimeout(f"Turn for session {session_id} outlived its lock; not writing")
+
+    def _acquire(self, session_id: str, keys: list, token: str, lock_ms: int):
+        """
+        Takes the session lock and reads the session and last response in one
+        round trip; returns (stored session, stored response, whether the
+        session had expired and was removed).
+        """
+        deadline = time.monotonic() + SESSION_LOCK_WAIT_SECONDS
+        while True:
+            cutoff_ms = int(time.time() * 1000) - self._idle_ttl_ms
+            result = self._acquire_script(keys=keys, args=[token, lock_ms, cutoff_ms, session_id])
+            if result[0]:
+                raw = result[1] if len(result) > 1 else None
+                raw_response = result[2] if len(result) > 2 else None
+                return raw, raw_response, result[0] == 2
+            if time.monotonic() >= deadline:
+                raise SessionLockTimeout(f"Session {keys[1]} is locked by another turn")
+            time.sleep(self.LOCK_RETRY_SECONDS)
+
+    def _collect_expired(self, now_ms: int, limit: int):
+        """Removes up to limit expired sessions and returns them."""
+        result = self._sweep_script(keys=[self.LAST_USED_KEY],
+                                    args=[now_ms - self._idle_ttl_ms, limit, self.KEY_PREFIX, self.LOCK_PREFIX])
+        evicted = []
+        for index in range(0, len(result), 2):
+            session_id = result[index].decode() if isinstance(result[index], bytes) else result[index]
+            evicted.append((session_id, decode_session(result[index + 1]), "idle"))
+        return evicted
+
+    def sweep(self):
+        """Evicts every expired session now."""
+        while True:
+            evicted = self._collect_expired(int(time.time() * 1000), self.SWEEP_BATCH)
+            self._notify_evicted(evicted)
+            if len(evicted) < self.SWEEP_BATCH:
+                return
+
+    def get(self, session_id: str):
+        raw = self._client.get(self.KEY_PREFIX + session_id)
+        return decode_session(raw) if raw is not None else None
+
+    def delete(self, session_id: str):
+        pipe = self._client.pipeline(transaction=True)
+        pipe.delete(self.KEY_PREFIX + session_id, self.RESPONSE_PREFIX + session_id)
+        pipe.zrem(self.LAST_USED_KEY, session_id)
+        pipe.execute()
+
+
+def create_session_store(backend: str = SESSION_STORE_BACKEND, on_evict=None) -> SessionStore:
+    """
+    Builds the session store selected by configuration. on_evict is called for
+    sessions the store evicts as idle (or, in memory, beyond its entry limit).
+    """
+    if backend == "memory":
+        store = InMemorySessionStore(on_evict=on_evict)
+    elif backend == "sqlite":
+        store = SQLiteSessionStore(on_evict=on_evict)
+    elif backend == "redis":
+        store = RedisSessionStore(on_evict=on_evict)
+    else:
+        raise ValueError(f"Unknown session store backend: {backend}")
+
+    logger.info(f"Using {backend} session store")
+    return store
@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# How long to wait for a listener's initial snapshot before falling back to a plain read
+LISTENER_STARTUP_TIMEOUT_SECONDS = 5.0
+
+
+CACHE_LOOKUPS = metrics.counter(
+    "vos_cache_lookups_total", "Cache reads served from memory (hit) or that had to load (miss).",
+    ("cache", "result")
+)
+
+
+def _hit_ratios() -> dict:
+    totals = {}
+    for (cache, result), count in CACHE_LOOKUPS.values().items():
+        hits, lookups = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (count if result == "hit" else 0), lookups + count)
+    return {(cache,): hits / lookups for cache, (hits, lookups) in totals.items() if lookups}
+
+
+metrics.gauge("vos_cache_hit_ratio", "Share of cache reads served from memory since start.", _hit_ratios, ("cache",))
+
+
+class SnapshotCache:
+    """
+    Base class for in-process caches of data read through the repositories.
+
+    The cache is filled on first use and then kept current by an on_snapshot
+    listener. When no listener can be attached (or it never delivers a first
+    snapshot, or later stops after a stream error) the cache falls back to
+    reloading itself once its TTL expires.
+
+    Subclasses provide how to subscribe to changes, how to read the data
+    directly and how to turn a list of document snapshots into cached state.
+    """
+
+    name = "snapshot cache"
+
+    def __init__(self, ttl_seconds: float, use_listener: bool):
+        self._ttl_seconds = ttl_seconds
+        self._use_listener = use_listener
+        self._loaded_at = None
+        self._watch = None
+        self._first_snapshot = threading.Event()
+        self._lock = threading.Lock()
+        # Bumped every time the cached state is replaced
+        self.version = 0
+        label = self.name.lower().replace(" ", "_")
+        self._hits = CACHE_LOOKUPS.labels(label, "hit")
+        self._misses = CACHE_LOOKUPS.labels(label, "miss")
+
+    def _listen(self, callback):
+        """Subscribes callback to changes and returns a handle with unsubscribe()."""
+        raise NotImplementedError
+
+    def _fetch(self):
+        """Reads the reference directly and returns a list of document snapshots."""
+        raise NotImplementedError
+
+    def _apply(self, docs):
+        """Rebuilds the cached state from a list of document snapshots."""
+        raise NotImplementedError
+
+    def cached_state(self):
+        """The objects the cache holds, for measuring its memory."""
+        raise NotImplementedError
+
+    def is_fresh(self) -> bool:
+        if self._loaded_at is None:
+            return False
+        watch = self._watch
+        if watch is not None:
+            if watch.is_active:
+                return True
+            self._listener_stopped(watch)
+        return time.monotonic() - self._loaded_at < self._ttl_seconds
+
+    def _listener_stopped(self, watch):
+        """
+        Drops a listener that stopped delivering changes. Firestore closes
+        the watch after a non-recoverable stream error without telling the
+        callback, so this is noticed here; the cached data may be stale from
+        then on, so the TTL counts from the last snapshot.
+        """
+        if self._watch is not watch:
+            return
+        self._watch = None
+        self._use_listener = False
+        logger.warning(f"{self.name} snapshot listener stopped, falling back to TTL refresh")
+
+    def ensure_loaded(self):
+        """Loads the cache if it is empty or, without a listener, stale."""
+        if self.is_fresh():
+            self._hits.inc()
+            return
+        self._misses.inc()
+        with self._lock:
+            # Another thread may have loaded it while we waited for the lock
+            if self.is_fresh():
+                return
+            if self._use_listener and self._watch is None and self._start_listener():
+                return
+            self.refresh()
+
+    def seed(self, docs):
+        """
+        Fills an empty cache from saved document snapshots (e.g. a warm
+        snapshot file) without reading Firestore, then brings it up to date
+        in the background. Until then, and if that fails, the seeded data is
+        served and the usual TTL reload applies.
+        """
+        with self._lock:
+            if self._loaded_at is not None:
+                return
+            self._replace(docs)
+        threading.Thread(target=self._catch_up, name=f"{self.name} catch-up", daemon=True).start()
+
+    def _catch_up(self):
+        try:
+            with self._lock:
+                if self._use_listener and self._watch is None and self._start_listener():
+                    return
+                self.refresh()
+        except Exception as e:
+            logger.warning(f"{self.name} could not be refreshed after seeding, serving seeded data: {str(e)}")
+
+    def refresh(self):
+        """Reloads the cached data with a direct read."""
+        started = time.monotonic()
+        self._replace(self._fetch())
+        logger.info(f"{self.name} loaded in {(time.monotonic() - started) * 1000:.1f}ms")
+
+    def close(self):
+        """Detaches the snapshot listener, if any."""
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+
+    def _start_listener(self) -> bool:
+        """Attaches an on_snapshot listener and waits for its first snapshot."""
+        try:
+            self._first_snapshot.clear()
+            self._watch = self._listen(self._on_snapshot)
+        except Exception as e:
+            logger.warning(f"{self.name} listener unavailable, falling back to TTL refresh: {str(e)}")
+            self._watch = None
+            self._use_listener = False
+            return False
+
+        if self._first_snapshot.wait(LISTENER_STARTUP_TIMEOUT_SECONDS):
+            logger.info(f"{self.name} attached to snapshot listener")
+            return True
+
+        logger.warning(f"{self.name} listener did not deliver a snapshot in time, loading directly")
+        self._watch.unsubscribe()
+        self._watch = None
+        self._use_listener = False
+        return False
+
+    def _on_snapshot(self, docs, changes, read_time):
+        """Listener callback; Firestore delivers the full result set on every change."""
+        try:
+            self._replace(docs)
+            if self._first_snapshot.is_set():
+                logger.info(f"{self.name} updated from snapshot: {len(changes)} changes")
+            self._first_snapshot.set()
+        except Exception as e:
+            logger.error(f"Error applying {self.name} snapshot: {str(e)}", exc_info=True)
+
+    def _replace(self, docs):
+        self._apply(docs)
+        self._loaded_at = time.monotonic()
+        self.version += 1
@@ -0,0 +1,301 @@
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Where the store a request belongs to comes from: "none" (a single store,
+# served from the top-level collections), "project" (the Dialogflow project
+# ID) or "session" (the session ID up to STORE_SESSION_SEPARATOR)
+STORE_ID_SOURCE = os.environ.get("STORE_ID_SOURCE", "none")
+
+# Separates the store ID from the rest of the session ID, e.g. "store42_3f9c..."
+STORE_SESSION_SEPARATOR = os.environ.get("STORE_SESSION_SEPARATOR", "_")
+
+# Memory the compiled menu, limits and upsell caches of all stores may take
+# together; past it the least recently served stores are dropped (and reloaded
+# on their next request)
+STORE_CACHE_BUDGET_MB = float(os.environ.get("STORE_CACHE_BUDGET_MB", "64"))
+
+# Stores whose caches are held at most, whatever their size: each holds up to
+# three snapshot listeners, which the memory budget does not see
+STORE_MAX_CACHED = int(os.environ.get("STORE_MAX_CACHED", "200"))
+
+# How long a store ID without a menu is refused before its menu is read again
+STORE_UNKNOWN_TTL_SECONDS = float(os.environ.get("STORE_UNKNOWN_TTL_SECONDS", "60"))
+
+_current_store = contextvars.ContextVar("vos_store", default=None)
+
+
+class UnknownStore(LookupError):
+    """Raised for a request naming a store that has no menu."""
+
+
+def store_id_for(request, source: str = STORE_ID_SOURCE):
+    """The ID of the store a webhook request belongs to, or None for the single default store."""
+    if source == "project":
+        return request.project_id or None
+    if source == "session":
+        store_id, separator, _ = request.session_id.partition(STORE_SESSION_SEPARATOR)
+        return store_id if separator and store_id else None
+    return None
+
+
+def store_collection(store_id, collection: str) -> str:
+    """A store's own collection, e.g. stores/<store_id>/menu_items; the top-level one for the default store."""
+    if store_id is None:
+        return collection
+    return f"stores/{store_id}/{collection}"
+
+
+def session_key(store_id, session_id: str) -> str:
+    """The session store key of a conversation, so two stores' sessions never share state."""
+    if store_id is None:
+        return session_id
+    return f"{store_id}/{session_id}"
+
+
+def split_session_key(key: str) -> tuple:
+    """Returns (store_id, session_id) for a session_key(); store_id is None for the default store."""
+    store_id, separator, session_id = key.rpartition("/")
+    return (store_id, session_id) if separator else (None, key)
+
+
+_ATOMIC = (str, bytes, int, float, bool, type(None))
+
+
+def approximate_size(root) -> int:
+    """
+    Bytes taken by an object graph of containers and slotted or plain
+    objects, each object counted once. Classes, functions and other
+    callables are not followed.
+    """
+    seen = {id(root)}
+    stack = [root]
+    total = sys.getsizeof(root)
+    slots = {}
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            children = [*obj.keys(), *obj.values()]
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            children = obj
+        elif isinstance(obj, _ATOMIC) or isinstance(obj, type) or callable(obj):
+            continue
+        else:
+            cls = type(obj)
+            names = slots.get(cls)
+            if names is None:
+                names = slots[cls] = [name for base in cls.__mro__ for name in getattr(base, "__slots__", ())]
+            children = [getattr(obj, name) for name in names if hasattr(obj, name)]
+            if hasattr(obj, "__dict__"):
+                children.append(obj.__dict__)
+        for child in children:
+            if id(child) in seen:
+                continue
+            seen.add(id(child))
+            total += sys.getsizeof(child)
+            # Strings and numbers have nothing to follow, so skip the stack
+            if not isinstance(child, _ATOMIC):
+                stack.append(child)
+    return total
+
+
+class StoreCaches:
+    """
+    One store's compiled menu, order limits and upsell caches. size_bytes is
+    kept up to date by measuring each cache again after it reloads.
+    """
+
+    __slots__ = ("store_id", "menu_catalog", "order_limits_config", "upsell_config", "size_bytes", "_measured")
+
+    def __init__(self, store_id, menu_catalog, order_limits_config, upsell_config):
+        self.store_id = store_id
+        self.menu_catalog = menu_catalog
+        self.order_limits_config = order_limits_config
+        self.upsell_config = upsell_config
+        self.size_bytes = 0
+        # Cache -> (version, bytes) when it was last measured
+        self._measured = {}
+
+    @property
+    def caches(self) -> tuple:
+        return self.menu_catalog, self.order_limits_config, self.upsell_config
+
+    def exists(self) -> bool:
+        """Whether the store has a menu; loads it, which the store's first request needs anyway."""
+        return bool(self.menu_catalog.items())
+
+    def measure(self) -> bool:
+        """Re-measures the caches that reloaded since the last call; returns whether any did."""
+        changed = False
+        for cache in self.caches:
+            version = cache.version
+            measured = self._measured.get(cache)
+            if measured is None or measured[0] != version:
+                self._measured[cache] = (version, approximate_size(cache.cached_state()))
+                changed = True
+        if changed:
+            self.size_bytes = sum(size for _, size in self._measured.values())
+        return changed
+
+    def close(self):
+        """Detaches the caches' snapshot listeners."""
+        for cache in self.caches:
+            cache.close()
+
+
+class StoreDirectory:
+    """
+    The caches of every store this instance serves, created on a store's
+    first request by factory(store_id).
+
+    Stores are kept in least recently served order. Whenever, after a
+    request, the measured size of all of them exceeds budget_bytes, or their
+    number exceeds max_stores, the least recently served are dropped (and
+    their listeners detached) until both fit, so busy stores stay warm while
+    a long tail of quiet ones cannot exhaust memory. The default store
+    (store_id None) is never dropped.
+
+    A store ID whose menu turns out empty is not kept: get() raises
+    UnknownStore for it, without reading its menu again, for unknown_ttl
+    seconds.
+    """
+
+    def __init__(self, factory, default: StoreCaches, budget_bytes: int = int(STORE_CACHE_BUDGET_MB * 1024 * 1024),
+                 max_stores: int = STORE_MAX_CACHED, unknown_ttl: float = STORE_UNKNOWN_TTL_SECONDS):
+        self._factory = factory
+        self._default = default
+        self._budget_bytes = budget_bytes
+        self._max_stores = max_stores
+        self._unknown_ttl = unknown_ttl
+        self._stores = OrderedDict()
+        # store_id -> monotonic time until which it is refused, oldest first
+        self._unknown = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.rejections = 0
+
+    def peek(self, store_id):
+        """Returns the store's caches if they are held, else None; never creates or loads them."""
+        if store_id is None:
+            return self._default
+        with self._lock:
+            return self._stores.get(store_id)
+
+    def get(self, store_id) -> StoreCaches:
+        """
+        Returns the store's caches, creating them and loading the store's
+        menu on first use, and marks the store as recently served. Raises
+        UnknownStore if the store has no menu.
+        """
+        if store_id is None:
+            return self._default
+        with self._lock:
+            store = self._stores.get(store_id)
+            if store is not None:
+                self._stores.move_to_end(store_id)
+                return store
+            self._check_known(store_id)
+
+        # Loaded outside the lock, so other stores are served meanwhile
+        store = self._factory(store_id)
+        try:
+            known = store.exists()
+        except Exception:
+            store.close()
+            raise
+        if not known:
+            store.close()
+            with self._lock:
+                self._unknown[store_id] = time.monotonic() + self._unknown_ttl
+                while len(self._unknown) > self._max_stores:
+                    self._unknown.popitem(last=False)
+                self.rejections += 1
+            logger.warning(f"Store {store_id} has no menu; refusing its requests")
+            raise UnknownStore(store_id)
+
+        with self._lock:
+            existing = self._stores.get(store_id)
+            if existing is not None:
+                self._stores.move_to_end(store_id)
+            else:
+                self._stores[store_id] = store
+                evicted = self._evict(keep=store_id)
+        if existing is not None:
+            # Another request created it first
+            store.close()
+            return existing
+        logger.info(f"Created caches for store {store_id}")
+        self._close(evicted)
+        return store
+
+    def _check_known(self, store_id):
+        """Raises UnknownStore for a store refused less than unknown_ttl ago; callers hold _lock."""
+        refused_until = self._unknown.get(store_id)
+        if refused_until is None:
+            return
+        if time.monotonic() < refused_until:
+            self.rejections += 1
+            raise UnknownStore(store_id)
+        del self._unknown[store_id]
+
+    def account(self, store: StoreCaches):
+        """
+        Re-measures a store after serving it, since its caches load (or
+        reload) during requests, and drops cold stores if that went over budget.
+        """
+        if not store.measure():
+            return
+        with self._lock:
+            evicted = self._evict(keep=store.store_id)
+        self._close(evicted)
+
+    def _evict(self, keep) -> list:
+        """Drops least recently served stores other than keep while over budget; callers hold _lock."""
+        evicted = []
+        total = self.size_bytes()
+        count = len(self._stores)
+        for store_id in list(self._stores):
+            if total <= self._budget_bytes and count <= self._max_stores:
+                break
+            if store_id == keep:
+                continue
+            cold = self._stores.pop(store_id)
+            total -= cold.size_bytes
+            count -= 1
+            evicted.append(cold)
+        self.evictions += len(evicted)
+        return evicted
+
+    @staticmethod
+    def _close(evicted: list):
+        for cold in evicted:
+            cold.close()
+            logger.info(f"Dropped caches of store {cold.store_id} ({cold.size_bytes} bytes) to stay within budget")
+
+    def size_bytes(self) -> int:
+        return self._default.size_bytes + sum(store.size_bytes for store in list(self._stores.values()))
+
+    def __len__(self):
+        return len(self._stores)
+
+
+@contextmanager
+def use_store(store: StoreCaches):
+    """Scopes the store being served to the current request (thread or task)."""
+    token = _current_store.set(store)
+    try:
+        yield store
+    finally:
+        _current_store.reset(token)
+
+
+def current_store():
+    """The store of the request being served, or None outside use_store()."""
+    return _current_store.get()
@@ -0,0 +1,118 @@
+import contextvars
+import json
+import logging
+import os
+import random
+from contextlib import contextmanager
+
+# json: one JSON object per line, which Cloud Logging ingests as structured
+# entries; text: the plain "LEVEL: message" lines, handier for local development
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# Share of requests whose request and response bodies are logged; LOG_BODIES
+# (or DEBUG level) logs every one
+LOG_BODY_SAMPLE_RATE = float(os.environ.get("LOG_BODY_SAMPLE_RATE", "0.01"))
+LOG_BODIES = os.environ.get("LOG_BODIES", "false").lower() == "true"
+
+# Logged bodies are cut to this many characters
+LOG_BODY_MAX_CHARS = int(os.environ.get("LOG_BODY_MAX_CHARS", "2048"))
+
+# Per-request fields attached to every record emitted while handling that
+# request, and structured fields a record may carry through extra=
+REQUEST_FIELDS = ("session_id", "intent", "response_id", "trace_id", "latency_ms", "metrics")
+
+_request_fields = contextvars.ContextVar("vos_request_fields", default=None)
+
+
+@contextmanager
+def request_context(**fields):
+    """Scopes per-request log fields to the current request (thread or task)."""
+    token = _request_fields.set(dict(fields))
+    try:
+        yield
+    finally:
+        _request_fields.reset(token)
+
+
+def bind(**fields):
+    """Adds fields to the current request's log context; a no-op outside request_context()."""
+    current = _request_fields.get()
+    if current is not None:
+        current.update(fields)
+
+
+def should_log_bodies(logger: logging.Logger) -> bool:
+    """Decides, once per request, whether its request and response bodies are logged."""
+    if LOG_BODIES or logger.isEnabledFor(logging.DEBUG):
+        return True
+    return LOG_BODY_SAMPLE_RATE > 0 and random.random() < LOG_BODY_SAMPLE_RATE
+
+
+class Payload:
+    """
+    Log argument wrapping a request or response body. It is serialized and
+    truncated only if the record is actually emitted, so passing one to a
+    filtered-out log call costs nothing beyond the wrapper.
+    """
+
+    __slots__ = ("_value", "_max_chars")
+
+    def __init__(self, value, max_chars: int = LOG_BODY_MAX_CHARS):
+        self._value = value
+        self._max_chars = max_chars
+
+    def __str__(self):
+        try:
+            text = json.dumps(self._value, default=str, separators=(",", ":"))
+        except (TypeError, ValueError):
+            text = repr(self._value)
+        if len(text) > self._max_chars:
+            return f"{text[:self._max_chars]}...<{len(text) - self._max_chars} more chars>"
+        return text
+
+
+def _record_fields(record: logging.LogRecord) -> dict:
+    fields = dict(_request_fields.get() or ())
+    # Fields passed through extra= override the request context
+    for name in REQUEST_FIELDS:
+        value = record.__dict__.get(name)
+        if value is not None:
+            fields[name] = value
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as Cloud Logging structured JSON lines."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+        }
+        entry.update(_record_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats records as 'LEVEL: message' followed by any request fields."""
+
+    def __init__(self):
+        super().__init__("%(levelname)s: %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        text = super().formatMessage(record)
+        fields = _record_fields(record)
+        if not fields:
+            return text
+        return f"{text} [{' '.join(f'{name}={value}' for name, value in fields.items())}]"
+
+
+def configure_logging():
+    """Installs the configured formatter on the root logger."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
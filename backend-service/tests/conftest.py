@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The service modules live flat in backend-service/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests that import main get the in-memory data backend seeded from
+# firestore/*.json, no warm snapshot and a journal of their own
+os.environ.update(
+    DATA_BACKEND="memory",
+    SESSION_STORE_BACKEND="memory",
+    WARM_SNAPSHOT_PATH="",
+    LOG_LEVEL="WARNING",
+    ORDER_JOURNAL_PATH=os.path.join(tempfile.mkdtemp(prefix="vos-tests-"), "journal.sqlite3"),
+)
+
+
+@pytest.fixture(scope="session")
+def service():
+    """The main module, imported once for every test that needs the whole service."""
+    pytest.importorskip("functions_framework")
+    import main
+    return main
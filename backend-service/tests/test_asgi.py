@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def asgi(service):
+    import asgi
+    return asgi
+
+
+def call(asgi, method: str, path: str, body: bytes = b"", query: bytes = b"", headers=()):
+    """Runs one request through the ASGI app; returns (status, body)."""
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": list(headers)}
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def turn(session: str, intent: str, parameters: dict, response_id: str) -> bytes:
+    name = f"projects/p/agent/sessions/{session}"
+    return json.dumps({
+        "responseId": response_id,
+        "session": name,
+        "queryResult": {"intent": {"displayName": intent}, "parameters": parameters,
+                        "outputContexts": [{"name": f"{name}/contexts/ongoing-order", "parameters": parameters}]},
+    }).encode()
+
+
+def test_webhook_turns(asgi):
+    status, body = call(asgi, "POST", "/", turn("asgi-1", "order.food", {"food-item": ["Big Mac"], "number": 2}, "r1"))
+    assert status == 200
+    payload = json.loads(body)
+    assert payload["payload"]["order_summary"]["item_count"] == 2
+
+    status, body = call(asgi, "POST", "/", turn("asgi-1", "order.complete", {}, "r2"))
+    assert status == 200
+    assert json.loads(body)["fulfillmentText"].startswith("Great! Your order is: 2 Big Mac")
+
+
+def test_rejected_requests(asgi, monkeypatch):
+    assert call(asgi, "PUT", "/")[0] == 405
+    assert call(asgi, "POST", "/", b"{not json")[0] == 400
+    monkeypatch.setattr(asgi, "ASGI_MAX_BODY_BYTES", 10)
+    assert call(asgi, "POST", "/", turn("asgi-2", "order.food", {}, "r1"))[0] == 413
+
+
+def test_metrics(asgi):
+    status, body = call(asgi, "GET", "/metrics")
+    assert status == 200
+    assert b"vos_" in body
+
+
+def test_kitchen_long_poll(asgi):
+    status, body = call(asgi, "GET", "/kitchen", query=b"timeout=0")
+    assert status == 200
+    cursor = json.loads(body)["cursor"]
+
+    call(asgi, "POST", "/", turn("asgi-3", "order.food", {"food-item": ["Big Mac"], "number": 1}, "r1"))
+    call(asgi, "POST", "/", turn("asgi-3", "order.complete", {}, "r2"))
+    status, body = call(asgi, "GET", "/kitchen", query=f"after={cursor}&timeout=1".encode())
+    events = json.loads(body)["events"]
+    assert [event["order"]["session_id"] for event in events] == ["asgi-3"]
+
+    assert call(asgi, "GET", "/kitchen", query=b"timeout=soon")[0] == 400
@@ -0,0 +1,40 @@
+from cart import CartLine, Session
+
+
+def big_mac(quantity: int = 1) -> CartLine:
+    return CartLine("1001", "Big Mac", quantity, 599)
+
+
+def test_changing_a_copy_leaves_the_session_alone():
+    session = Session([big_mac()])
+    copy = session.copy()
+    copy.replace(0, copy.items[0].with_customizations(("no onions",)))
+    copy.set_quantity(0, 3)
+    copy.add(big_mac())
+
+    assert session.to_dict() == {"items": [big_mac().to_dict()], "total_amount": 5.99, "item_count": 1}
+    assert copy.items[0].customizations == ("no onions",)
+    assert copy.item_count == 4
+
+
+def test_serialized_cart_follows_every_change():
+    session = Session()
+    assert session.to_dict()["items"] == []
+    session.add(big_mac())
+    assert session.to_dict() is session.to_dict()
+    assert session.to_dict()["item_count"] == 1
+    session.set_quantity(0, 2)
+    assert session.to_dict()["items"][0]["quantity"] == 2
+    assert session.to_dict()["total_amount"] == 11.98
+    session.add(big_mac())
+    session.remove(0)
+    assert session.to_dict()["item_count"] == 1
+    session.clear()
+    assert session.to_dict() == {"items": [], "total_amount": 0.0, "item_count": 0}
+
+
+def test_round_trip_through_the_stored_form():
+    session = Session([big_mac(2).with_customizations(("extra cheese",))])
+    restored = Session.from_dict(session.to_dict())
+    assert restored.to_dict() == session.to_dict()
+    assert restored.total_cents == 1198
@@ -0,0 +1,99 @@
+from kitchen_feed import KitchenFeed
+
+
+def order(order_id: str, status: str = "completed", store_id: str = None) -> dict:
+    return {
+        "id": order_id,
+        "session_id": "abc",
+        "store_id": store_id,
+        "status": status,
+        "items": [{"item_id": "1001", "name": "Big Mac", "quantity": 1, "item_total": 5.99}],
+    }
+
+
+def ids(events) -> list:
+    return [event["order"]["id"] for event in events]
+
+
+def test_new_subscriber_gets_only_new_orders():
+    feed = KitchenFeed()
+    feed.publish([order("a")])
+    subscription = feed.subscribe()
+
+    assert subscription.take() == ([], False)
+    feed.publish([order("b"), order("c", status="abandoned"), order("b")])
+    events, reset = subscription.take()
+    assert ids(events) == ["b"]
+    assert not reset
+    assert "item_total" not in events[0]["order"]["items"][0]
+
+
+def test_reconnect_with_cursor_replays_what_was_missed():
+    feed = KitchenFeed()
+    feed.publish([order("a")])
+    cursor = feed.poll(cursor="0", timeout=0)["cursor"]
+    feed.publish([order("b"), order("c")])
+
+    result = feed.poll(cursor=cursor, timeout=0)
+    assert ids(result["events"]) == ["b", "c"]
+    assert not result["reset"]
+    assert result["cursor"] == feed.cursor(3)
+
+
+def test_unknown_cursor_replays_the_log_as_a_reset():
+    feed = KitchenFeed()
+    feed.publish([order("a"), order("b")])
+
+    for cursor in ("0", "otherepoch:1", feed.cursor(99)):
+        result = feed.poll(cursor=cursor, timeout=0)
+        assert ids(result["events"]) == ["a", "b"]
+        assert result["reset"]
+    assert feed.resets == 3
+
+
+def test_cursor_older_than_the_log_is_a_reset():
+    feed = KitchenFeed(replay_events=2)
+    feed.publish([order("a")])
+    cursor = feed.cursor(1)
+    feed.publish([order("b"), order("c"), order("d")])
+
+    result = feed.poll(cursor=cursor, timeout=0)
+    assert ids(result["events"]) == ["c", "d"]
+    assert result["reset"]
+
+
+def test_slow_subscriber_catches_up_from_the_log():
+    feed = KitchenFeed(buffer_size=2)
+    subscription = feed.subscribe()
+    subscription.take()
+    feed.publish([order(str(number)) for number in range(5)])
+
+    events, reset = subscription.take()
+    assert ids(events) == ["0", "1", "2", "3", "4"]
+    assert not reset
+
+
+def test_store_subscriber_is_sent_and_woken_for_its_store_only():
+    feed = KitchenFeed()
+    woken = []
+    subscription = feed.subscribe(wake=lambda: woken.append(True), store_id="s1")
+    subscription.take()
+
+    feed.publish([order("a", store_id="s2")])
+    assert woken == []
+    assert subscription.take() == ([], False)
+
+    feed.publish([order("b", store_id="s1")])
+    assert woken == [True]
+    events, _ = subscription.take()
+    assert ids(events) == ["b"]
+
+
+def test_store_cursor_moves_past_other_stores_orders():
+    feed = KitchenFeed()
+    feed.publish([order("a", store_id="s1"), order("b", store_id="s2")])
+
+    result = feed.poll(cursor="0", timeout=0, store_id="s1")
+    assert ids(result["events"]) == ["a"]
+    assert result["cursor"] == feed.cursor(2)
+    assert feed.poll(cursor=result["cursor"], timeout=0, store_id="s1")["events"] == []
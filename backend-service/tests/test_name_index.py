@@ -0,0 +1,55 @@
+import pytest
+
+from name_index import NameIndex, edit_distance, normalize_name
+
+MENU = [{"name": "Big Mac"}, {"name": "French Fries"}, {"name": "Coca Cola"}, {"name": "Quarter Pounder"},
+        {"name": "Apple Pie"}]
+SYNONYMS = {"bigmac": "Big Mac", "fries": "French Fries", "coke": "Coca Cola", "sprite": "Sprite"}
+
+
+@pytest.fixture
+def index():
+    return NameIndex(MENU, SYNONYMS)
+
+
+def name(item):
+    return item["name"] if item is not None else None
+
+
+@pytest.mark.parametrize("spoken, expected", [
+    ("big mac", "Big Mac"),
+    ("BIG-MAC", "Big Mac"),
+    ("coke", "Coca Cola"),
+    ("Fries", "French Fries"),
+    ("cokes", "Coca Cola"),
+    ("apple pies", "Apple Pie"),
+])
+def test_names_synonyms_and_plurals(index, spoken, expected):
+    assert name(index.resolve(spoken)) == expected
+
+
+@pytest.mark.parametrize("spoken, expected", [
+    ("quarter poundr", "Quarter Pounder"),
+    ("quater pounder", "Quarter Pounder"),
+    ("cocacolla", "Coca Cola"),
+    ("frnch fries", "French Fries"),
+])
+def test_typos_within_the_edit_budget(index, spoken, expected):
+    assert name(index.resolve(spoken)) == expected
+
+
+@pytest.mark.parametrize("spoken", ["", "sprite", "pizza", "cake", "quartr poundr burger"])
+def test_no_match(index, spoken):
+    # sprite is a synonym of something not on the menu; short names get no typo budget
+    assert index.resolve(spoken) is None
+
+
+def test_synonyms_never_shadow_menu_names():
+    index = NameIndex([{"name": "Fries"}, {"name": "French Fries"}], {"fries": "French Fries"})
+    assert name(index.resolve("fries")) == "Fries"
+
+
+def test_edit_distance_stops_past_the_limit():
+    assert edit_distance(normalize_name("Quarter Pounder"), "quaterpounder", 2) == 1
+    assert edit_distance("bigmac", "bigmacs", 1) == 1
+    assert edit_distance("bigmac", "hamburger", 2) == 3
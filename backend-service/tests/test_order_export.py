@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from order_export import export_orders, line_item_rows, order_row
+from repositories import InMemoryBackend, OrderRepository
+
+
+def order(order_id: str, minutes_ago: int = 10) -> dict:
+    created_at = datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)
+    return {
+        "id": order_id,
+        "session_id": "abc",
+        "status": "completed",
+        "created_at": created_at,
+        "completed_at": created_at,
+        "items": [
+            {"item_id": "1001", "name": "Big Mac", "quantity": 3, "base_price": 0.1, "size": "large",
+             "size_price": 0.2, "item_total": 0.9, "customizations": ["no pickles"]},
+        ],
+        "total_amount": 0.9,
+    }
+
+
+def test_money_is_exported_as_integer_cents():
+    row = order_row(order("a"))
+    line = line_item_rows(order("a"))[0]
+
+    assert row["total_cents"] == 90
+    assert (line["base_price_cents"], line["size_price_cents"], line["item_total_cents"]) == (10, 20, 90)
+    assert "total_amount" not in row
+
+
+def test_parquet_money_columns_are_int64(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    repository = OrderRepository(InMemoryBackend())
+    repository.save_orders([order("a"), order("b"), order("new", minutes_ago=0)])
+
+    stats = export_orders(repository, str(tmp_path), formats=("parquet",), page_size=1)
+
+    assert stats["orders"] == 2
+    orders = pq.read_table(str(tmp_path / "orders-00000.parquet"))
+    items = pq.read_table(str(tmp_path / "order_items-00000.parquet"))
+    assert orders.schema.field("total_cents").type == pa.int64()
+    assert items.schema.field("item_total_cents").type == pa.int64()
+    assert sum(orders.column("total_cents").to_pylist()) == 180
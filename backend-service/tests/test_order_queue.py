@@ -0,0 +1,115 @@
+import pytest
+
+import order_queue
+from order_queue import OrderJournal, OrderWriter
+
+
+class FlakyRepository:
+    """Stands in for the OrderRepository; fails the orders in bad, or every write while down."""
+
+    def __init__(self, bad=()):
+        self.saved = {}
+        self.calls = []
+        self.bad = set(bad)
+        self.down = False
+
+    def save_orders(self, orders):
+        self.calls.append([order["id"] for order in orders])
+        if self.down or any(order["id"] in self.bad for order in orders):
+            raise RuntimeError("write failed")
+        self.saved.update((order["id"], order) for order in orders)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(order_queue, "ORDER_RETRY_BASE_SECONDS", 0)
+    monkeypatch.setattr(order_queue, "ORDER_RETRY_MAX_SECONDS", 0)
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "journal.sqlite3")
+
+
+@pytest.fixture
+def manual_writer(journal_path, monkeypatch):
+    """Builds writers without the background thread; the test flushes them with _flush_once()."""
+    monkeypatch.setattr(OrderWriter, "_start", lambda self: None)
+
+    def build(repository, **kwargs):
+        return OrderWriter(repository, OrderJournal(journal_path), batch_size=10, **kwargs)
+    return build
+
+
+def order(order_id: str) -> dict:
+    return {"id": order_id, "status": "completed", "items": []}
+
+
+def test_orders_left_by_a_crashed_process_are_written_on_start(journal_path):
+    journal = OrderJournal(journal_path)
+    journal.append("a", order("a"))
+    journal.append("b", order("b"))
+
+    repository = FlakyRepository()
+    writer = OrderWriter(repository, OrderJournal(journal_path))
+    assert writer.flush(5)
+    assert set(repository.saved) == {"a", "b"}
+    assert OrderJournal(journal_path).depth() == 0
+
+
+def test_failed_batch_is_retried_until_written(manual_writer):
+    repository = FlakyRepository()
+    repository.down = True
+    writer = manual_writer(repository)
+
+    writer.enqueue(order("a"))
+    writer.enqueue(order("b"))
+    assert not writer._flush_once()
+    assert writer.stats()["queue_depth"] == 2
+
+    repository.down = False
+    assert writer._flush_once()
+    assert set(repository.saved) == {"a", "b"}
+    assert writer.stats()["queue_depth"] == 0
+
+
+def test_bad_order_does_not_hold_up_the_batch(manual_writer):
+    repository = FlakyRepository(bad={"b"})
+    writer = manual_writer(repository, dead_letter_attempts=3)
+
+    for order_id in "abc":
+        writer.enqueue(order(order_id))
+    assert writer._flush_once()
+    assert set(repository.saved) == {"a", "c"}
+    assert writer.stats()["queue_depth"] == 1
+
+    # b keeps failing on its own until it is set aside
+    assert not writer._flush_once()
+    assert not writer._flush_once()
+    assert writer.stats()["queue_depth"] == 0
+    assert writer.stats()["failed_orders"] == 1
+
+    repository.bad.clear()
+    assert writer.requeue_failed() == 1
+    assert writer._flush_once()
+    assert set(repository.saved) == {"a", "b", "c"}
+    assert writer.stats()["failed_orders"] == 0
+
+
+def test_writes_stop_after_repeated_single_failures(manual_writer):
+    repository = FlakyRepository()
+    repository.down = True
+    writer = manual_writer(repository)
+
+    for index in range(6):
+        writer.enqueue(order(str(index)))
+    writer._flush_once()
+    # The batch, then ORDER_SINGLE_RETRY_FAILURES single writes, not one per order
+    assert len(repository.calls) == 1 + order_queue.ORDER_SINGLE_RETRY_FAILURES
+    assert writer.stats()["queue_depth"] == 6
+
+
+def test_order_id_is_stable_across_retries_of_a_turn():
+    assert OrderWriter.order_id_for("session", "response-1") == OrderWriter.order_id_for("session", "response-1")
+    assert OrderWriter.order_id_for("session", "response-1") != OrderWriter.order_id_for("session", "response-2")
+    assert OrderWriter.order_id_for("session", "") != OrderWriter.order_id_for("session", "")
@@ -0,0 +1,57 @@
+import time
+
+from response_cache import ResponseCache
+
+
+def test_retry_is_replayed():
+    cache = ResponseCache(ttl_seconds=60, max_entries=10)
+    cache.put("abc", "r1", {"fulfillmentText": "Added."})
+
+    assert cache.get("abc", "r1") == {"fulfillmentText": "Added."}
+    assert cache.get("abc", "r2") is None
+    assert cache.get("other", "r1") is None
+    assert cache.replays == 1
+
+
+def test_requests_without_an_id_are_not_cached():
+    cache = ResponseCache(ttl_seconds=60, max_entries=10)
+    cache.put("abc", None, {"fulfillmentText": "Added."})
+
+    assert cache.get("abc", None) is None
+    assert len(cache) == 0
+
+
+def test_entries_expire():
+    cache = ResponseCache(ttl_seconds=0.05, max_entries=10)
+    cache.put("abc", "r1", {})
+    time.sleep(0.1)
+
+    assert cache.get("abc", "r1") is None
+    cache.put("abc", "r2", {})
+    assert len(cache) == 1
+
+
+def test_oldest_entries_are_evicted_first():
+    cache = ResponseCache(ttl_seconds=60, max_entries=2)
+    for response_id in ("r1", "r2", "r3"):
+        cache.put("abc", response_id, {"id": response_id})
+
+    assert cache.get("abc", "r1") is None
+    assert cache.get("abc", "r2") == {"id": "r2"}
+    assert cache.get("abc", "r3") == {"id": "r3"}
+
+
+def test_discarded_turn_runs_again():
+    cache = ResponseCache(ttl_seconds=60, max_entries=10)
+    cache.put("abc", "r1", {})
+    cache.discard("abc", "r1")
+
+    assert cache.get("abc", "r1") is None
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(ttl_seconds=0, max_entries=10)
+    cache.put("abc", "r1", {})
+
+    assert not cache.enabled
+    assert cache.get("abc", "r1") is None
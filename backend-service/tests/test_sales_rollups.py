@@ -0,0 +1,59 @@
+from datetime import date, datetime, timezone
+
+import pytest
+
+from repositories import InMemoryBackend, SalesRollupRepository, SQLiteBackend
+from sales_rollups import SalesRollups
+
+DAY = date(2024, 2, 6)
+
+
+def order(order_id: str, status: str = "completed") -> dict:
+    return {
+        "id": order_id,
+        "status": status,
+        "completed_at": datetime(2024, 2, 6, 12, 30, tzinfo=timezone.utc),
+        "items": [{"item_id": "1001", "name": "Big Mac", "quantity": 2, "item_total": 11.98}],
+        "total_amount": 11.98,
+    }
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def rollups(request, tmp_path):
+    if request.param == "memory":
+        backend = InMemoryBackend()
+    else:
+        backend = SQLiteBackend(str(tmp_path / "data.sqlite3"))
+    return SalesRollups(SalesRollupRepository(backend), shards=4)
+
+
+def test_replayed_batch_counts_each_order_once(rollups):
+    assert rollups.record_orders([order("a"), order("b")]) == ["a", "b"]
+    # e.g. the write-behind batch retried after the journal failed to drop it
+    assert rollups.record_orders([order("a"), order("b"), order("c")]) == ["c"]
+
+    today = rollups.query(DAY)
+    assert today["orders"] == 3
+    assert today["items_sold"] == 6
+    assert today["revenue"] == pytest.approx(35.94)
+
+
+def test_other_orders_are_not_marked(rollups):
+    assert rollups.record_orders([order("a", status="abandoned")]) == []
+    assert rollups.record_orders([order("a")]) == ["a"]
+    assert rollups.query(DAY)["orders"] == 1
+
+
+def test_rebuilt_orders_are_not_counted_again(rollups):
+    rollups.rebuild([[order("a")]])
+    assert rollups.record_orders([order("a")]) == []
+    assert rollups.query(DAY)["orders"] == 1
+
+
+def test_rebuild_adds_up_pages(rollups):
+    assert rollups.rebuild([[order("a"), order("b")], [order("c", status="abandoned")], [order("d")]]) == 2
+    assert rollups.record_orders([order("a"), order("d")]) == []
+
+    today = rollups.query(DAY)
+    assert today["orders"] == 3
+    assert today["items_sold"] == 6
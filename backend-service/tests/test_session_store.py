@@ -0,0 +1,217 @@
+import threading
+import time
+
+import pytest
+
+import session_store
+from cart import CartLine
+from session_store import InMemorySessionStore, RedisSessionStore, SessionLockTimeout
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+
+def line(quantity: int = 1) -> CartLine:
+    return CartLine("1001", "Big Mac", quantity, 599)
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def redis_store(server, **kwargs) -> RedisSessionStore:
+    """A store with its own client, like one function instance."""
+    return RedisSessionStore(client=fakeredis.FakeRedis(server=server), **kwargs)
+
+
+def test_transaction_writes_session_back(server):
+    store = redis_store(server)
+    with store.transaction("abc") as session:
+        session.add(line(2))
+
+    stored = store.get("abc")
+    assert stored.item_count == 2
+    assert stored.total_cents == 1198
+
+
+def test_empty_cart_is_deleted(server):
+    store = redis_store(server)
+    with store.transaction("abc") as session:
+        session.add(line())
+    with store.transaction("abc") as session:
+        session.clear()
+
+    assert store.get("abc") is None
+    assert not fakeredis.FakeRedis(server=server).keys("*")
+
+
+def test_failed_turn_leaves_session_and_releases_lock(server):
+    store = redis_store(server)
+    with store.transaction("abc") as session:
+        session.add(line())
+
+    with pytest.raises(RuntimeError):
+        with store.transaction("abc") as session:
+            session.add(line(5))
+            raise RuntimeError("handler failed")
+
+    assert store.get("abc").item_count == 1
+    with store.transaction("abc") as session:
+        assert session.item_count == 1
+
+
+def test_lock_excludes_other_instances(server, monkeypatch):
+    monkeypatch.setattr(session_store, "SESSION_LOCK_WAIT_SECONDS", 0.05)
+    first, second = redis_store(server), redis_store(server)
+
+    with first.transaction("abc"):
+        with pytest.raises(SessionLockTimeout):
+            with second.transaction("abc"):
+                pass
+
+    with second.transaction("abc"):
+        pass
+
+
+def test_overrun_turn_neither_writes_nor_releases_the_new_lock(server, monkeypatch):
+    monkeypatch.setattr(session_store, "SESSION_LOCK_TIMEOUT_SECONDS", 0.05)
+    monkeypatch.setattr(session_store, "SESSION_LOCK_WAIT_SECONDS", 0.01)
+    slow, fast = redis_store(server), redis_store(server)
+
+    with pytest.raises(SessionLockTimeout):
+        with slow.transaction("abc") as session:
+            session.add(line(9))
+            time.sleep(0.1)
+            # The lock expired and another turn holds it now
+            client = fakeredis.FakeRedis(server=server)
+            assert client.set(RedisSessionStore.LOCK_PREFIX + "abc", "other", nx=True, px=5000)
+
+    assert slow.get("abc") is None
+    assert fakeredis.FakeRedis(server=server).get(RedisSessionStore.LOCK_PREFIX + "abc") == b"other"
+    with pytest.raises(SessionLockTimeout):
+        with fast.transaction("abc"):
+            pass
+
+
+def test_unswept_sessions_expire_at_twice_the_idle_ttl(server):
+    store = redis_store(server, idle_ttl_seconds=0.05)
+    with store.transaction("abc") as session:
+        session.add(line())
+
+    ttl_ms = fakeredis.FakeRedis(server=server).pttl(RedisSessionStore.KEY_PREFIX + "abc")
+    assert 50 < ttl_ms <= 100
+    time.sleep(0.15)
+    assert store.get("abc") is None
+
+
+def test_concurrent_turns_are_serialized(server):
+    instances = [redis_store(server) for _ in range(4)]
+    turns = 25
+
+    def customer(store):
+        for _ in range(turns):
+            with store.transaction("abc") as session:
+                if session.items:
+                    session.set_quantity(0, session.items[0].quantity + 1)
+                else:
+                    session.add(line())
+
+    threads = [threading.Thread(target=customer, args=(store,)) for store in instances for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert instances[0].get("abc").item_count == len(threads) * turns
+
+
+def test_in_memory_failed_turn_leaves_session():
+    store = InMemorySessionStore()
+    with store.transaction("abc") as session:
+        session.add(line())
+
+    with pytest.raises(RuntimeError):
+        with store.transaction("abc") as session:
+            session.set_quantity(0, 4)
+            session.add(line())
+            raise RuntimeError("handler failed")
+
+    stored = store.get("abc")
+    assert stored.item_count == 1
+    assert stored.items[0].quantity == 1
+
+
+def test_idle_sessions_are_swept_to_the_eviction_hook_once(server):
+    evicted = []
+    instances = [redis_store(server, idle_ttl_seconds=0.2,
+                             on_evict=lambda session_id, session, reason: evicted.append((session_id, reason)))
+                 for _ in range(2)]
+    with instances[0].transaction("abandoned") as session:
+        session.add(line())
+    time.sleep(0.25)
+    with instances[1].transaction("active") as session:
+        session.add(line())
+
+    for store in instances:
+        store.sweep()
+
+    assert evicted == [("abandoned", "idle")]
+    assert instances[0].get("abandoned") is None
+    assert instances[0].get("active") is not None
+
+
+def test_expired_session_found_by_its_next_turn_is_evicted(server):
+    evicted = []
+    store = redis_store(server, idle_ttl_seconds=0.2,
+                        on_evict=lambda session_id, session, reason: evicted.append(session.item_count))
+    with store.transaction("abc") as session:
+        session.add(line(3))
+    time.sleep(0.25)
+
+    with store.transaction("abc") as session:
+        assert not session.items
+
+    assert evicted == [3]
+
+
+def test_last_response_is_committed_with_the_session(server):
+    first, second = redis_store(server), redis_store(server)
+    with first.transaction("abc") as session:
+        session.clear()
+        session.last_response = ("r1", {"fulfillmentText": "Your order is placed."})
+
+    # A retry reaching another instance, with the cart already emptied
+    with second.transaction("abc") as session:
+        assert session.replay("r1") == {"fulfillmentText": "Your order is placed."}
+        assert session.replay("r2") is None
+
+    ttl_ms = fakeredis.FakeRedis(server=server).pttl(RedisSessionStore.RESPONSE_PREFIX + "abc")
+    assert 0 < ttl_ms <= session_store.RESPONSE_CACHE_TTL_SECONDS * 1000
+
+
+def test_failed_turn_leaves_no_response(server):
+    store = redis_store(server)
+    with pytest.raises(RuntimeError):
+        with store.transaction("abc") as session:
+            session.last_response = ("r1", {"fulfillmentText": "Added."})
+            raise RuntimeError("handler failed")
+
+    with store.transaction("abc") as session:
+        assert session.replay("r1") is None
+
+
+def test_sqlite_last_response_is_shared_and_expires(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    first = session_store.SQLiteSessionStore(path, response_ttl_seconds=0.2)
+    second = session_store.SQLiteSessionStore(path, response_ttl_seconds=0.2)
+    with first.transaction("abc") as session:
+        session.add(line())
+        session.last_response = ("r1", {"fulfillmentText": "Added."})
+
+    with second.transaction("abc") as session:
+        assert session.replay("r1") == {"fulfillmentText": "Added."}
+    time.sleep(0.25)
+    with second.transaction("abc") as session:
+        assert session.replay("r1") is None
+        assert session.item_count == 1
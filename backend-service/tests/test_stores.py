@@ -0,0 +1,93 @@
+import pytest
+
+from stores import StoreCaches, StoreDirectory, UnknownStore, session_key, split_session_key
+
+
+class FakeCache:
+    """Stands in for a snapshot cache: a version, a state to measure, and close()."""
+
+    def __init__(self, items=(), padding: int = 0):
+        self.version = 1
+        self._items = list(items)
+        self._state = "x" * padding
+        self.closed = False
+
+    def items(self) -> list:
+        return self._items
+
+    def cached_state(self):
+        return self._state
+
+    def close(self):
+        self.closed = True
+
+
+def caches(store_id, menu=("Big Mac",), padding: int = 1000) -> StoreCaches:
+    return StoreCaches(store_id, FakeCache(menu, padding), FakeCache(), FakeCache())
+
+
+class Factory:
+    def __init__(self, menu=("Big Mac",)):
+        self.menu = menu
+        self.created = []
+
+    def __call__(self, store_id) -> StoreCaches:
+        store = caches(store_id, self.menu)
+        self.created.append(store)
+        return store
+
+
+def serve(directory: StoreDirectory, store_id) -> StoreCaches:
+    store = directory.get(store_id)
+    directory.account(store)
+    return store
+
+
+def test_least_recently_served_stores_are_dropped_over_budget():
+    factory = Factory()
+    directory = StoreDirectory(factory, caches(None), budget_bytes=2500)
+    first = serve(directory, "s1")
+    serve(directory, "s2")
+    serve(directory, "s1")
+    serve(directory, "s3")
+
+    assert directory.peek("s2") is None
+    assert directory.peek("s1") is first and directory.peek("s3") is not None
+    assert factory.created[1].menu_catalog.closed
+    assert directory.evictions == 1
+    assert directory.peek(None) is not None
+
+
+def test_store_count_is_capped_under_budget():
+    factory = Factory()
+    directory = StoreDirectory(factory, caches(None), budget_bytes=10 ** 9, max_stores=2)
+    for store_id in ("s1", "s2", "s3"):
+        serve(directory, store_id)
+
+    assert len(directory) == 2
+    assert directory.peek("s1") is None
+
+
+def test_store_without_a_menu_is_refused_until_the_ttl_passes():
+    factory = Factory(menu=())
+    directory = StoreDirectory(factory, caches(None), unknown_ttl=60)
+    for _ in range(2):
+        with pytest.raises(UnknownStore):
+            directory.get("nowhere")
+
+    assert len(factory.created) == 1
+    assert factory.created[0].menu_catalog.closed
+    assert directory.rejections == 2
+    assert len(directory) == 0
+
+    directory = StoreDirectory(factory, caches(None), unknown_ttl=0)
+    for _ in range(2):
+        with pytest.raises(UnknownStore):
+            directory.get("nowhere")
+    assert len(factory.created) == 3
+
+
+def test_session_keys_keep_stores_apart():
+    assert session_key("s1", "abc") != session_key("s2", "abc")
+    assert split_session_key(session_key("s1", "abc")) == ("s1", "abc")
+    assert split_session_key(session_key(None, "abc")) == (None, "abc")
@@ -0,0 +1,79 @@
+import sys
+
+import pytest
+
+from upsell import UpsellTable, build_store_upsell_configs, build_upsell_config, cooccurrence_counts, top_k_table
+
+
+def order(order_id: str, item_ids, status: str = "completed", store_id: str = None) -> dict:
+    return {
+        "id": order_id,
+        "status": status,
+        "store_id": store_id,
+        "items": [{"item_id": item_id, "quantity": 1} for item_id in item_ids],
+    }
+
+
+# A is in 3 orders, B in 3, C in 2; A+B in 2, A+C in 2, B+C in 1
+PAGES = [
+    [order("1", ["A", "B"]), order("2", ["A", "B", "C", "A"])],
+    [order("3", ["A", "C"]), order("4", ["B"]), order("5", ["A", "B"], status="abandoned")],
+]
+
+
+@pytest.fixture(params=["numpy", "python"])
+def counter(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setitem(sys.modules, "numpy", None)
+    return request.param
+
+
+def test_pairs_are_counted_per_order(counter):
+    item_ids, counts, orders = cooccurrence_counts(PAGES)
+
+    assert orders == 4
+    by_id = {item_id: index for index, item_id in enumerate(item_ids)}
+    expected = {("A", "A"): 3, ("B", "B"): 3, ("C", "C"): 2, ("A", "B"): 2, ("A", "C"): 2, ("B", "C"): 1}
+    for (first, second), count in expected.items():
+        assert counts[by_id[first]][by_id[second]] == count
+        assert counts[by_id[second]][by_id[first]] == count
+
+
+def test_suggestions_are_ranked_by_confidence(counter):
+    table = top_k_table(*cooccurrence_counts(PAGES)[:2], top_k=2, min_support=1)
+
+    assert table == {
+        "A": [{"item_id": "B", "score": 0.6667}, {"item_id": "C", "score": 0.6667}],
+        "B": [{"item_id": "A", "score": 0.6667}, {"item_id": "C", "score": 0.3333}],
+        "C": [{"item_id": "A", "score": 1.0}, {"item_id": "B", "score": 0.5}],
+    }
+    assert top_k_table(*cooccurrence_counts(PAGES)[:2], top_k=1, min_support=2) == {
+        "A": [{"item_id": "B", "score": 0.6667}],
+        "B": [{"item_id": "A", "score": 0.6667}],
+        "C": [{"item_id": "A", "score": 1.0}],
+    }
+
+
+def test_cart_suggestion_adds_up_scores():
+    table = UpsellTable(build_upsell_config(PAGES, top_k=2, min_support=1))
+
+    assert table.orders == 4
+    assert table.suggest(["B", "C"]) == "A"
+    assert table.suggest(["A"]) == "B"
+    assert table.suggest(["A"], available=lambda item_id: item_id != "B") == "C"
+    assert table.suggest(["A", "B", "C"]) is None
+    assert table.suggest(["unknown"]) is None
+
+
+def test_each_store_gets_a_table_from_its_own_orders():
+    pages = [[order("1", ["A", "B"], store_id="s1"), order("2", ["A", "C"], store_id="s2")],
+             [order("3", ["A", "B"], store_id="s1"), order("4", ["B", "C"])]]
+    configs = build_store_upsell_configs(pages, top_k=2, min_support=1)
+
+    assert set(configs) == {"s1", "s2", None}
+    assert configs["s1"]["orders"] == 2
+    assert configs["s1"]["suggestions"]["A"] == [{"item_id": "B", "score": 1.0}]
+    assert configs["s2"]["suggestions"]["A"] == [{"item_id": "C", "score": 1.0}]
+    assert set(build_store_upsell_configs(pages, store_ids=["s2"])) == {"s2"}
@@ -0,0 +1,299 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Where finished traces go: "none" (tracing off), "file" (OTLP JSON lines
+# appended to TRACE_FILE_PATH) or "memory" (kept in process, for tests)
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "none").lower()
+TRACE_FILE_PATH = os.environ.get("TRACE_FILE_PATH", "/tmp/vos-traces.jsonl")
+
+# Share of requests traced; the decision is made once, when a trace starts
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+
+SERVICE_NAME = "vos-fulfilment"
+
+# OTLP status codes
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar("vos_current_span", default=None)
+
+
+def _new_id(n_bytes: int) -> str:
+    return f"{random.getrandbits(n_bytes * 8):0{n_bytes * 2}x}"
+
+
+def _attribute_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class _Trace:
+    """Spans of one sampled request, exported together when the root span ends."""
+
+    __slots__ = ("trace_id", "root", "spans")
+
+    def __init__(self):
+        self.trace_id = _new_id(16)
+        self.root = None
+        self.spans = []
+
+
+class Span:
+    """
+    A timed operation within a trace. Use as a context manager: entering
+    makes it the parent of spans started inside the block, and an exception
+    escaping the block marks it as failed.
+    """
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes",
+                 "start_ns", "end_ns", "status", "status_message", "_token")
+
+    recording = True
+
+    def __init__(self, trace: _Trace, name: str, parent_id: str = None, attributes: dict = None):
+        self.trace = trace
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.start_ns = None
+        self.end_ns = None
+        self.status = STATUS_UNSET
+        self.status_message = None
+        self._token = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.status = STATUS_ERROR
+            self.status_message = f"{exc_type.__name__}: {exc}"
+        self.trace.spans.append(self)
+        if self is self.trace.root:
+            _export(self.trace.spans)
+        return False
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 2 if self is self.trace.root else 1,  # SERVER for the request, INTERNAL below it
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class _UnsampledSpan:
+    """Root of a request that was not sampled: spans started below it record nothing."""
+
+    __slots__ = ("_token",)
+
+    recording = False
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        return False
+
+
+class _NoopSpan:
+    """Shared stand-in for spans outside a sampled trace; entering it costs nothing."""
+
+    __slots__ = ()
+
+    recording = False
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def otlp_payload(spans) -> dict:
+    """Wraps spans in an OTLP ExportTraceServiceRequest, as accepted by OpenTelemetry collectors."""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [span.to_otlp() for span in spans]}],
+        }]
+    }
+
+
+class InMemorySpanExporter:
+    """Keeps finished spans in process, so traces can be inspected offline and in tests."""
+
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock:
+            self._spans.extend(spans)
+
+    def get_finished_spans(self) -> list:
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans = []
+
+
+class FileSpanExporter:
+    """Appends each finished trace to a file as one line of OTLP JSON."""
+
+    def __init__(self, path: str = TRACE_FILE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps(otlp_payload(spans), separators=(",", ":"))
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+def _create_exporter(kind: str):
+    if kind == "none":
+        return None
+    if kind == "file":
+        return FileSpanExporter()
+    if kind == "memory":
+        return InMemorySpanExporter()
+    raise ValueError(f"Unknown trace exporter: {kind}")
+
+
+_exporter = _create_exporter(TRACE_EXPORTER)
+_sample_rate = TRACE_SAMPLE_RATE
+
+
+def configure_tracing(exporter, sample_rate: float = None):
+    """Replaces the exporter (None turns tracing off) and, optionally, the sample rate."""
+    global _exporter, _sample_rate
+    _exporter = exporter
+    if sample_rate is not None:
+        _sample_rate = sample_rate
+
+
+def _export(spans):
+    exporter = _exporter
+    if exporter is None:
+        return
+    try:
+        exporter.export(spans)
+    except Exception as e:
+        logger.warning(f"Could not export trace: {str(e)}")
+
+
+def trace(name: str, attributes: dict = None):
+    """
+    Starts a trace for a request, subject to sampling, or continues the
+    current one as a child span when called inside a trace already.
+    """
+    parent = _current_span.get()
+    if parent is not None:
+        if not parent.recording:
+            return NOOP_SPAN
+        return Span(parent.trace, name, parent.span_id, attributes)
+    if _exporter is None:
+        return NOOP_SPAN
+    if random.random() >= _sample_rate:
+        return _UnsampledSpan()
+    new_trace = _Trace()
+    new_trace.root = Span(new_trace, name, None, attributes)
+    return new_trace.root
+
+
+def span(name: str, attributes: dict = None):
+    """Starts a child of the current span; a no-op outside a sampled trace."""
+    parent = _current_span.get()
+    if parent is None or not parent.recording:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def traced(name: str, root: bool = False):
+    """
+    Decorator running each call of a function in a child span. With root,
+    a call made outside any trace starts one, as trace() does.
+
+    When TRACE_EXPORTER is "none" functions are left undecorated, so
+    disabled tracing adds no call overhead; enabling it later with
+    configure_tracing() then records only explicit trace()/span() blocks.
+    """
+    def decorate(function):
+        if TRACE_EXPORTER == "none":
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            parent = _current_span.get()
+            if parent is None and root:
+                with trace(name):
+                    return function(*args, **kwargs)
+            if parent is None or not parent.recording:
+                return function(*args, **kwargs)
+            with Span(parent.trace, name, parent.span_id):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def set_trace_attributes(attributes: dict):
+    """Sets attributes (e.g. request identifiers) on the root span of the current trace."""
+    current = _current_span.get()
+    if current is None or not current.recording:
+        return
+    for key, value in attributes.items():
+        if value is not None:
+            current.trace.root.attributes[key] = value
+
+
+def current_trace_id():
+    """The current trace's ID, or None outside a sampled trace."""
+    current = _current_span.get()
+    if current is None or not current.recording:
+        return None
+    return current.trace.trace_id
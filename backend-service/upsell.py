@@ -0,0 +1,286 @@
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timezone
+
+from snapshot_cache import SnapshotCache
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Suggest an item bought together with the cart after order.food/order.drink turns
+UPSELL_ENABLED = os.environ.get("UPSELL_ENABLED", "true").lower() == "true"
+
+# How long a table loaded without a snapshot listener stays fresh
+UPSELL_TTL_SECONDS = float(os.environ.get("UPSELL_TTL_SECONDS", "300"))
+
+# Keep the table live through a snapshot listener when the data backend supports one
+UPSELL_USE_LISTENER = os.environ.get("UPSELL_USE_LISTENER", "true").lower() == "true"
+
+# Suggestions kept per item by the build job
+UPSELL_TOP_K = int(os.environ.get("UPSELL_TOP_K", "5"))
+
+# Pairs bought together in fewer orders than this are not suggested
+UPSELL_MIN_SUPPORT = int(os.environ.get("UPSELL_MIN_SUPPORT", "5"))
+
+# The configs document the table is published to and loaded from
+UPSELL_CONFIG = "upsell"
+
+
+def _baskets(orders) -> list:
+    """The distinct item IDs of each completed order."""
+    return [
+        sorted({line["item_id"] for line in order.get("items", [])})
+        for order in orders if order.get("status") == "completed"
+    ]
+
+
+class CooccurrenceCounter:
+    """
+    Counts, page by page, how many completed orders contain each pair of
+    items. result() returns (item_ids, counts, orders) where counts[i][j] is
+    the number of orders with both item_ids[i] and item_ids[j], and
+    counts[i][i] the number with item_ids[i].
+
+    With NumPy each page becomes an order-by-item incidence matrix M and the
+    counts are the sum of M.T @ M; menus are small, so the item-by-item
+    matrix is kept dense. Without NumPy the pairs are counted one by one.
+    """
+
+    def __init__(self):
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        self._np = np
+        self._index = {}
+        self._counts = np.zeros((0, 0), dtype=np.int64) if np is not None else Counter()
+        self.orders = 0
+
+    def add(self, orders):
+        baskets = _baskets(orders)
+        if not baskets:
+            return
+        if self._np is None:
+            self._add_python(baskets)
+        else:
+            self._add_numpy(baskets)
+        self.orders += len(baskets)
+
+    def _add_numpy(self, baskets: list):
+        np = self._np
+        index = self._index
+        for basket in baskets:
+            for item_id in basket:
+                index.setdefault(item_id, len(index))
+        size = len(index)
+        if self._counts.shape[0] < size:
+            grow = size - self._counts.shape[0]
+            self._counts = np.pad(self._counts, ((0, grow), (0, grow)))
+        lengths = [len(basket) for basket in baskets]
+        rows = np.repeat(np.arange(len(baskets)), lengths)
+        columns = np.fromiter((index[item_id] for basket in baskets for item_id in basket),
+                              dtype=np.intp, count=sum(lengths))
+        incidence = np.zeros((len(baskets), size), dtype=np.int32)
+        incidence[rows, columns] = 1
+        self._counts += incidence.T @ incidence
+
+    def _add_python(self, baskets: list):
+        for basket in baskets:
+            columns = [self._index.setdefault(item_id, len(self._index)) for item_id in basket]
+            for first in columns:
+                for second in columns:
+                    self._counts[(first, second)] += 1
+
+    def result(self) -> tuple:
+        if self._np is not None:
+            return list(self._index), self._counts.tolist(), self.orders
+        counts = [[0] * len(self._index) for _ in self._index]
+        for (first, second), count in self._counts.items():
+            counts[first][second] = count
+        return list(self._index), counts, self.orders
+
+
+def cooccurrence_counts(pages) -> tuple:
+    """(item_ids, counts, orders) over pages of orders; see CooccurrenceCounter."""
+    counter = CooccurrenceCounter()
+    for page in pages:
+        counter.add(page)
+    return counter.result()
+
+
+def top_k_table(item_ids, counts, top_k: int = UPSELL_TOP_K, min_support: int = UPSELL_MIN_SUPPORT) -> dict:
+    """
+    {item_id: [{"item_id", "score"}, ...]}: for each item, the top_k items
+    most often bought with it, scored by the share of its orders that also
+    contain them (confidence), best first.
+    """
+    table = {}
+    for i, item_id in enumerate(item_ids):
+        orders_with_item = counts[i][i]
+        candidates = [
+            (counts[i][j] / orders_with_item, other_id)
+            for j, other_id in enumerate(item_ids)
+            if j != i and counts[i][j] >= min_support
+        ]
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        if candidates:
+            table[item_id] = [{"item_id": other_id, "score": round(score, 4)} for score, other_id in candidates[:top_k]]
+    return table
+
+
+def _upsell_config(counter: CooccurrenceCounter, top_k: int, min_support: int) -> dict:
+    item_ids, counts, orders = counter.result()
+    return {
+        "suggestions": top_k_table(item_ids, counts, top_k, min_support),
+        "orders": orders,
+        "top_k": top_k,
+        "min_support": min_support,
+        "built_at": datetime.now(timezone.utc),
+    }
+
+
+def build_upsell_config(pages, top_k: int = UPSELL_TOP_K, min_support: int = UPSELL_MIN_SUPPORT) -> dict:
+    """The configs/upsell document for the orders in pages."""
+    counter = CooccurrenceCounter()
+    for page in pages:
+        counter.add(page)
+    return _upsell_config(counter, top_k, min_support)
+
+
+def build_store_upsell_configs(pages, top_k: int = UPSELL_TOP_K, min_support: int = UPSELL_MIN_SUPPORT,
+                               store_ids=None) -> dict:
+    """
+    {store_id: configs/upsell document} from one pass over pages of orders,
+    each store's table counted from its own orders only (store_id None for
+    orders of the default store). With store_ids, only those stores.
+    """
+    counters = {}
+    for page in pages:
+        by_store = {}
+        for order in page:
+            store_id = order.get("store_id")
+            if store_ids is None or store_id in store_ids:
+                by_store.setdefault(store_id, []).append(order)
+        for store_id, orders in by_store.items():
+            counter = counters.get(store_id)
+            if counter is None:
+                counter = counters[store_id] = CooccurrenceCounter()
+            counter.add(orders)
+    return {store_id: _upsell_config(counter, top_k, min_support) for store_id, counter in counters.items()}
+
+
+class UpsellTable:
+    """
+    Parsed form of the configs/upsell document: for each item, the items
+    bought with it as (item_id, score) tuples, best first.
+    """
+
+    __slots__ = ("suggestions", "orders")
+
+    def __init__(self, config: dict):
+        self.suggestions = {
+            item_id: tuple((entry["item_id"], entry["score"]) for entry in entries)
+            for item_id, entries in config.get("suggestions", {}).items()
+        }
+        self.orders = config.get("orders", 0)
+
+    def suggest(self, cart_item_ids, available=None):
+        """
+        Returns the item ID most often bought with the cart, adding up the
+        scores it has with each cart item; items already in the cart, and
+        those available(item_id) rejects, are skipped. None if there is none.
+        """
+        cart = set(cart_item_ids)
+        scores = {}
+        for item_id in cart:
+            for other_id, score in self.suggestions.get(item_id, ()):
+                if other_id not in cart:
+                    scores[other_id] = scores.get(other_id, 0.0) + score
+        for other_id, _ in sorted(scores.items(), key=lambda entry: (-entry[1], entry[0])):
+            if available is None or available(other_id):
+                return other_id
+        return None
+
+
+class UpsellConfig(SnapshotCache):
+    """
+    Process-wide cache of configs/upsell, so a suggestion is a few dict
+    lookups. Publishing a new table (python upsell.py build) reaches running
+    instances through the listener, or within UPSELL_TTL_SECONDS without one.
+    """
+
+    name = "Upsell table"
+
+    def __init__(self, repository, ttl_seconds: float = UPSELL_TTL_SECONDS,
+                 use_listener: bool = UPSELL_USE_LISTENER):
+        super().__init__(ttl_seconds, use_listener)
+        self._repository = repository
+        self._table = None
+
+    def current(self):
+        """Returns the current UpsellTable, or None until one is published."""
+        self.ensure_loaded()
+        return self._table
+
+    def cached_state(self):
+        return self._table
+
+    def _listen(self, callback):
+        return self._repository.watch_config(UPSELL_CONFIG, callback)
+
+    def _fetch(self):
+        return [self._repository.get_config(UPSELL_CONFIG)]
+
+    def _apply(self, docs):
+        doc = docs[0] if docs else None
+        if doc is None or not doc.exists:
+            self._table = None
+            logger.info("Upsell table not published yet, no suggestions will be made")
+            return
+
+        self._table = UpsellTable(doc.to_dict() or {})
+        logger.info(f"Upsell table loaded with suggestions for {len(self._table.suggestions)} items "
+                    f"from {self._table.orders} orders")
+
+
+if __name__ == "__main__":
+    # Rebuild the tables from the orders collection and publish them, e.g. nightly:
+    #   python upsell.py build [--store STORE_ID ...] [--top-k N] [--min-support N]
+    # Each store's table is counted from its own orders and published to its
+    # stores/<store_id>/configs (the default store's to configs). Orders are
+    # read page by page, so memory stays flat however many there are.
+    import argparse
+    import main
+    from repositories import ConfigRepository
+    from stores import store_collection
+
+    parser = argparse.ArgumentParser(description="Upsell table maintenance")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--store", action="append", default=None, help="only this store (repeatable)")
+    parser.add_argument("--top-k", type=int, default=UPSELL_TOP_K)
+    parser.add_argument("--min-support", type=int, default=UPSELL_MIN_SUPPORT)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    def pages():
+        after = None
+        while True:
+            page = main.order_repository.page_orders(after, args.page_size)
+            if not page:
+                return
+            yield page
+            after = (page[-1]["created_at"], page[-1]["id"])
+
+    configs = build_store_upsell_configs(pages(), args.top_k, args.min_support, args.store)
+    # Stores asked for (or the default one) get a table even without orders, replacing a stale one
+    for store_id in args.store or [None]:
+        if store_id not in configs:
+            configs[store_id] = build_upsell_config([], args.top_k, args.min_support)
+    for store_id, config in configs.items():
+        if store_id is None:
+            repository = main.config_repository
+        else:
+            repository = ConfigRepository(main.data_backend, store_collection(store_id, ConfigRepository.collection))
+        repository.put_configs({UPSELL_CONFIG: config})
+        logger.info(f"Published upsell suggestions for {len(config['suggestions'])} items from {config['orders']} "
+                    f"orders of store {store_id or 'default'}")
@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+import sys
+import time
+
+from repositories import SnapshotDocument
+
+logger = logging.getLogger("VOS-FULFILMENT")
+
+# Bumped whenever the file layout changes; files of another version are ignored
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+def write_warm_snapshot(path: str, menu_docs, limits_doc):
+    """
+    Saves the menu_items documents and the configs/order_limits document to
+    path. The file is written next to its destination and renamed into place,
+    so a reader never sees a partial snapshot.
+    """
+    snapshot = {
+        "version": SNAPSHOT_FORMAT_VERSION,
+        "created_at": time.time(),
+        "menu_items": [{"id": doc.id, "data": doc.to_dict()} for doc in menu_docs],
+        "order_limits": limits_doc.to_dict() if limits_doc is not None and limits_doc.exists else None,
+    }
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        # Fields the caches never read, such as timestamps, are kept as strings
+        json.dump(snapshot, f, default=str, separators=(",", ":"))
+    os.replace(temp_path, path)
+    logger.info(f"Wrote warm snapshot with {len(snapshot['menu_items'])} menu items to {path}")
+
+
+def read_warm_snapshot(path: str):
+    """Returns (menu_docs, limits_doc, created_at) from a snapshot file."""
+    with open(path) as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"unsupported snapshot version {snapshot.get('version')}")
+
+    menu_docs = [SnapshotDocument(entry["id"], entry["data"]) for entry in snapshot["menu_items"]]
+    limits_doc = SnapshotDocument("order_limits", snapshot.get("order_limits"))
+    return menu_docs, limits_doc, snapshot.get("created_at")
+
+
+def load_warm_snapshot(path: str, menu_catalog, order_limits_config) -> bool:
+    """
+    Seeds the menu catalog and order limits caches from a snapshot file, if
+    present. A missing or unreadable file only means a cold first request,
+    so errors are logged rather than raised.
+    """
+    if not path or not os.path.exists(path):
+        return False
+    try:
+        started = time.monotonic()
+        menu_docs, limits_doc, created_at = read_warm_snapshot(path)
+        menu_catalog.seed(menu_docs)
+        order_limits_config.seed([limits_doc])
+        age = f", {time.time() - created_at:.0f}s old" if created_at else ""
+        logger.info(
+            f"Seeded caches from warm snapshot {path} ({len(menu_docs)} menu items{age}) "
+            f"in {(time.monotonic() - started) * 1000:.1f}ms"
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error loading warm snapshot {path}: {str(e)}", exc_info=True)
+        return False
+
+
+if __name__ == "__main__":
+    # Refresh the snapshot from Firestore before deploying:
+    #   python warm_snapshot.py [path]
+    import main
+
+    output_path = sys.argv[1] if len(sys.argv) > 1 else main.WARM_SNAPSHOT_PATH
+    write_warm_snapshot(
+        output_path,
+        main.menu_repository.list_items(),
+        main.config_repository.get_config('order_limits'),
+    )
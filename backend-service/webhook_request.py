@@ -0,0 +1,141 @@
+# Parse-once view of a Dialogflow ES webhook request. The payload is walked a
+# single time when the request arrives; handlers then read the intent, the
+# session identifiers, normalized parameters and contexts (indexed by their
+# short name) from one slotted object instead of re-walking and re-splitting
+# the raw dict.
+import fast_json
+
+_SESSIONS = "/sessions/"
+_CONTEXTS = "/contexts/"
+
+
+def as_list(value) -> list:
+    """Dialogflow sends list parameters as lists and others as scalars; missing ones as ''."""
+    if isinstance(value, list):
+        return value
+    if value is None or value == "":
+        return []
+    return [value]
+
+
+def as_quantity(value, default=1):
+    """Parses a sys.number parameter ('2', 2.0, ...) to an int, or returns default."""
+    if isinstance(value, list):
+        value = value[0] if value else None
+    try:
+        return int(float(value))
+    except (ValueError, TypeError):
+        return default
+
+
+class OutputContext:
+    """One active Dialogflow context; short_name is the part after /contexts/."""
+
+    __slots__ = ("name", "short_name", "lifespan_count", "parameters")
+
+    def __init__(self, name: str, lifespan_count: int, parameters: dict):
+        self.name = name
+        self.short_name = name.rpartition(_CONTEXTS)[2]
+        self.lifespan_count = lifespan_count
+        self.parameters = parameters
+
+
+class WebhookRequest:
+    """
+    A Dialogflow webhook request, parsed once.
+
+    parameters keeps Dialogflow's values as sent; first(), values() and
+    quantity() give the normalized forms handlers need, whichever shape the
+    agent used for a parameter. raw is the decoded payload, for body logging.
+    """
+
+    __slots__ = ("intent", "response_id", "query_text", "session_path", "project_id", "session_id",
+                 "parameters", "contexts", "raw", "store_id", "session_key")
+
+    def __init__(self, intent: str, response_id: str, query_text: str, session_path: str,
+                 parameters: dict, contexts: dict, raw: dict = None):
+        self.intent = intent
+        self.response_id = response_id
+        self.query_text = query_text
+        self.session_path = session_path
+        # session_path is projects/<project>/agent[/environments/...]/sessions/<session>
+        self.project_id = session_path.split("/")[1]
+        self.session_id = session_path.rpartition(_SESSIONS)[2]
+        self.parameters = parameters
+        self.contexts = contexts
+        self.raw = raw
+        # Set by the webhook once the store is known (see stores.py); the
+        # session key scopes session state to the store
+        self.store_id = None
+        self.session_key = self.session_id
+
+    def first(self, name: str):
+        """The parameter's value, or its first value if it is a list; None if empty or missing."""
+        values = as_list(self.parameters.get(name))
+        return values[0] if values else None
+
+    def values(self, name: str) -> list:
+        """The parameter's values as a list, whether it was sent as a list or a scalar."""
+        return as_list(self.parameters.get(name))
+
+    def quantity(self, name: str = "number", default=1):
+        """The parameter as an integer quantity, or default if missing or not a number."""
+        return as_quantity(self.parameters.get(name), default)
+
+    def quantities(self, name: str = "number") -> list:
+        """Every value of a list number parameter as an integer; unparseable values count as 1."""
+        return [as_quantity(value) for value in as_list(self.parameters.get(name))]
+
+    def context(self, short_name: str):
+        """The active context with this short name (e.g. 'awaiting-size'), or None."""
+        return self.contexts.get(short_name)
+
+    def context_name(self, short_name: str) -> str:
+        """Full resource name of one of this session's contexts, for output contexts."""
+        return f"{self.session_path}{_CONTEXTS}{short_name}"
+
+
+def parse_webhook_request(data: dict) -> WebhookRequest:
+    """
+    Parses a raw webhook payload. Raises ValueError (or KeyError for a
+    payload without queryResult or intent) if the request is unusable.
+    """
+    query_result = data["queryResult"]
+    output_contexts = query_result.get("outputContexts") or []
+
+    session_path = data.get("session")
+    if not session_path:
+        # Older payloads only identify the session through its contexts
+        if not output_contexts:
+            raise ValueError("No session or output contexts found in request")
+        session_path = output_contexts[0]["name"].partition(_CONTEXTS)[0]
+    if _SESSIONS not in session_path:
+        raise ValueError(f"Malformed session name: {session_path}")
+
+    contexts = {}
+    for raw in output_contexts:
+        context = OutputContext(raw["name"], raw.get("lifespanCount", 0), raw.get("parameters") or {})
+        contexts.setdefault(context.short_name, context)
+
+    return WebhookRequest(
+        intent=query_result["intent"]["displayName"],
+        response_id=data.get("responseId"),
+        query_text=query_result.get("queryText"),
+        session_path=session_path,
+        parameters=query_result.get("parameters") or {},
+        contexts=contexts,
+        raw=data,
+    )
+
+
+def decode_webhook_request(body) -> WebhookRequest:
+    """
+    Decodes a webhook body (bytes or str) straight into a WebhookRequest
+    with the fast_json codec. Raises ValueError for invalid JSON or a
+    payload that is not a usable webhook request.
+    """
+    data = fast_json.loads(body)
+    try:
+        return parse_webhook_request(data)
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Malformed webhook request: {e!r}") from e